@@ -0,0 +1,178 @@
+import time
+import asyncio
+from collections import deque
+
+
+"""
+Adaptive concurrency control. An AdaptiveLimiter works like a semaphore whose
+size is adjusted at runtime with AIMD (additive increase, multiplicative
+decrease): it grows while the observed timeout ratio and p95 latency stay near
+their baselines, and shrinks quickly as soon as the local network or the
+resolver starts to drop work. A lot of scanned hosts never answer, so both
+signals are compared with a moving baseline instead of fixed thresholds.
+"""
+
+
+class AdaptiveLimiter:
+    """
+    Semaphore with an AIMD controlled limit.
+
+    Args:
+        initial (int): The limit at the start.
+        minimum (int): The limit never goes below this value.
+        maximum (int): The limit never goes above this value.
+        step (int | None): Additive increase per window, 5% of maximum by
+            default.
+        decrease (float): Multiplicative decrease factor of a congested
+            window.
+        interval (float): Minimum duration of a window in seconds.
+        min_samples (int): Minimum number of outcomes of a window.
+        error_margin (float): A window is congested if its timeout ratio is
+            higher than the baseline ratio plus this margin.
+        latency_factor (float): A window is congested if its p95 latency is
+            higher than the baseline p95 times this factor.
+        baseline_weight (float): Weight of a window in the baselines, they
+            are moving averages so a few unusually fast windows can't pin
+            them.
+        latency_floor_ms (float): Lower bound of the baseline p95.
+    """
+
+    def __init__(
+            self,
+            initial: int,
+            minimum: int = 1,
+            maximum: int = 10_000,
+            step: int | None = None,
+            decrease: float = 0.7,
+            interval: float = 1.0,
+            min_samples: int = 20,
+            error_margin: float = 0.1,
+            latency_factor: float = 2.0,
+            baseline_weight: float = 0.2,
+            latency_floor_ms: float = 1.0) -> None:
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit: int = min(max(initial, self.minimum), self.maximum)
+        self.step: int = step or max(1, self.maximum // 20)
+        self.decrease = decrease
+        self.interval = interval
+        self.min_samples = min_samples
+        self.error_margin = error_margin
+        self.latency_factor = latency_factor
+        self.baseline_weight = baseline_weight
+        self.latency_floor_ms = latency_floor_ms
+
+        self.in_flight: int = 0
+        self._waiters: deque[asyncio.Future] = deque()
+
+        self._window_start: float = time.monotonic()
+        self._outcomes: int = 0
+        self._timeouts: int = 0
+        self._latencies: list[float] = list()
+        self._base_error_ratio: float | None = None
+        self._base_p95: float | None = None
+
+    async def __aenter__(self) -> None:
+        await self.acquire()
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.release()
+
+    async def acquire(self) -> None:
+        """
+        Waits until the number of holders is below the current limit.
+        """
+
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was granted just before the cancellation
+                self.release()
+            else:
+                self._waiters.remove(future)
+            raise
+
+    def release(self) -> None:
+        """
+        Gives a slot back and wakes up waiters.
+        """
+
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        """Grants slots to waiters while the limit allows it."""
+
+        while self._waiters and self.in_flight < self.limit:
+            future = self._waiters.popleft()
+            if not future.done():
+                self.in_flight += 1
+                future.set_result(None)
+
+    def record(self, timed_out: bool, latency_ms: float | None = None) -> None:
+        """
+        Records the outcome of one operation and adjusts the limit at the
+        end of a window.
+
+        Args:
+            timed_out (bool): Whether the operation timed out.
+            latency_ms (float | None): Latency of a successful operation.
+        """
+
+        self._outcomes += 1
+        if timed_out:
+            self._timeouts += 1
+        elif latency_ms is not None:
+            self._latencies.append(latency_ms)
+
+        if (self._outcomes >= self.min_samples and
+                time.monotonic() - self._window_start >= self.interval):
+            self._adjust()
+
+    def _adjust(self) -> None:
+        """Applies AIMD to the limit based on the finished window."""
+
+        error_ratio = self._timeouts / self._outcomes
+        p95: float | None = None
+        if self._latencies:
+            self._latencies.sort()
+            p95 = self._latencies[int(0.95 * (len(self._latencies) - 1))]
+
+        if self._base_error_ratio is None:
+            self._base_error_ratio = error_ratio
+        if p95 is not None and self._base_p95 is None:
+            self._base_p95 = max(p95, self.latency_floor_ms)
+
+        congested = (
+            error_ratio > self._base_error_ratio + self.error_margin or
+            (p95 is not None and
+             p95 > self._base_p95 * self.latency_factor))
+
+        if congested:
+            self.limit = max(self.minimum, int(self.limit * self.decrease))
+        else:
+            self.limit = min(self.maximum, self.limit + self.step)
+
+        '''The baselines follow every window slowly, a lasting change of the
+        network (or a baseline learnt from untypical windows) stops counting
+        as congestion after a few windows'''
+        weight = self.baseline_weight
+        self._base_error_ratio += weight * (
+            error_ratio - self._base_error_ratio)
+        if p95 is not None:
+            self._base_p95 = max(
+                self.latency_floor_ms,
+                self._base_p95 + weight * (p95 - self._base_p95))
+
+        self._window_start = time.monotonic()
+        self._outcomes = 0
+        self._timeouts = 0
+        self._latencies.clear()
+        self._wake()
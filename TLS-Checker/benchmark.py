@@ -0,0 +1,564 @@
+import os
+import ssl
+import sys
+import json
+import time
+import zlib
+import random
+import shutil
+import socket
+import struct
+import asyncio
+import inspect
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from sys import exit
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from options import add_option_arguments, comma_list, headless_options
+
+
+"""
+Offline benchmark of the scanner. It starts a farm of local TLS servers
+(self-signed certificates, configurable TLS versions, ciphers and delays) on
+127.0.0.x and a DNS stub in separate processes, writes a synthetic input.csv
+into a temporary working directory and runs the scan path of main.py
+(create_tasks, the pipeline and the DatabaseWriter) against them. Then it
+times save(), database_convert() and geo_information() and reports the
+throughput, p50/p99 latency of every stage and the peak RSS.
+
+    python benchmark.py --domains 20000 --servers 16 --active-tasks 500
+
+The certificates are created with the openssl command line tool. The GeoIP
+databases (GeoLite2-ASN.mmdb, GeoLite2-City.mmdb) are taken from the
+directory of this script or from --geoip-dir.
+"""
+
+
+# Zone of the synthetic domains, the certificate is issued for *.ZONE
+ZONE: str = 'bench.test'
+
+
+@dataclass
+class ServerSpec:
+    """One local TLS server of the farm."""
+
+    address: str
+    version: str | None
+    ciphers: str | None
+    delay: float
+
+
+def free_port(kind: int = socket.SOCK_STREAM, host: str = '127.0.0.1') -> int:
+    """Returns a port that is free at the moment."""
+
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def create_certificates(directory: str) -> tuple[str, str, str]:
+    """
+    Creates a CA and a wildcard certificate for *.ZONE signed by it.
+
+    Returns:
+        tuple[str, str, str]: Paths of the CA certificate, the server
+        certificate and its key.
+
+    Raises:
+        SystemExit: If openssl is not installed or fails.
+    """
+
+    if shutil.which('openssl') is None:
+        print('| The benchmark needs the openssl command line tool')
+        exit(1)
+
+    ca_cert = os.path.join(directory, 'ca.pem')
+    ca_key = os.path.join(directory, 'ca.key')
+    cert = os.path.join(directory, 'server.pem')
+    key = os.path.join(directory, 'server.key')
+    csr = os.path.join(directory, 'server.csr')
+    extensions = os.path.join(directory, 'server.ext')
+    with open(extensions, 'w') as file:
+        file.write(f'subjectAltName=DNS:*.{ZONE}\n'
+                   'basicConstraints=critical,CA:FALSE\n'
+                   'keyUsage=critical,digitalSignature\n'
+                   'extendedKeyUsage=serverAuth\n'
+                   'subjectKeyIdentifier=hash\n'
+                   'authorityKeyIdentifier=keyid\n')
+
+    ec_key = ['-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+              '-nodes']
+    commands = [
+        ['openssl', 'req', '-x509', *ec_key, '-keyout', ca_key,
+         '-out', ca_cert, '-days', '2',
+         '-subj', '/C=XX/O=TLS-Checker Bench CA/CN=TLS-Checker Bench CA',
+         '-addext', 'basicConstraints=critical,CA:TRUE',
+         '-addext', 'keyUsage=critical,keyCertSign,cRLSign'],
+        ['openssl', 'req', *ec_key, '-keyout', key, '-out', csr,
+         '-subj', f'/C=XX/O=TLS-Checker Bench/CN=*.{ZONE}'],
+        ['openssl', 'x509', '-req', '-in', csr, '-CA', ca_cert,
+         '-CAkey', ca_key, '-CAcreateserial', '-out', cert, '-days', '2',
+         '-extfile', extensions],
+    ]
+    for command in commands:
+        try:
+            subprocess.run(command, check=True, capture_output=True)
+        except subprocess.CalledProcessError as e:
+            print(f'| openssl failed > {e.stderr.decode(errors="replace")}')
+            exit(1)
+    return ca_cert, cert, key
+
+
+def server_context(spec: ServerSpec, cert: str, key: str) -> ssl.SSLContext:
+    """Creates the SSLContext of one server of the farm."""
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    if spec.version:
+        version = ssl.TLSVersion[spec.version.replace('.', '_')]
+        context.minimum_version = context.maximum_version = version
+    if spec.ciphers:
+        context.set_ciphers(spec.ciphers)
+    return context
+
+
+class DelayedTls(asyncio.Protocol):
+    """
+    One connection to a server of the farm. Reading is paused before the
+    ClientHello arrives, the handshake starts after the delay of the server
+    and the connection is held until the client closes it.
+    """
+
+    def __init__(self, context: ssl.SSLContext, delay: float) -> None:
+        self.context = context
+        self.delay = delay
+        self.task: asyncio.Task | None = None
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        transport.pause_reading()
+        self.task = asyncio.ensure_future(self.handshake(transport))
+
+    async def handshake(self, transport: asyncio.Transport) -> None:
+        try:
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            await asyncio.get_running_loop().start_tls(
+                transport, self, self.context, server_side=True)
+        except Exception:
+            transport.abort()
+
+
+async def start_tls_server(
+        spec: ServerSpec, port: int, cert: str, key: str) -> asyncio.Server:
+    """Starts one TLS server of the farm."""
+
+    context = server_context(spec, cert, key)
+    return await asyncio.get_running_loop().create_server(
+        lambda: DelayedTls(context, spec.delay), spec.address, port,
+        backlog=4096)
+
+
+class DnsStub(asyncio.DatagramProtocol):
+    """
+    Answers A queries of the synthetic domains with the address of their
+    server, AAAA queries with an empty answer and names that start with
+    'nx' with NXDOMAIN.
+    """
+
+    def __init__(self, addresses: list[str], delay: float) -> None:
+        self.addresses = addresses
+        self.delay = delay
+        self.transport: asyncio.DatagramTransport | None = None
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        try:
+            response = self.answer(data)
+        except (IndexError, struct.error):
+            return
+        if self.delay:
+            asyncio.get_running_loop().call_later(
+                self.delay, self.transport.sendto, response, addr)
+        else:
+            self.transport.sendto(response, addr)
+
+    def answer(self, data: bytes) -> bytes:
+        """Builds the response to one query."""
+
+        query_id = struct.unpack('!H', data[:2])[0]
+        offset, labels = 12, list()
+        while data[offset]:
+            length = data[offset]
+            labels.append(data[offset + 1:offset + 1 + length].decode())
+            offset += 1 + length
+        question = data[12:offset + 5]
+        qtype = struct.unpack('!H', data[offset + 1:offset + 3])[0]
+        name = '.'.join(labels).lower()
+
+        if name.startswith('nx'):
+            # NXDOMAIN
+            return struct.pack('!6H', query_id, 0x8183, 1, 0, 0, 0) + question
+        if qtype != 1:
+            # NODATA
+            return struct.pack('!6H', query_id, 0x8180, 1, 0, 0, 0) + question
+
+        address = self.addresses[
+            zlib.crc32(name.encode()) % len(self.addresses)]
+        record = (b'\xc0\x0c' + struct.pack('!HHIH', 1, 1, 300, 4) +
+                  socket.inet_aton(address))
+        return (struct.pack('!6H', query_id, 0x8180, 1, 1, 0, 0) +
+                question + record)
+
+
+def serve_farm(
+        specs: list[ServerSpec],
+        port: int,
+        cert: str,
+        key: str,
+        dns: tuple[int, list[str], float] | None,
+        ready) -> None:
+    """
+    Runs a part of the server farm (and the DNS stub) in its own process
+    until it is terminated.
+    """
+
+    async def serve() -> None:
+        servers = [await start_tls_server(spec, port, cert, key)
+                   for spec in specs]
+        if dns is not None:
+            dns_port, addresses, delay = dns
+            await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: DnsStub(addresses, delay),
+                local_addr=('127.0.0.1', dns_port))
+        ready.set()
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+
+    asyncio.run(serve())
+
+
+def write_input(input_path: str, domains: int, nx_ratio: float,
+                seed: int) -> None:
+    """Writes a synthetic domain list, nx* names don't resolve."""
+
+    rng = random.Random(seed)
+    with open(input_path, 'w') as file:
+        for i in range(domains):
+            prefix = 'nx' if rng.random() < nx_ratio else 'd'
+            file.write(f'{prefix}{i}.{ZONE}\n')
+
+
+def percentile(values: list[float], share: float) -> float | None:
+    """Returns the value below which the given share of values falls."""
+
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def timed(handler: Callable[..., Awaitable],
+          durations: list[float]) -> Callable[..., Awaitable]:
+    """Wraps a stage handler and records its duration in milliseconds."""
+
+    async def wrapper(item, timeout):
+        started = time.perf_counter()
+        try:
+            return await handler(item, timeout)
+        finally:
+            durations.append((time.perf_counter() - started) * 1000)
+
+    return wrapper
+
+
+def peak_rss_mib() -> float | None:
+    """Returns the peak resident set size of this process in MiB."""
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024
+
+
+async def run_scan(input_path: str, options: dict,
+                   domain_list_length: int) -> dict:
+    """
+    Runs the scan path of main.py and measures it.
+
+    Returns:
+        dict: Elapsed seconds, saved scans, the durations of every stage,
+        the outcomes of the stages and operations, and the event loop.
+    """
+
+    import main
+    from geo_ip import close_geo_lookup
+    from save_to_database import DatabaseWriter
+
+    items, _, pipeline, cleanups = main.create_tasks(
+        input_path, options, domain_list_length)
+    durations: dict[str, list[float]] = dict()
+    for stage in pipeline.stages:
+        durations[stage.name] = list()
+        stage.handler = timed(stage.handler, durations[stage.name])
+
+    writer = DatabaseWriter(prepare=main.prepare_rows)
+    await writer.start()
+    started = time.perf_counter()
+    try:
+        async for record in pipeline.run(items):
+            if record is not None:
+                await writer.put(record)
+    finally:
+        await writer.close()
+        elapsed = time.perf_counter() - started
+        for cleanup in cleanups:
+            if inspect.isawaitable(result := cleanup()):
+                await result
+        close_geo_lookup()
+
+    return {'seconds': elapsed, 'saved': writer.written,
+            'durations': durations,
+            'outcomes': pipeline.metrics.snapshot()['outcomes'],
+            'loop': type(asyncio.get_running_loop()).__module__.split('.')[0]}
+
+
+def bench_save(domains: int) -> float:
+    """Times save() with synthetic rows of the given number of domains."""
+
+    import main
+    from record import ScanResult
+    from save_to_database import save
+
+    records: list[ScanResult] = list()
+    for i in range(domains):
+        record = ScanResult(f'save{i}.{ZONE}')
+        record.ipv4 = [f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}']
+        record.geo = [[64500, 'BENCH', 'XX', 'Benchland']]
+        record.tls_version = 'TLSv1.3'
+        record.cipher = 'TLS_AES_128_GCM_SHA256'
+        record.issuer_organ = 'TLS-Checker Bench CA'
+        record.tcp_connect_ms = 1.0
+        record.tls_handshake_ms = 2.0
+        record.scanned_at = int(time.time())
+        records.append(record)
+
+    started = time.perf_counter()
+    save(main.extract_results(records))
+    return time.perf_counter() - started
+
+
+def bench_convert(formats: list[str]) -> float:
+    """Times database_convert() of output.db."""
+
+    from csv_convertor import database_convert
+
+    started = time.perf_counter()
+    database_convert(formats)
+    return time.perf_counter() - started
+
+
+def bench_geo(lookups: int, seed: int) -> dict:
+    """Times geo_information() of random public IPv4 addresses."""
+
+    from geo_ip import close_geo_lookup, geo_information, get_geo_lookup
+
+    rng = random.Random(seed)
+    addresses = [
+        socket.inet_ntoa(struct.pack('!I', rng.randrange(1 << 24, 224 << 24)))
+        for _ in range(lookups)]
+    started = time.perf_counter()
+    for ip in addresses:
+        geo_information(ip)
+    elapsed = time.perf_counter() - started
+    lookup = get_geo_lookup()
+    hits = lookup.hits / max(1, lookup.hits + lookup.misses)
+    close_geo_lookup()
+    return {'seconds': elapsed, 'lookups': lookups, 'cache_hit_ratio': hits}
+
+
+def parse_arguments() -> argparse.Namespace:
+    """Parses the arguments of the benchmark and of the scan."""
+
+    parser = argparse.ArgumentParser(
+        description='Offline benchmark of TLS-Checker.')
+    parser.add_argument('--domains', type=int, default=5000,
+                        help='number of synthetic domains [default: 5000]')
+    parser.add_argument('--nx-ratio', type=float, default=0.05,
+                        help='share of domains that don\'t resolve '
+                             '[default: 0.05]')
+    parser.add_argument('--servers', type=int, default=8,
+                        help='number of local TLS servers [default: 8]')
+    parser.add_argument('--server-processes', type=int, default=2,
+                        help='processes running the server farm '
+                             '[default: 2]')
+    parser.add_argument('--versions', type=comma_list, default=['TLSv1.3'],
+                        metavar='VERSION[,VERSION...]',
+                        help='TLS versions of the servers, assigned round '
+                             'robin [default: TLSv1.3]')
+    parser.add_argument('--server-ciphers', action='append', default=None,
+                        metavar='CIPHERS',
+                        help='OpenSSL cipher string of TLS 1.2 servers, may '
+                             'be given more than once (round robin)')
+    parser.add_argument('--delays-ms', type=comma_list, default=['0'],
+                        metavar='MS[,MS...]',
+                        help='handshake delays of the servers, assigned '
+                             'round robin [default: 0]')
+    parser.add_argument('--dns-delay-ms', type=float, default=0,
+                        help='delay of every DNS answer [default: 0]')
+    parser.add_argument('--geo-lookups', type=int, default=100_000,
+                        help='number of geo_information() calls '
+                             '[default: 100000]')
+    parser.add_argument('--geoip-dir',
+                        help='directory of the GeoLite2 databases '
+                             '[default: the directory of this script]')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir',
+                        help='working directory, a temporary one is used '
+                             'and removed by default')
+    parser.add_argument('--json', metavar='PATH',
+                        help='also write the report as JSON')
+    add_option_arguments(parser)
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_arguments()
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    geoip_dir = os.path.abspath(args.geoip_dir or source_dir)
+    for name in ('GeoLite2-ASN.mmdb', 'GeoLite2-City.mmdb'):
+        if not os.path.isfile(os.path.join(geoip_dir, name)):
+            print(f'| {name} is missing, run main.py with --update-geoip '
+                  f'once')
+            exit(1)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='tls-checker-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    for name in ('GeoLite2-ASN.mmdb', 'GeoLite2-City.mmdb'):
+        shutil.copyfile(os.path.join(geoip_dir, name),
+                        os.path.join(workdir, name))
+    # The modules of the scanner use the working directory of the import
+    os.chdir(workdir)
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    ca_cert, cert, key = create_certificates(workdir)
+    # create_default_context() of the scanner trusts the benchmark CA
+    os.environ['SSL_CERT_FILE'] = ca_cert
+
+    specs = [
+        ServerSpec(
+            address=f'127.0.0.{2 + i}',
+            version=args.versions[i % len(args.versions)],
+            ciphers=(args.server_ciphers[i % len(args.server_ciphers)]
+                     if args.server_ciphers else None),
+            delay=float(args.delays_ms[i % len(args.delays_ms)]) / 1000)
+        for i in range(max(1, min(args.servers, 250)))]
+    port = free_port()
+    dns_port = free_port(socket.SOCK_DGRAM)
+
+    context = multiprocessing.get_context('spawn')
+    processes = list()
+    for index in range(max(1, min(args.server_processes, len(specs)))):
+        ready = context.Event()
+        dns = None
+        if index == 0:
+            dns = (dns_port, [spec.address for spec in specs],
+                   args.dns_delay_ms / 1000)
+        process = context.Process(
+            target=serve_farm,
+            args=(specs[index::args.server_processes], port, cert, key, dns,
+                  ready),
+            daemon=True)
+        process.start()
+        processes.append((process, ready))
+    for process, ready in processes:
+        if not ready.wait(30):
+            print('| The server farm did not start')
+            exit(1)
+
+    input_path = os.path.join(workdir, 'input.csv')
+    write_input(input_path, args.domains, args.nx_ratio, args.seed)
+
+    options = headless_options(args, args.domains)
+    options['nameservers'] = [f'127.0.0.1:{dns_port}']
+    options['tls_port'] = port
+    options['update_geoip'] = False
+    options['resume_hours'] = 0
+    # Every run starts cold
+    options['dns_cache'] = False
+
+    print(f'| Scanning {args.domains} synthetic domains with '
+          f'{len(specs)} servers ...')
+    try:
+        from main import loop_runner
+        scan = loop_runner(options['loop'])(
+            run_scan(input_path, options, args.domains))
+        save_seconds = bench_save(args.domains)
+        convert_seconds = bench_convert(options['export_formats'])
+        geo = bench_geo(args.geo_lookups, args.seed)
+    finally:
+        for process, _ in processes:
+            process.terminate()
+            process.join()
+
+    report = {
+        'domains': args.domains,
+        'servers': len(specs),
+        'options': {key: options[key] for key in (
+            'active_tasks', 'adaptive', 'max_workers', 'tls_timeout',
+            'dns_timeout', 'ping')},
+        'loop': scan['loop'],
+        'scan_seconds': scan['seconds'],
+        'domains_per_second': args.domains / scan['seconds'],
+        'saved_scans': scan['saved'],
+        'stages': {
+            name: {'count': len(values),
+                   'p50_ms': percentile(values, 0.5),
+                   'p99_ms': percentile(values, 0.99)}
+            for name, values in scan['durations'].items()},
+        'outcomes': scan['outcomes'],
+        'save_seconds': save_seconds,
+        'convert_seconds': convert_seconds,
+        'geo_lookups_per_second': geo['lookups'] / geo['seconds'],
+        'geo_cache_hit_ratio': geo['cache_hit_ratio'],
+        'peak_rss_mib': peak_rss_mib(),
+    }
+
+    print(f'|{95 * "_"}')
+    print(f'| Scan: {report["domains_per_second"]:.0f} domains/s '
+          f'({args.domains} domains in {scan["seconds"]:.2f} s, '
+          f'{scan["saved"]} scans saved, {scan["loop"]} loop)')
+    for name, stage in report['stages'].items():
+        if stage['count']:
+            print(f'| {name:<8} p50 {stage["p50_ms"]:8.2f} ms   '
+                  f'p99 {stage["p99_ms"]:8.2f} ms   ({stage["count"]})')
+    for name, outcomes in report['outcomes'].items():
+        print(f'| {name:<10}' + ', '.join(
+            f'{outcome}: {count}' for outcome, count in outcomes.items()))
+    print(f'| save: {args.domains} scans in {save_seconds:.2f} s')
+    print(f'| database_convert: {convert_seconds:.2f} s')
+    print(f'| geo_information: {report["geo_lookups_per_second"]:.0f} '
+          f'lookups/s (cache hits {geo["cache_hit_ratio"]:.0%})')
+    if report['peak_rss_mib'] is not None:
+        print(f'| Peak RSS: {report["peak_rss_mib"]:.1f} MiB')
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f'| Report saved to {args.json} ✓')
+
+    os.chdir(source_dir)
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
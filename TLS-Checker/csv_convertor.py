@@ -1,18 +1,49 @@
 import os
 import csv
+import json
+import time
 import sqlite3
 from sys import exit
-import logging.handlers
+from typing import Iterator
+from itertools import chain
+from contextlib import contextmanager
 
 
 """
-This script converts SQLite database tables to csv files.
-The database file is assumed to be named 'RapGoat.db' and located in the
-current working directory. The csv files will be saved in a 'csv' subdirectory
-within the current working directory.
+This script exports the SQLite database tables and views to csv, jsonl and
+parquet files. The database file is assumed to be named 'output.db' and located
+in the current working directory. The files are saved in a 'csv', 'jsonl'
+and 'parquet' subdirectory within the current working directory.
+
+Rows are streamed from the database in batches, so memory doesn't depend on
+the size of the tables. In incremental mode only the scans written since the
+last export are appended to the history tables (scans and scan_addresses,
+keyed by the scan id), the snapshot tables and views like 'results' (the
+newest scan of every domain) are rewritten. The position of the last export
+of every format is kept in 'export_state.json'.
 """
 
 
+# Number of rows fetched from the database at once
+BATCH_SIZE: int = 10_000
+
+EXPORT_FORMATS: tuple[str, ...] = ('csv', 'jsonl', 'parquet')
+
+# Rows of the history tables that were written by the scans with an id in
+# (since, until], an incremental export appends them. Every other table and
+# view is a snapshot (e.g. the newest scan of every domain or the current geo
+# information of an address) whose rows change in place, so it is always
+# exported completely.
+CHANGED_ROWS: dict[str, str] = {
+    'scans': '''
+        SELECT * FROM scans WHERE id > ? AND id <= ?
+    ''',
+    'scan_addresses': '''
+        SELECT * FROM scan_addresses WHERE scan_id > ? AND scan_id <= ?
+    ''',
+}
+
+
 def get_database_dir() -> str:
     """
     Get the directory of the database file.
@@ -39,15 +70,242 @@ def check_database(db_dir: str) -> None:
         exit(1)
 
 
-def convertor(database_dir: str) -> None:
+def get_export_dir(export_format: str) -> str:
+    """
+    Creates the directory of an export format in this place, if it doesn't
+    exist.
+
+    Args:
+        export_format (str): 'csv', 'jsonl' or 'parquet'.
+
+    Returns:
+        str: The path of the directory.
+    """
+
+    export_dir: str = os.path.join(os.getcwd(), export_format)
+    if not os.path.exists(export_dir):
+        print(f'| "{export_format}" directory does\'nt exist.'
+              f'\nNow is created automatically...')
+        os.mkdir(export_dir)
+    return export_dir
+
+
+def load_state() -> dict[str, int]:
+    """
+    Reads the position of the newest exported row of every format.
+
+    Returns:
+        dict[str, int]: Export format -> id of the newest scan, empty if
+        nothing was exported incrementally yet.
+    """
+
+    state_path = os.path.join(os.getcwd(), 'export_state.json')
+    try:
+        with open(state_path) as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_state(state: dict[str, int]) -> None:
+    """
+    Writes the export positions, see load_state().
+
+    Args:
+        state (dict[str, int]): Export format -> id of the newest scan.
+    """
+
+    state_path = os.path.join(os.getcwd(), 'export_state.json')
+    with open(state_path + '.tmp', 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(state_path + '.tmp', state_path)
+
+
+def iter_batches(cur: sqlite3.Cursor) -> Iterator[list[tuple]]:
+    """
+    Streams the rows of an executed query in batches of BATCH_SIZE rows.
+
+    Args:
+        cur (sqlite3.Cursor): The cursor of the executed query.
+
+    Yields:
+        list[tuple]: The next batch of rows.
+    """
+
+    while batch := cur.fetchmany(BATCH_SIZE):
+        yield batch
+
+
+@contextmanager
+def undo_append(file_path: str, append: bool) -> Iterator[None]:
+    """
+    Cuts a file back to its old size if appending to it fails, so the next
+    export doesn't append the rows twice.
+
+    Args:
+        file_path (str): The file the rows are appended to.
+        append (bool): Whether the rows are appended to an existing file.
+    """
+
+    size = os.path.getsize(file_path) if append else 0
+    try:
+        yield
+    except Exception:
+        if append:
+            os.truncate(file_path, size)
+        raise
+
+
+def write_csv(file_path: str, headers: list[str],
+              batches: Iterator[list[tuple]], append: bool) -> int:
+    """
+    Writes rows to a csv file, the header is only written to a new file.
+
+    Returns:
+        int: The number of written rows.
+    """
+
+    written = 0
+    append = append and os.path.isfile(file_path)
+    with undo_append(file_path, append), \
+            open(file_path, 'a' if append else 'w', newline='') as csvfile:
+        writer = csv.writer(
+            csvfile, delimiter=',', lineterminator='\r\n',
+            quoting=csv.QUOTE_ALL, escapechar='\\')
+        if not append:
+            writer.writerow(headers)
+        for batch in batches:
+            # Replace not exist values with null instead of empty string
+            writer.writerows(
+                ['NULL' if value is None else value for value in row]
+                for row in batch)
+            written += len(batch)
+    return written
+
+
+def write_jsonl(file_path: str, headers: list[str],
+                batches: Iterator[list[tuple]], append: bool) -> int:
+    """
+    Writes rows to a JSON lines file, one object per row.
+
+    Returns:
+        int: The number of written rows.
+    """
+
+    written = 0
+    append = append and os.path.isfile(file_path)
+    with undo_append(file_path, append), \
+            open(file_path, 'a' if append else 'w', encoding='utf-8') as file:
+        for batch in batches:
+            file.writelines(
+                json.dumps(dict(zip(headers, row)), ensure_ascii=False) + '\n'
+                for row in batch)
+            written += len(batch)
+    return written
+
+
+def write_parquet(dir_path: str, headers: list[str],
+                  batches: Iterator[list[tuple]], append: bool,
+                  types: list[str]) -> int:
     """
-    Convert the database tables to csv files.
+    Writes rows to a zstd compressed parquet file in the dataset directory
+    of a table. Every export adds one part file, a full export removes the
+    old ones first.
+
+    Args:
+        types (list[str]): The declared type of every column, see
+            column_types(). SQLite doesn't enforce them, a numeric column
+            that holds text in the first batch is written as text.
+
+    Returns:
+        int: The number of written rows.
+
+    Raises:
+        ValueError: If a later batch holds text in a numeric column.
+    """
+
+    import pyarrow
+    import pyarrow.parquet
+
+    batches = iter(batches)
+    first: list[tuple] = next(batches, [])
+    if first:
+        types = [
+            'text' if any(isinstance(value, (str, bytes)) for value in column)
+            else column_type
+            for column_type, column in zip(types, zip(*first))]
+
+    arrow_types = {'integer': pyarrow.int64(), 'real': pyarrow.float64()}
+    schema = pyarrow.schema([
+        (header, arrow_types.get(column_type, pyarrow.string()))
+        for header, column_type in zip(headers, types)])
+
+    os.makedirs(dir_path, exist_ok=True)
+    if not append:
+        for name in os.listdir(dir_path):
+            if name.endswith('.parquet'):
+                os.remove(os.path.join(dir_path, name))
+
+    written = 0
+    file_path = os.path.join(dir_path, f'part-{time.time_ns()}.parquet')
+    try:
+        with pyarrow.parquet.ParquetWriter(
+                file_path, schema, compression='zstd') as writer:
+            for batch in chain([first] if first else [], batches):
+                columns = [
+                    [value if value is None or column_type != 'text'
+                     else str(value) for value in column]
+                    for column, column_type in zip(zip(*batch), types)]
+                writer.write_batch(
+                    pyarrow.record_batch(columns, schema=schema))
+                written += len(batch)
+    except Exception:
+        # The rows of a failed part are written again by the next export
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+        raise
+    return written
+
+
+def column_types(cur: sqlite3.Cursor, table_name: str) -> list[str]:
+    """
+    Finds the declared type of every column of a table or view.
+
+    Returns:
+        list[str]: 'integer', 'real' or 'text' for every column.
+    """
+
+    cur.execute(f'PRAGMA table_info({table_name})')
+    types: list[str] = list()
+    for row in cur.fetchall():
+        column_type = (row[2] or '').upper()
+        if 'INT' in column_type:
+            types.append('integer')
+        elif any(name in column_type for name in ('REAL', 'FLOA', 'DOUB')):
+            types.append('real')
+        else:
+            types.append('text')
+    return types
+
+
+def convertor(
+        database_dir: str,
+        formats: tuple[str, ...] = ('csv',),
+        incremental: bool = False) -> None:
+    """
+    Exports the database tables.
 
     Args:
         database_dir (str): The path to the database file.
+        formats (tuple[str, ...]): Export formats, see EXPORT_FORMATS.
+        incremental (bool): Only append the rows written since the last
+            export of each format, see CHANGED_ROWS.
 
     Raises:
-        SystemExit: If database connection or data export fails.
+        SystemExit: If database connection or data export fails. The
+        position of a format is only saved if all of its tables were
+        exported, so a failed incremental export is repeated by the next
+        one.
     """
 
     check_database(database_dir)
@@ -62,68 +320,107 @@ def convertor(database_dir: str) -> None:
         # table_list includes all table name that includes in our database
         table_list = get_table_names(cur)
 
-    for table in table_list:
-        table_name = table[0]
-        try:
-            cur.execute(f'''
-                    SELECT * FROM {table_name}
-                ''')
-            all_data = cur.fetchall()
-        except sqlite3.DatabaseError as e:
-            print(f'| Data export from {table_name} was unsuccessful > {e}')
-            exit(1)
-        else:
-            '''According to PEP 249, this read-only attribute is a sequence of 
-            7-items sequences. Each of these sequences contains information
-            describing one result column. Here we need just "name". 
-            name,type_code,display_size,internal_size,precision,scale,null_ok
-            '''
-            table_headers: list[str] = [desc[0] for desc in cur.description]
-
-        '''Creates csv folder in this place, if it not exists'''
-        this_dir: str = os.getcwd()
-        if not os.path.exists(this_dir + '/csv'):
-            print(f'| "csv" directory does\'nt exist.'
-                  f'\nNow is created automatically...')
-            csv_dir: str = os.path.join(this_dir, 'csv')
-            os.mkdir(csv_dir)
-
-        '''Defines name of .csv file and opens it to write data in it'''
-        csv_file_dir: str = this_dir + f'/csv/{table_name}.csv'
-        try:
-            with open(csv_file_dir, 'w', newline='') as csvfile:
-                writer = csv.writer(
-                    csvfile, delimiter=',', lineterminator='\r\n',
-                    quoting=csv.QUOTE_ALL, escapechar='\\')
-                writer.writerow(table_headers)
-                # Replace not exist values with null instead of empty string
-                for row in all_data:
-                    data_with_none = [
-                        'NULL' if value is None else value for value in row
-                    ]
-                    writer.writerow(data_with_none)
-        except IOError as e:
-            print(f'| convertor > {e}')
-        else:
-            print(f'| Data exported from {table_name} successfully ✓')
+    state = load_state()
+    '''The newest row at the start is the end of this export, so every
+    table is exported up to the same point'''
+    try:
+        cur.execute('SELECT max(id) FROM scans')
+        until: int = cur.fetchone()[0] or 0
+    except sqlite3.DatabaseError:
+        until = 0
+
+    failed: list[str] = list()
+    for export_format in formats:
+        if export_format not in EXPORT_FORMATS:
+            print(f'| Unknown export format: {export_format}')
+            failed.append(export_format)
+            continue
+        if export_format == 'parquet':
+            try:
+                import pyarrow.parquet
+            except ImportError:
+                print('| Parquet export needs the "pyarrow" module:'
+                      ' pip install pyarrow')
+                failed.append(export_format)
+                continue
+
+        since: int = state.get(export_format, 0)
+        export_dir = get_export_dir(export_format)
+        for table in table_list:
+            table_name = table[0]
+            # The first incremental export of a format writes everything
+            append = (incremental and export_format in state and
+                      table_name in CHANGED_ROWS)
+            if append:
+                query, params = CHANGED_ROWS[table_name], (since, until)
+            else:
+                query, params = f'SELECT * FROM {table_name}', ()
+
+            try:
+                if export_format == 'parquet':
+                    types = column_types(cur, table_name)
+                cur.execute(query, params)
+                '''According to PEP 249, this read-only attribute is a
+                sequence of 7-items sequences. Each of these sequences
+                contains information describing one result column. Here we
+                need just "name".
+                name,type_code,display_size,internal_size,precision,scale,
+                null_ok'''
+                table_headers: list[str] = [
+                    desc[0] for desc in cur.description]
+
+                file_path = os.path.join(
+                    export_dir, f'{table_name}.{export_format}')
+                match export_format:
+                    case 'csv':
+                        written = write_csv(file_path, table_headers,
+                                            iter_batches(cur), append)
+                    case 'jsonl':
+                        written = write_jsonl(file_path, table_headers,
+                                              iter_batches(cur), append)
+                    case _:
+                        written = write_parquet(
+                            os.path.join(export_dir, table_name),
+                            table_headers, iter_batches(cur), append, types)
+            except sqlite3.DatabaseError as e:
+                print(f'| Data export from {table_name} was unsuccessful > '
+                      f'{e}')
+                exit(1)
+            except (IOError, ValueError) as e:
+                print(f'| convertor > {e}')
+                if export_format not in failed:
+                    failed.append(export_format)
+            else:
+                print(f'| Data exported from {table_name} to {export_format} '
+                      f'successfully ({written} rows) ✓')
+
+        if export_format not in failed:
+            state[export_format] = until
+    save_state(state)
 
     con.close()
+    if failed:
+        print(f'| Export to {", ".join(failed)} was unsuccessful, the next '
+              f'export writes its rows again')
+        exit(1)
 
 
 def get_table_names(cur: sqlite3.Cursor) -> list:
     """
-    Retrieve the names of all tables in the database.
+    Retrieve the names of all tables and views in the database, the
+    internal tables of SQLite are skipped.
 
     Args:
         cur (sqlite3.Cursor): The cursor object for executing SQL queries.
 
     Returns:
-        list: A list of table names in the database.
+        list: A list of table and view names in the database.
     """
 
     try:
         cur.execute('''
-            SELECT name FROM sqlite_master WHERE type='table';
+            SELECT name FROM sqlite_master
+            WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%';
         ''')
     except sqlite3.Error as e:
         print(f'| get_table_name > failed to retrieve table names > {e}')
@@ -132,10 +429,17 @@ def get_table_names(cur: sqlite3.Cursor) -> list:
         return cur.fetchall()
 
 
-def database_convert():
+def database_convert(
+        formats: tuple[str, ...] = ('csv',),
+        incremental: bool = False) -> None:
     """
-    Execute the database to CSV conversion process.
+    Execute the database export process.
+
+    Args:
+        formats (tuple[str, ...]): Export formats, see EXPORT_FORMATS.
+        incremental (bool): Only append the rows written since the last
+            export.
     """
 
     database_dir = get_database_dir()
-    convertor(database_dir)
+    convertor(database_dir, formats, incremental)
@@ -0,0 +1,323 @@
+import time
+import sqlite3
+from collections import OrderedDict
+from typing import NamedTuple
+
+import aiodns
+from aiodns.error import DNSError, ARES_ENODATA, ARES_ENOTFOUND
+
+
+"""
+DNS layer with caching. Answers are cached for their TTL and NXDOMAIN/NODATA
+answers for a fixed negative TTL, in a bounded in-memory LRU and optionally in
+'dns_cache.db' next to 'output.db', so back-to-back scans skip the network for
+names that are still fresh. The file is queried on a miss of the LRU and new
+answers are written into it in batches during the scan, so memory doesn't
+grow with the input or the cache history. Queries are spread round-robin over
+several resolver channels, one or more per configured nameserver.
+"""
+
+
+# Answers that say the name or the record doesn't exist are cached
+NEGATIVE_ERRORS: tuple[int, ...] = (ARES_ENOTFOUND, ARES_ENODATA)
+
+
+class Answer(NamedTuple):
+    """One cached address record, compatible with the aiodns results."""
+
+    host: str
+    ttl: int
+
+
+class CachingResolver:
+    """
+    Drop-in replacement for aiodns.DNSResolver.query() with a TTL honoring
+    cache and a pool of resolver channels.
+
+    Args:
+        nameservers (list[str] | None): Nameservers to query as 'ip' or
+            'ip:port' ('[ip]:port' for IPv6), the system configuration is used
+            if it is None or empty.
+        channels (int): Number of resolver channels per nameserver.
+        negative_ttl (int): Seconds an NXDOMAIN/NODATA answer is cached.
+        max_ttl (int): Upper bound of the cached TTL of positive answers.
+        cache_path (str | None): Path of the SQLite file the cache is read
+            from and written to, nothing is persisted if it is None.
+        max_entries (int): Number of answers kept in memory.
+        flush_size (int): Number of new answers written into the file in
+            one batch.
+        flush_interval (float): Seconds after which the pending answers are
+            written even if the batch is not full.
+    """
+
+    def __init__(
+            self,
+            nameservers: list[str] | None = None,
+            channels: int = 1,
+            negative_ttl: int = 300,
+            max_ttl: int = 86_400,
+            cache_path: str | None = None,
+            max_entries: int = 100_000,
+            flush_size: int = 1_000,
+            flush_interval: float = 10.0) -> None:
+        channels = max(1, channels)
+        if nameservers:
+            self._resolvers = [
+                create_resolver(nameserver)
+                for nameserver in nameservers for _ in range(channels)]
+        else:
+            self._resolvers = [
+                aiodns.DNSResolver() for _ in range(channels)]
+        self._next: int = 0
+
+        self.negative_ttl = negative_ttl
+        self.max_ttl = max_ttl
+        self.cache_path = cache_path
+        self.max_entries = max(1, max_entries)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.hits: int = 0
+        self.misses: int = 0
+        # (name, query type) -> (expires at, hosts or error code), the least
+        # recently used entry first
+        self._cache: OrderedDict[
+            tuple[str, str], tuple[float, tuple | int]] = OrderedDict()
+        # The answers that are not written into the file yet
+        self._dirty: dict[tuple[str, str], tuple[float, tuple | int]] = dict()
+        self._flushed: float = time.monotonic()
+
+        self._con: sqlite3.Connection | None = None
+        if cache_path is not None:
+            self._con = open_cache(cache_path)
+
+    async def query(self, host: str, qtype: str) -> list[Answer]:
+        """
+        Resolves one record type of a name, from the cache if it is fresh.
+
+        Args:
+            host (str): The name to resolve.
+            qtype (str): The record type, 'A' or 'AAAA'.
+
+        Returns:
+            list[Answer]: The address records.
+
+        Raises:
+            DNSError: If the name or record doesn't exist or the query fails.
+        """
+
+        answers = self.cached(host, qtype)
+        if answers is not None:
+            return answers
+
+        key = (host, qtype)
+        now = time.time()
+        self.misses += 1
+        resolver = self._resolvers[self._next]
+        self._next = (self._next + 1) % len(self._resolvers)
+
+        try:
+            response = await resolver.query(host, qtype)
+        except DNSError as e:
+            if e.args and e.args[0] in NEGATIVE_ERRORS:
+                self._store(key, now + self.negative_ttl, e.args[0])
+            raise
+
+        hosts = tuple(record.host for record in response if record)
+        ttl = min((getattr(record, 'ttl', 0) for record in response),
+                  default=0)
+        if ttl > 0:
+            self._store(key, now + min(ttl, self.max_ttl), hosts)
+        return [Answer(ip, ttl) for ip in hosts]
+
+    def cached(self, host: str, qtype: str) -> list[Answer] | None:
+        """
+        Answers a query from the cache without going to the network.
+
+        Args:
+            host (str): The name to resolve.
+            qtype (str): The record type, 'A' or 'AAAA'.
+
+        Returns:
+            list[Answer] | None: The cached address records, None if there
+            is no fresh entry.
+
+        Raises:
+            DNSError: If a fresh negative answer is cached.
+        """
+
+        key = (host, qtype)
+        cached = self._cache.get(key)
+        if cached is None:
+            cached = self._read(key)
+            if cached is None:
+                return None
+            self._remember(key, cached)
+        else:
+            self._cache.move_to_end(key)
+        expires, value = cached
+        now = time.time()
+        if expires <= now:
+            del self._cache[key]
+            return None
+        self.hits += 1
+        if isinstance(value, int):
+            raise DNSError(value, 'cached negative answer')
+        return [Answer(ip, int(expires - now)) for ip in value]
+
+    def _remember(self, key: tuple[str, str],
+                  cached: tuple[float, tuple | int]) -> None:
+        """Puts one entry into the LRU and evicts the oldest ones."""
+
+        self._cache[key] = cached
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def _store(self, key: tuple[str, str], expires: float,
+               value: tuple | int) -> None:
+        """Caches one answer and writes it into the file with a batch."""
+
+        self._remember(key, (expires, value))
+        if self._con is None:
+            return
+        self._dirty[key] = (expires, value)
+        if (len(self._dirty) >= self.flush_size or
+                time.monotonic() - self._flushed >= self.flush_interval):
+            self.flush()
+
+    def _read(self, key: tuple[str, str]) -> tuple[float, tuple | int] | None:
+        """
+        Looks up one entry in the cache file. It is a primary key lookup in
+        a local file, cheaper than handing it to an executor.
+        """
+
+        if self._con is None:
+            return None
+        try:
+            row = self._con.execute('''
+                SELECT expires, hosts, error FROM dns_cache
+                WHERE name = ? AND qtype = ?
+            ''', key).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        expires, hosts, error = row
+        if error is not None:
+            return expires, error
+        return expires, tuple(hosts.split(',') if hosts else ())
+
+    def flush(self) -> None:
+        """
+        Writes the pending answers into the cache file in one transaction.
+        """
+
+        self._flushed = time.monotonic()
+        if self._con is None or not self._dirty:
+            return
+        rows: list[tuple] = list()
+        for key, (expires, value) in self._dirty.items():
+            if isinstance(value, int):
+                rows.append((*key, expires, None, value))
+            else:
+                rows.append((*key, expires, ','.join(value), None))
+        self._dirty.clear()
+
+        try:
+            with self._con:
+                self._con.executemany('''
+                    INSERT OR REPLACE INTO dns_cache (
+                        name, qtype, expires, hosts, error
+                    ) VALUES (?, ?, ?, ?, ?)
+                ''', rows)
+        except sqlite3.Error as e:
+            print(f'\n| DNS cache could not be saved > {e}')
+
+    def save(self) -> None:
+        """
+        Writes the pending answers, removes the expired entries of the cache
+        file and closes it. It blocks, so it should run in an executor while
+        the loop is busy.
+        """
+
+        if self._con is None:
+            return
+        self.flush()
+        try:
+            with self._con:
+                self._con.execute('DELETE FROM dns_cache WHERE expires <= ?',
+                                  (time.time(),))
+        except sqlite3.Error as e:
+            print(f'| DNS cache could not be saved > {e}')
+        self._con.close()
+        self._con = None
+
+
+def create_resolver(nameserver: str) -> aiodns.DNSResolver:
+    """
+    Creates a resolver channel for one nameserver.
+
+    Args:
+        nameserver (str): 'ip', 'ip:port' or '[ipv6]:port'.
+
+    Returns:
+        aiodns.DNSResolver: The resolver of the nameserver.
+    """
+
+    host, port = nameserver, None
+    if nameserver.startswith('['):
+        host, _, port = nameserver[1:].partition(']:')
+    elif nameserver.count(':') == 1:
+        host, _, port = nameserver.partition(':')
+
+    if port:
+        return aiodns.DNSResolver(
+            nameservers=[host], udp_port=int(port), tcp_port=int(port))
+    return aiodns.DNSResolver(nameservers=[host])
+
+
+def open_cache(cache_path: str) -> sqlite3.Connection | None:
+    """
+    Opens the cache file, it is created if it doesn't exist.
+
+    Args:
+        cache_path (str): Path of the SQLite file.
+
+    Returns:
+        sqlite3.Connection | None: The connection, or None if the file can
+        not be used (the cache is kept in memory only then).
+    """
+
+    # save() runs in an executor thread after the scan
+    con = sqlite3.connect(cache_path, check_same_thread=False)
+    try:
+        # Batches are committed without waiting for the disk
+        con.execute('PRAGMA journal_mode=WAL')
+        con.execute('PRAGMA synchronous=NORMAL')
+        create_cache_table(con.cursor())
+        con.commit()
+    except sqlite3.Error as e:
+        print(f'| DNS cache could not be opened > {e}')
+        con.close()
+        return None
+    return con
+
+
+def create_cache_table(cur: sqlite3.Cursor) -> None:
+    """
+    Creates the 'dns_cache' table if it doesn't exist.
+
+    Args:
+        cur (sqlite3.Cursor): The cursor object for executing SQL queries.
+    """
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS dns_cache (
+        name TEXT,
+        qtype TEXT,
+        expires REAL,
+        hosts TEXT,
+        error INTEGER,
+        PRIMARY KEY (name, qtype)
+        )
+    ''')
@@ -0,0 +1,140 @@
+from collections import Counter
+from typing import Awaitable, Callable
+
+from record import ScanResult
+
+
+"""
+Declarative early-exit filters. A domain is dropped by the first stage whose
+result disqualifies it, so the later (more expensive) stages never run for
+it and it is not saved. The checks of a stage only look at what that stage
+(or an earlier one) has filled in.
+"""
+
+
+class Filters:
+    """
+    The filter predicates of a scan, an empty Filters lets everything pass.
+
+    Args:
+        tls_versions (list[str]): Allowed TLS versions, e.g. ['TLSv1.3'], a
+            failed handshake never matches. Empty allows every outcome.
+        require_ipv6 (bool): Drop domains without an AAAA record.
+        exclude_issuers (list[str]): Issuer organizations to drop
+            (case-insensitive).
+        exclude_asns (list[int | str]): ASNs of the probed address to drop,
+            '13335' and 'AS13335' are both accepted.
+        exclude_countries (list[str]): ISO codes or English names of the
+            country of the probed address to drop (case-insensitive).
+    """
+
+    def __init__(
+            self,
+            tls_versions: list[str] = (),
+            require_ipv6: bool = False,
+            exclude_issuers: list[str] = (),
+            exclude_asns: list[int | str] = (),
+            exclude_countries: list[str] = ()) -> None:
+        self.tls_versions: set[str] = {
+            version.lower() for version in tls_versions}
+        self.require_ipv6 = require_ipv6
+        self.exclude_issuers: set[str] = {
+            issuer.lower() for issuer in exclude_issuers}
+        self.exclude_asns: set[int] = {
+            int(str(asn).upper().removeprefix('AS')) for asn in exclude_asns}
+        self.exclude_countries: set[str] = {
+            country.lower() for country in exclude_countries}
+        # Reason -> number of dropped domains
+        self.dropped: Counter = Counter()
+
+    @classmethod
+    def from_options(cls, options: dict) -> 'Filters':
+        """Creates the filters of the options of get_options()."""
+
+        return cls(
+            tls_versions=options.get('require_tls') or (),
+            require_ipv6=bool(options.get('require_ipv6')),
+            exclude_issuers=options.get('exclude_issuers') or (),
+            exclude_asns=options.get('exclude_asns') or (),
+            exclude_countries=options.get('exclude_countries') or ())
+
+    def __bool__(self) -> bool:
+        return bool(self.tls_versions or self.require_ipv6 or
+                    self.exclude_issuers or self.needs_geo)
+
+    @property
+    def needs_geo(self) -> bool:
+        """Whether a check depends on the geo information."""
+
+        return bool(self.exclude_asns or self.exclude_countries)
+
+    def _drop(self, reason: str) -> bool:
+        self.dropped[reason] += 1
+        return False
+
+    def check_addresses(self, record: ScanResult) -> bool:
+        """Checks the result of the resolve stage."""
+
+        if self.require_ipv6 and not record.ipv6:
+            return self._drop('ipv6')
+        return True
+
+    def check_tls(self, record: ScanResult) -> bool:
+        """Checks the result of the tls stage."""
+
+        if self.tls_versions and (
+                record.tls_version is None or
+                record.tls_version.lower() not in self.tls_versions):
+            return self._drop('tls_version')
+        if (record.issuer_organ is not None and
+                record.issuer_organ.lower() in self.exclude_issuers):
+            return self._drop('issuer')
+        return True
+
+    def check_geo(self, record: ScanResult) -> bool:
+        """Checks the geo information of the probed address."""
+
+        asn, _, iso_code, country = record.probed_geo
+        if asn is not None and asn in self.exclude_asns:
+            return self._drop('asn')
+        if self.exclude_countries and (
+                (iso_code or '').lower() in self.exclude_countries or
+                (country or '').lower() in self.exclude_countries):
+            return self._drop('country')
+        return True
+
+    def report(self) -> None:
+        """Prints the number of dropped domains per reason."""
+
+        if self.dropped:
+            reasons = ', '.join(
+                f'{reason}: {count}' for reason, count in self.dropped.items())
+            print(f'\n| Filtered out {sum(self.dropped.values())} domains '
+                  f'({reasons})', end='')
+
+
+def with_check(
+        handler: Callable[[ScanResult, float | None], Awaitable],
+        check: Callable[[ScanResult], bool]) -> Callable[
+        [ScanResult, float | None], Awaitable]:
+    """
+    Wraps a stage handler so it drops the records that fail a check.
+
+    Args:
+        handler (Callable): The stage handler, see pipeline.Stage.
+        check (Callable[[ScanResult], bool]): Receives a processed record,
+            the record is dropped if it returns False.
+
+    Returns:
+        Callable: The wrapped handler.
+    """
+
+    async def checked(
+            record: ScanResult,
+            timeout: float | None) -> ScanResult | None:
+        record = await handler(record, timeout)
+        if record is None or check(record):
+            return record
+        return None
+
+    return checked
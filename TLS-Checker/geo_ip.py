@@ -1,6 +1,183 @@
 import os
-import geoip2.database
-from geoip2 import errors
+import threading
+import ipaddress
+from collections import OrderedDict
+
+
+class GeoLookup:
+    """
+    Long-lived geo lookup service over the MaxMind GeoIP databases.
+
+    Both readers (GeoLite2-ASN.mmdb and GeoLite2-City.mmdb) are opened once
+    and memory-mapped, so a scan does not re-open and re-parse the databases
+    for every domain. Results are kept in a bounded LRU cache keyed by the
+    network prefix that the databases return with each record. Every address
+    of the same network shares one entry, which suits lists that resolve to
+    the same few CDN networks over and over.
+
+    The service is thread-safe and can be shared by worker threads.
+
+    Args:
+        directory (str | None): Directory of the .mmdb files, the current
+            working directory by default.
+        cache_size (int): Maximum number of cached networks.
+    """
+
+    def __init__(
+            self,
+            directory: str | None = None,
+            cache_size: int = 65_536) -> None:
+        # geoip2 is imported by the first lookup service, so runs that don't
+        # scan (e.g. --merge or the parent of the shard processes) skip it
+        from geoip2.errors import AddressNotFoundError
+
+        directory = directory or os.getcwd()
+        self._not_found = AddressNotFoundError
+        self._asn_reader = self._open(
+            os.path.join(directory, 'GeoLite2-ASN.mmdb'))
+        self._city_reader = self._open(
+            os.path.join(directory, 'GeoLite2-City.mmdb'))
+        self.cache_size = cache_size
+        self.hits: int = 0
+        self.misses: int = 0
+        # (ip version, prefix length, network as int) -> geo information
+        self._cache: OrderedDict[
+            tuple[int, int, int], list[str | int | None]] = OrderedDict()
+        # ip version -> prefix lengths present in the cache, longest first
+        self._prefix_lens: dict[int, list[int]] = {4: [], 6: []}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _open(db_path: str) -> 'geoip2.database.Reader':
+        """
+        Opens one database memory-mapped, by the C extension of maxminddb if
+        it is installed.
+        """
+
+        import geoip2.database
+
+        try:
+            return geoip2.database.Reader(
+                db_path, mode=geoip2.database.MODE_MMAP_EXT)
+        except ValueError:
+            return geoip2.database.Reader(
+                db_path, mode=geoip2.database.MODE_MMAP)
+
+    def lookup(self, ip: str) -> list:
+        """
+        Retrieves the geographic information of an IP address.
+
+        Args:
+            ip (str): The IP address for which geographic information is to be
+            retrieved.
+
+        Returns:
+            list: ASN, ASN organization, ISO code and name of the registered
+            country. Values that are not found are None.
+        """
+
+        address = ipaddress.ip_address(ip)
+        version = address.version
+        bits = address.max_prefixlen
+        value = int(address)
+
+        with self._lock:
+            for prefix_len in self._prefix_lens[version]:
+                key = (version, prefix_len, value >> (bits - prefix_len))
+                geo_info = self._cache.get(key)
+                if geo_info is not None:
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    return geo_info
+            self.misses += 1
+
+        geo_info, prefix_len = self._query(ip, bits)
+
+        key = (version, prefix_len, value >> (bits - prefix_len))
+        with self._lock:
+            self._cache[key] = geo_info
+            if prefix_len not in self._prefix_lens[version]:
+                self._prefix_lens[version].append(prefix_len)
+                self._prefix_lens[version].sort(reverse=True)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return geo_info
+
+    def _query(self, ip: str, bits: int) -> tuple[list, int]:
+        """
+        Queries both databases.
+
+        Returns:
+            tuple[list, int]: The geographic information and the prefix length
+            of the smallest network the information is valid for.
+        """
+
+        geo_info: list[str | int | None] = list()
+        prefix_len: int = 0
+
+        try:
+            response_asn = self._asn_reader.asn(ip)
+        except self._not_found as e:
+            geo_info.extend([None, None])
+            prefix_len = max(prefix_len, e.network.prefixlen
+                             if e.network is not None else bits)
+        else:
+            geo_info.append(response_asn.autonomous_system_number)
+            geo_info.append(response_asn.autonomous_system_organization)
+            prefix_len = max(prefix_len, response_asn.network.prefixlen)
+
+        try:
+            response_city = self._city_reader.city(ip)
+        except self._not_found as e:
+            geo_info.extend([None, None])
+            prefix_len = max(prefix_len, e.network.prefixlen
+                             if e.network is not None else bits)
+        else:
+            geo_info.append(response_city.registered_country.iso_code)
+            geo_info.append(
+                response_city.registered_country.names.get('en'))
+            prefix_len = max(prefix_len,
+                             response_city.traits.network.prefixlen)
+
+        return geo_info, prefix_len
+
+    def close(self) -> None:
+        """
+        Closes both databases.
+        """
+
+        self._asn_reader.close()
+        self._city_reader.close()
+
+
+_geo_lookup: GeoLookup | None = None
+_geo_lookup_lock = threading.Lock()
+
+
+def get_geo_lookup() -> GeoLookup:
+    """
+    Returns the GeoLookup shared by the whole run, it is opened on first use.
+    """
+
+    global _geo_lookup
+    with _geo_lookup_lock:
+        if _geo_lookup is None:
+            _geo_lookup = GeoLookup()
+        return _geo_lookup
+
+
+def close_geo_lookup() -> None:
+    """
+    Closes the shared GeoLookup, the next call of get_geo_lookup() opens the
+    databases again (e.g. after they were updated).
+    """
+
+    global _geo_lookup
+    with _geo_lookup_lock:
+        if _geo_lookup is not None:
+            _geo_lookup.close()
+            _geo_lookup = None
 
 
 def geo_information(ip: str) -> list:
@@ -17,7 +194,7 @@ def geo_information(ip: str) -> list:
 
     Notes:
         The function uses MaxMind GeoIP databases (GeoLite2-ASN.mmdb and
-        GeoLite2-City.mmdb)
+        GeoLite2-City.mmdb) through the shared GeoLookup service
         to retrieve the following information:
         - Autonomous System Number (ASN) and ASN organization for the IP address.
         - ISO code and country name for the registered country associated
@@ -27,23 +204,4 @@ def geo_information(ip: str) -> list:
         None values are appended to the list.
     """
 
-    geo_info: list[str | int | None] = list()
-    path = os.getcwd()
-    with geoip2.database.Reader(f'{path}/GeoLite2-ASN.mmdb') as reader:
-        try:
-            response_asn = reader.asn(ip)
-        except geoip2.errors.AddressNotFoundError:
-            geo_info.extend([None, None])
-        else:
-            geo_info.append(response_asn.autonomous_system_number)
-            geo_info.append(response_asn.autonomous_system_organization)
-    with geoip2.database.Reader(f'{path}/GeoLite2-City.mmdb') as reader:
-        try:
-            response_city = reader.city(ip)
-        except geoip2.errors.AddressNotFoundError:
-            geo_info.extend([None, None])
-        else:
-            geo_info.append(response_city.registered_country.iso_code)
-            geo_info.append(response_city.registered_country.names['en'])
-        finally:
-            return geo_info
+    return get_geo_lookup().lookup(ip)
@@ -0,0 +1,218 @@
+import os
+import time
+import socket
+import struct
+import asyncio
+import ipaddress
+
+
+"""
+ICMP echo engine driven by the asyncio event loop. One socket per address
+family is shared by every ping of a scan, echo replies are matched to the
+waiting futures by their sequence number, so any number of targets can be in
+flight at the same time without a thread per ping.
+
+An unprivileged datagram ICMP socket is preferred, a raw socket is used when
+the datagram socket is not permitted (see net.ipv4.ping_group_range). If none
+of them can be opened the pinger reports it as unavailable and the caller
+falls back to another ping method.
+"""
+
+
+ICMP_ECHO_REQUEST: int = 8
+ICMP_ECHO_REPLY: int = 0
+ICMPV6_ECHO_REQUEST: int = 128
+ICMPV6_ECHO_REPLY: int = 129
+
+PAYLOAD: bytes = b'TLS-Checker'.ljust(32, b'\x00')
+
+
+def checksum(data: bytes) -> int:
+    """
+    Calculates the internet checksum (RFC 1071) of the given data.
+
+    Args:
+        data (bytes): The ICMP header and payload with a zero checksum.
+
+    Returns:
+        int: The 16 bit one's complement checksum.
+    """
+
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+class IcmpPinger:
+    """
+    Sends ICMP echo requests over shared sockets and matches the replies to
+    pending futures.
+
+    Sockets are opened lazily on the first ping of each address family and
+    registered as readers of the running event loop. close() must be called
+    from the same loop when the scan is finished.
+    """
+
+    def __init__(self) -> None:
+        self._ident: int = os.getpid() & 0xFFFF
+        self._sequence: int = 0
+        # family -> (socket, is_raw) or None if the family is not permitted
+        self._sockets: dict[int, tuple[socket.socket, bool] | None] = dict()
+        # (family, sequence) -> (future, address, sent_at)
+        self._pending: dict[
+            tuple[int, int], tuple[asyncio.Future, str, float]] = dict()
+
+    def _open(self, family: int) -> tuple[socket.socket, bool] | None:
+        """
+        Opens the shared socket of an address family.
+
+        Args:
+            family (int): socket.AF_INET or socket.AF_INET6.
+
+        Returns:
+            tuple[socket.socket, bool] | None: The socket and whether it is a
+            raw socket, or None if ICMP sockets are not permitted.
+        """
+
+        if family in self._sockets:
+            return self._sockets[family]
+
+        proto = (socket.IPPROTO_ICMP if family == socket.AF_INET
+                 else socket.IPPROTO_ICMPV6)
+        opened = None
+        for kind in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+            try:
+                sock = socket.socket(family, kind, proto)
+            except OSError:
+                continue
+            sock.setblocking(False)
+            loop = asyncio.get_running_loop()
+            loop.add_reader(sock.fileno(), self._on_readable, family, sock,
+                            kind == socket.SOCK_RAW)
+            opened = (sock, kind == socket.SOCK_RAW)
+            break
+
+        self._sockets[family] = opened
+        return opened
+
+    def available(self, family: int = socket.AF_INET) -> bool:
+        """
+        Checks whether ICMP echo requests can be sent for an address family.
+
+        Args:
+            family (int): socket.AF_INET or socket.AF_INET6.
+
+        Returns:
+            bool: True if a datagram or raw ICMP socket could be opened.
+        """
+
+        return self._open(family) is not None
+
+    def _next_sequence(self, family: int) -> int:
+        """Returns a sequence number that is not used by a pending ping."""
+
+        for _ in range(0x10000):
+            self._sequence = (self._sequence + 1) & 0xFFFF
+            if (family, self._sequence) not in self._pending:
+                return self._sequence
+        raise RuntimeError('too many pings in flight')
+
+    def _on_readable(
+            self, family: int, sock: socket.socket, is_raw: bool) -> None:
+        """
+        Reads all queued replies from a socket and resolves their futures.
+        """
+
+        received_at = time.perf_counter()
+        while True:
+            try:
+                data, addr = sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+
+            if family == socket.AF_INET:
+                # Raw IPv4 sockets deliver the IP header as well
+                if is_raw:
+                    data = data[(data[0] & 0x0F) * 4:]
+                reply_type = ICMP_ECHO_REPLY
+            else:
+                reply_type = ICMPV6_ECHO_REPLY
+
+            if len(data) < 8:
+                continue
+            icmp_type, _, _, ident, sequence = struct.unpack(
+                '!BBHHH', data[:8])
+            # Datagram sockets rewrite the identifier to their own port and
+            # only receive their own replies, raw sockets see every reply
+            if icmp_type != reply_type or (is_raw and ident != self._ident):
+                continue
+
+            pending = self._pending.get((family, sequence))
+            if pending is None:
+                continue
+            future, address, sent_at = pending
+            if ipaddress.ip_address(addr[0]) != ipaddress.ip_address(address):
+                continue
+            if not future.done():
+                future.set_result((received_at - sent_at) * 1000)
+
+    async def ping(self, address: str, timeout: float) -> float | None:
+        """
+        Sends one echo request to an IP address and waits for its reply.
+
+        Args:
+            address (str): The IPv4 or IPv6 address to ping.
+            timeout (float): The timeout of the reply in seconds.
+
+        Returns:
+            float | None: The round trip time in milliseconds, or None if there
+            was no reply within the timeout or the request could not be sent.
+        """
+
+        family = (socket.AF_INET6 if ':' in address else socket.AF_INET)
+        opened = self._open(family)
+        if opened is None:
+            return None
+        sock, _ = opened
+
+        sequence = self._next_sequence(family)
+        request_type = (ICMP_ECHO_REQUEST if family == socket.AF_INET
+                        else ICMPV6_ECHO_REQUEST)
+        header = struct.pack(
+            '!BBHHH', request_type, 0, 0, self._ident, sequence)
+        # The kernel fills in the checksum of ICMPv6 itself
+        if family == socket.AF_INET:
+            header = struct.pack(
+                '!BBHHH', request_type, 0, checksum(header + PAYLOAD),
+                self._ident, sequence)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending[(family, sequence)] = (
+            future, address, time.perf_counter())
+        try:
+            sock.sendto(header + PAYLOAD, (address, 0))
+            return await asyncio.wait_for(future, timeout=timeout)
+        except (OSError, asyncio.TimeoutError):
+            return None
+        finally:
+            del self._pending[(family, sequence)]
+
+    def close(self) -> None:
+        """
+        Unregisters and closes the shared sockets.
+        """
+
+        loop = asyncio.get_running_loop()
+        for opened in self._sockets.values():
+            if opened is None:
+                continue
+            sock, _ = opened
+            loop.remove_reader(sock.fileno())
+            sock.close()
+        self._sockets.clear()
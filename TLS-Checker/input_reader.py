@@ -0,0 +1,335 @@
+import io
+import re
+import os
+import csv
+import sys
+import gzip
+import math
+import random
+import hashlib
+from sys import exit
+from itertools import islice
+from typing import Iterable, Iterator, TextIO
+
+from metrics import Metrics
+
+
+"""
+Streaming input layer. Domains are read lazily from plain, gzip or zstd
+compressed csv files or from stdin, normalised and deduplicated on the fly,
+so a huge domain list never has to fit in memory.
+"""
+
+
+# A hostname of letters, digits, '-' and '_' labels with at least one dot.
+# The last label is not all-numeric, so IPv4 literals are not domains.
+_HOSTNAME = re.compile(
+    r'^(?=.{1,253}$)'
+    r'(?:[a-z0-9_](?:[a-z0-9_-]{0,61}[a-z0-9_])?\.)+'
+    r'(?![0-9]+$)(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?)$')
+
+
+def open_input(input_path: str) -> TextIO:
+    """
+    Opens the domain list for reading as text.
+
+    Args:
+        input_path (str): Path of a plain, .gz or .zst/.zstd file, or '-' to
+            read from stdin.
+
+    Returns:
+        TextIO: The opened text stream.
+
+    Raises:
+        SystemExit: If the file doesn't exist or zstd support is missing.
+    """
+
+    if input_path == '-':
+        return sys.stdin
+
+    if not os.path.isfile(input_path):
+        print(f'| There is no such input file: {input_path}')
+        exit(1)
+
+    if input_path.endswith('.gz'):
+        return gzip.open(input_path, mode='rt', newline='')
+
+    if input_path.endswith(('.zst', '.zstd')):
+        try:
+            import zstandard
+        except ImportError:
+            print('| Reading .zst files needs the "zstandard" module:'
+                  ' pip install zstandard')
+            exit(1)
+        stream = zstandard.ZstdDecompressor().stream_reader(
+            open(input_path, mode='rb'), closefd=True)
+        return io.TextIOWrapper(stream, newline='')
+
+    return open(input_path, newline='')
+
+
+def count_lines(input_path: str) -> int | None:
+    """
+    Counts the lines of a plain input file without decoding it.
+
+    Args:
+        input_path (str): Path of the input file.
+
+    Returns:
+        int | None: The number of lines, or None for stdin and compressed
+        files whose length is not known without decompressing them.
+    """
+
+    if input_path == '-' or input_path.endswith(('.gz', '.zst', '.zstd')):
+        return None
+    if not os.path.isfile(input_path):
+        return None
+
+    lines = 0
+    last = b'\n'
+    with open(input_path, mode='rb') as file:
+        while chunk := file.read(1 << 20):
+            lines += chunk.count(b'\n')
+            last = chunk[-1:]
+    # The last line doesn't need a line break
+    return lines + (last != b'\n')
+
+
+def normalize(name: str) -> str | None:
+    """
+    Normalises one domain name: strips it, lowercases it, removes the trailing
+    dot and converts internationalized names to their IDNA (punycode) form.
+
+    Args:
+        name (str): The raw value of the first csv column.
+
+    Returns:
+        str | None: The normalised name, or None if it is not a valid
+        hostname (e.g. a header row or an empty line).
+    """
+
+    name = name.strip().lower().rstrip('.')
+    if not name.isascii():
+        try:
+            name = name.encode('idna').decode('ascii')
+        except UnicodeError:
+            return None
+
+    if _HOSTNAME.match(name) is None:
+        return None
+    return name
+
+
+def item_hashes(item: str) -> tuple[int, int]:
+    """
+    Returns:
+        tuple[int, int]: The two halves of one 128 bit digest of the item,
+        the base and the (odd) step of the double hashing probes.
+    """
+
+    digest = int.from_bytes(
+        hashlib.blake2b(item.encode(), digest_size=16).digest(), 'little')
+    return digest & 0xFFFF_FFFF_FFFF_FFFF, (digest >> 64) | 1
+
+
+class BloomFilter:
+    """
+    Memory-bounded set of strings with a tunable false positive rate. A false
+    positive reports an item that wasn't added, with probability about
+    error_rate as long as the number of items stays below capacity; past it
+    the rate rises quickly, see ScalableBloomFilter.
+
+    Args:
+        capacity (int): Expected number of distinct items.
+        error_rate (float): Target false positive probability.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 1e-4) -> None:
+        self.capacity: int = max(1, capacity)
+        self.count: int = 0
+        self.size: int = max(8, int(
+            -self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes: int = max(
+            1, round(self.size / self.capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def add(self, item: str) -> bool:
+        """
+        Adds an item to the filter.
+
+        Args:
+            item (str): The item to add.
+
+        Returns:
+            bool: True if the item was (probably) not in the filter yet.
+        """
+
+        return self.add_hashes(*item_hashes(item))
+
+    def add_hashes(self, h1: int, h2: int) -> bool:
+        """Same as add() for the item_hashes() of an item."""
+
+        new = False
+        size = self.size
+        bits = self._bits
+        for position in range(h1, h1 + self.hashes * h2, h2):
+            position %= size
+            mask = 1 << (position & 7)
+            byte = bits[position >> 3]
+            if not byte & mask:
+                bits[position >> 3] = byte | mask
+                new = True
+        self.count += new
+        return new
+
+    def has_hashes(self, h1: int, h2: int) -> bool:
+        """Whether the item of the item_hashes() is (probably) added."""
+
+        size = self.size
+        bits = self._bits
+        for position in range(h1, h1 + self.hashes * h2, h2):
+            position %= size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class ScalableBloomFilter:
+    """
+    Bloom filter that grows with the number of items, for streams of unknown
+    length (compressed files and stdin). When the newest slice is full a new
+    slice with growth times its capacity and a tightening times smaller
+    error rate is added, so the overall false positive rate stays below
+    error_rate however many items are added (Almeida et al., Scalable Bloom
+    Filters).
+
+    Args:
+        capacity (int): Capacity of the first slice.
+        error_rate (float): Bound of the false positive probability.
+        growth (int): Capacity factor of every new slice.
+        tightening (float): Error rate factor of every new slice.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 1e-4,
+                 growth: int = 2, tightening: float = 0.5) -> None:
+        self.growth = growth
+        self.tightening = tightening
+        # The error rates of the slices are a geometric series below
+        # error_rate
+        self.slices: list[BloomFilter] = [
+            BloomFilter(capacity, error_rate * (1 - tightening))]
+        self._error_rate = error_rate * (1 - tightening)
+
+    @property
+    def count(self) -> int:
+        return sum(bloom.count for bloom in self.slices)
+
+    def add(self, item: str) -> bool:
+        """
+        Adds an item to the filter.
+
+        Args:
+            item (str): The item to add.
+
+        Returns:
+            bool: True if the item was (probably) not in the filter yet.
+        """
+
+        h1, h2 = item_hashes(item)
+        last = self.slices[-1]
+        for bloom in self.slices[:-1]:
+            if bloom.has_hashes(h1, h2):
+                return False
+        if not last.add_hashes(h1, h2):
+            return False
+
+        if last.count >= last.capacity:
+            self._error_rate *= self.tightening
+            self.slices.append(BloomFilter(
+                last.capacity * self.growth, self._error_rate))
+        return True
+
+
+def read_domains(
+        input_path: str,
+        capacity: int | None = None,
+        metrics: Metrics | None = None) -> Iterator[str]:
+    """
+    Streams the normalised, unique domains of the first csv column.
+
+    Args:
+        input_path (str): Path of the input file, or '-' for stdin.
+        capacity (int | None): Expected number of domains, it sizes the
+            first slice of the Bloom filter used for deduplication.
+        metrics (Metrics | None): Counts the dropped names as 'input'
+            outcomes, 'invalid' and 'duplicate' (see report_dropped).
+
+    Yields:
+        str: Every valid domain once, in input order.
+    """
+
+    # The filter grows if the capacity is exceeded or unknown
+    seen = ScalableBloomFilter(capacity or 1_000_000)
+    with open_input(input_path) as csv_file:
+        for row in csv.reader(csv_file):
+            if not row:
+                continue
+            domain_name = normalize(row[0])
+            if domain_name is None:
+                if metrics is not None:
+                    metrics.count('input', 'invalid')
+            elif seen.add(domain_name):
+                yield domain_name
+            elif metrics is not None:
+                metrics.count('input', 'duplicate')
+
+
+def report_dropped(metrics: Metrics) -> None:
+    """
+    Prints the number of input names dropped by read_domains() and of the
+    fresh domains skipped in resume mode (save_to_database.skip_fresh). A
+    false positive of the Bloom filter (about 1 in 10,000 new names) is
+    counted as a duplicate.
+    """
+
+    invalid = metrics.outcomes[('input', 'invalid')]
+    duplicates = metrics.outcomes[('input', 'duplicate')]
+    fresh = metrics.outcomes[('input', 'fresh')]
+    if invalid or duplicates:
+        print(f'\n| Dropped {duplicates} duplicate and {invalid} invalid '
+              f'names of the input', end='')
+    if fresh:
+        print(f'\n| Skipped {fresh} domains that are still fresh in '
+              f'output.db', end='')
+
+
+def reservoir_sample(
+        items: Iterable[str],
+        k: int,
+        rng: random.Random | None = None) -> list[str]:
+    """
+    Selects k items uniformly at random from a stream of unknown length in
+    one pass, keeping only k items in memory (Algorithm R).
+
+    Args:
+        items (Iterable[str]): The stream to sample from.
+        k (int): The sample size.
+        rng (random.Random | None): Source of randomness.
+
+    Returns:
+        list[str]: The sample in random order.
+    """
+
+    rng = rng or random.Random()
+    iterator = iter(items)
+    sample: list[str] = list(islice(iterator, k))
+    if k <= 0:
+        return sample
+
+    for seen, item in enumerate(iterator, start=k + 1):
+        position = rng.randrange(seen)
+        if position < k:
+            sample[position] = item
+
+    rng.shuffle(sample)
+    return sample
@@ -1,6 +1,7 @@
 """
 This Python script is designed to gather information about a list of domains
-provided in a CSV file named input.csv The script collects various details
+provided in a CSV file named input.csv (optionally gzip or zstd compressed as
+input.csv.gz or input.csv.zst). The script collects various details
 about each domain, including:
 
 - IPv4 and IPv6 addresses
@@ -11,12 +12,15 @@ about each domain, including:
 - Cipher
 - SSL/TLS version
 - Issuer organization
-- Ping response time from the domain's server
+- Ping response time from the domain's server (optional)
+- TCP connect and TLS handshake durations
 
 The domains are expected to be listed in a single column within the CSV file
-(e.g., "google.com", "yahoo.com", etc.). Please note that the script's ability
-to retrieve certain information, such as ping response time, may depend on the
-quality and speed of your internet connection and your system resources.
+(e.g., "google.com", "yahoo.com", etc.). The list is streamed, names are
+normalised and duplicates are dropped while it is read. Please note that the
+script's ability to retrieve certain information, such as ping response time,
+may depend on the quality and speed of your internet connection and your
+system resources.
 
 This script utilizes asynchronous and concurrency methods to speed up the
 scanning process. Additionally, instead of using an API, it leverages the
@@ -24,390 +28,853 @@ MaxMind GeoIP database for geo information.
 """
 
 import os
-import csv
-import ssl
+import sys
+import time
 import signal
 import socket
 import asyncio
-from random import shuffle
+import inspect
+import argparse
+from functools import partial
+from contextlib import nullcontext
+from itertools import chain, islice
+from typing import Any, Callable, Coroutine, Iterator
 from concurrent.futures import ThreadPoolExecutor
 
-import aiodns
-from ping3 import ping
-
-import update_geoip_db
-from options import get_options
-from save_to_database import save
-from geo_ip import geo_information
+from options import (
+    DEFAULT_OPTIONS, add_option_arguments, get_options, headless_options)
+from input_reader import (
+    count_lines, read_domains, report_dropped, reservoir_sample)
+from icmp_ping import IcmpPinger
+from record import ScanResult
+from pipeline import Pipeline, Stage
+from filters import Filters, with_check
+from adaptive import AdaptiveLimiter
+from metrics import Metrics, error_class, serve_metrics, write_stats
+from profiling import LoopMonitor, profiled
+from tls_probe import tls_info, create_context
+from shard import filter_shard, parse_shard, run_local_shards, shard_share
+from save_to_database import (
+    INSERTS, DatabaseWriter, init_database, ip_version, skip_fresh,
+    merge_databases)
+from geo_ip import geo_information, get_geo_lookup, close_geo_lookup
 from ascii_welcome import print_acii
 from csv_convertor import database_convert
 
 
 this_path: str = os.getcwd()
-
-# The task inside this value doesn't stop for a gracefully stopping
-# in this case we add main coroutine in  _DO_NOT_CANCEL_TASKS
-
-_DO_NOT_CANCEL_TASKS: set[asyncio.Task] = set()
+# Exit status of a stopped scan (128 + SIGINT, as a shell reports ctrl+c)
+STOPPED_EXIT_CODE: int = 130
 
 
-def get_ping(domain_name: str, timeout: int) -> str:
+def blocking_ping(address: str, timeout: int) -> float | None:
     """
-    Send one ping to destination address(domain_name) with the given timeout.
+    Send one ping to destination address with the given timeout by ping3.
+    This is the fallback when ICMP sockets are not permitted.
     """
 
+    from ping3 import ping
+
     try:
-        delay = ping(domain_name, unit='ms', timeout=timeout)
+        return ping(address, unit='ms', timeout=timeout) or None
     except:
-        delay = None
+        return None
+
+
+async def get_ping(
+        pinger: IcmpPinger,
+        executor,
+        address: str,
+        timeout: int) -> float | None:
+    """
+    Send one ping to destination address with the given timeout. The shared
+    ICMP sockets of the pinger are used, if they can not be opened the ping
+    is sent by ping3 in the executor.
+
+    Args:
+        pinger (IcmpPinger): The ICMP echo engine shared by the scan.
+        executor (concurrent.futures.Executor): Executor for the ping3
+            fallback.
+        address (str): The IP address to ping.
+        timeout (int): Timeout of the ping in seconds.
+
+    Returns:
+        float | None: The round trip time in whole milliseconds or None.
+    """
+
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    if pinger.available(family):
+        delay = await pinger.ping(address, timeout)
     else:
-        if delay is not None:
-            delay = f'{delay:4.0f}'
+        loop = asyncio.get_running_loop()
+        delay = await loop.run_in_executor(
+            executor, blocking_ping, address, timeout)
+
+    if delay is not None:
+        delay = float(round(delay))
 
     return delay
 
-def tls_info(hostname: str, timeout: int) -> dict:
+
+async def resolve(
+        resolver,
+        domain_name: str,
+        query_type: str,
+        dns_timeout: int,
+        limiter: AdaptiveLimiter | None = None,
+        metrics: Metrics | None = None) -> list[str] | None:
     """
-    Creates an SSLContext object with default settings, establishes a socket
-    connection to the specified hostname over port 443 with the given timeout,
-    and retrieves the TLS version, cryptographic details,
-    and issuer of its certificate.
+    Queries one record type of a domain and returns the resolved addresses.
+    Answers from the cache are not recorded by the limiter, their latency
+    says nothing about the network.
 
     Args:
-        hostname (str): The domain name to connect to.
-        timeout (int): The timeout duration for the socket connection.
+        resolver (CachingResolver): DNS resolver for querying the domain.
+        domain_name (str): The domain name to resolve.
+        query_type (str): 'A' for IPv4 or 'AAAA' for IPv6 addresses.
+        dns_timeout (int): Timeout for the DNS query.
+        limiter (AdaptiveLimiter | None): Receives the outcome and latency
+            of the query in adaptive mode.
+        metrics (Metrics | None): Receives the outcome (e.g. 'nxdomain')
+            and latency of the query.
 
     Returns:
-        dict: A dictionary containing the TLS version, cipher used, and issuer
-              organization of the certificate.
+        list[str] | None: The resolved addresses, or None if there is no
+        answer.
     """
 
+    addresses: list[str] = list()
+    started = time.perf_counter()
+    network = False
     try:
-        context = ssl.create_default_context()
+        resp = resolver.cached(domain_name, query_type)
+        if resp is None:
+            network = True
+            resp = await asyncio.wait_for(
+                resolver.query(domain_name, query_type), timeout=dns_timeout)
+    except asyncio.TimeoutError:
+        if limiter is not None:
+            limiter.record(timed_out=True)
+        if metrics is not None:
+            metrics.count('dns', 'timeout')
+        return None
+    except Exception as e:
+        # An answer like NXDOMAIN is a healthy outcome for the limiter
+        if limiter is not None and network:
+            limiter.record(timed_out=False)
+        if metrics is not None:
+            metrics.count('dns', error_class(e))
+        return None
+
+    latency_ms = (time.perf_counter() - started) * 1000
+    if network and limiter is not None:
+        limiter.record(timed_out=False, latency_ms=latency_ms)
+    if metrics is not None:
+        metrics.count('dns', 'ok')
+        if network:
+            metrics.observe('dns', latency_ms)
+
+    for ip in resp:
+        if ip:
+            addresses.append(ip.host)
+    # An empty answer is stored as None like a failed query
+    return addresses or None
+
+
+async def resolve_stage(
+        record: ScanResult,
+        timeout: int,
+        resolver,
+        limiter: AdaptiveLimiter | None = None,
+        metrics: Metrics | None = None) -> ScanResult | None:
+    """
+    Resolve stage, queries the A and AAAA records of a domain in parallel.
+    Domains without any address are dropped, so they are not probed and not
+    saved.
 
-        with socket.create_connection((hostname, 443), timeout=timeout) as sock:
-            with context.wrap_socket(sock, server_hostname=hostname) as ssock:
-                version = ssock.version()
-                cipher = ssock.cipher()[0]
-                issuer = ssock.getpeercert()['issuer'][1][0][1]
-    except:
-        version = None
-        cipher = None
-        issuer = None
+    Args:
+        record (ScanResult): The result record of the domain.
+        timeout (int): Timeout for DNS queries.
+        resolver (CachingResolver): DNS resolver for querying domain
+            information.
+        limiter (AdaptiveLimiter | None): Limits the domains being resolved
+            at the same time in adaptive mode.
+        metrics (Metrics | None): Receives the outcomes of the queries.
+
+    Returns:
+        ScanResult | None: The record with ipv4 and ipv6 set, or None.
+    """
 
-    return {'version': version, 'cipher': cipher, 'issuer': issuer}
+    domain_name = record.domain_name
+    async with limiter or nullcontext():
+        record.ipv4, record.ipv6 = await asyncio.gather(
+            resolve(resolver, domain_name, 'A', timeout, limiter, metrics),
+            resolve(resolver, domain_name, 'AAAA', timeout, limiter,
+                    metrics))
 
+    if not record.ipv4 and not record.ipv6:
+        return None
+    return record
 
-async def get_info(
-        semaphore,
-        resolver,
-        domain_name,
-        executor,
-        dns_timeout,
-        tls_timeout,
-        ping_timeout) -> dict:
+
+async def enrich_stage(
+        record: ScanResult,
+        timeout: float | None,
+        geo_executor,
+        metrics: Metrics | None = None) -> ScanResult:
     """
-    Retrieves various information about a domain, including IPv4, IPv6, ASN,
-    ASN Organization, country ISO code, and country name from DNS. It also runs
-    tls_info() in another thread using an event loop and executor. The function
-    restricts active tasks in the event loop to the semaphore count.
+    Enrich stage, looks up the geo information of every resolved address in
+    the geo worker pool, so the lookups never block the event loop. A failed
+    lookup keeps the record with empty geo fields.
 
     Args:
-        semaphore (asyncio.Semaphore): Semaphore to limit concurrent tasks.
-        resolver (aiodns.DNSResolver): DNS resolver for querying domain information.
-        domain_name (str): The domain name to retrieve information for.
-        executor (concurrent.futures.Executor): Executor for running blocking
-            operations in separate threads.
-        dns_timeout (int): Timeout for DNS queries.
-        tls_timeout (int): Timeout for TLS information retrieval.
-        ping_timeout (int): Timeout for ping operations.
+        record (ScanResult): The result record of the domain.
+        timeout (float | None): Timeout of the lookups.
+        geo_executor (concurrent.futures.Executor): Worker pool for the geo
+            lookups.
+        metrics (Metrics | None): Receives the outcome of the lookups.
 
     Returns:
-        dict: A dictionary containing the retrieved information for the domain,
-        including:
-            - 'ipv4': List of IPv4 addresses or None
-            - 'ipv6': List of IPv6 addresses or None
-            - 'tls_version': TLS version used by the domain
-            - 'cipher': Cipher used by the domain
-            - 'issuer_organ': Issuer organization of the domain's certificate
-            - 'ping': Ping response time from the domain's server
-    """
-
-    ipv4: list[str | None] = list()
-    ipv6: list[str | None] = list()
-    info: dict[str, str | None | list[str]] = dict()
-    result: dict[str, dict[str, str | None | list[str]]] = dict()
-
-    async with semaphore:
-        loop = asyncio.get_running_loop()
-        tls_info_list = await loop.run_in_executor(
-            executor,
-            tls_info,
-            domain_name,
-            tls_timeout)
+        ScanResult: The record with geo set.
+    """
 
-        info['ping'] = await loop.run_in_executor(
-            executor,
-            get_ping,
-            domain_name,
-            ping_timeout)
+    addresses = record.addresses()
+    loop = asyncio.get_running_loop()
+    try:
+        record.geo = await asyncio.wait_for(
+            loop.run_in_executor(geo_executor, geo_addresses, addresses),
+            timeout=timeout)
+    except Exception as e:
+        # The TLS result of the domain is still saved without its geo data
+        record.geo = [[None] * 4 for _ in addresses]
+        if metrics is not None:
+            metrics.count('geo', error_class(e))
+        return record
+
+    if metrics is not None:
+        metrics.count('geo', 'ok')
+    return record
+
+
+async def tls_stage(
+        record: ScanResult,
+        timeout: int,
+        context,
+        limiter: AdaptiveLimiter | None = None,
+        port: int = 443,
+        metrics: Metrics | None = None) -> ScanResult:
+    """
+    TLS stage, probes the first resolved address (the first IPv4 if there is
+    one) with SNI set to the domain name.
 
-        info['tls_version'] = tls_info_list['version']
-        info['cipher'] = tls_info_list['cipher']
-        info['issuer_organ'] = tls_info_list['issuer']
+    Args:
+        record (ScanResult): The result record of the domain.
+        timeout (int): Timeout for TLS information retrieval.
+        context (ssl.SSLContext): SSLContext shared by all TLS probes.
+        limiter (AdaptiveLimiter | None): Limits the handshakes in flight in
+            adaptive mode, it learns from their timeouts and durations.
+        port (int): The TCP port of the probe.
+        metrics (Metrics | None): Receives the outcome (e.g. 'cert_error')
+            and the timings of the probe.
 
+    Returns:
+        ScanResult: The record with the TLS version, cipher, issuer and
+        timings set.
+    """
 
-        try:
-            resp = await asyncio.wait_for(
-                resolver.query(domain_name, 'A'), timeout=dns_timeout)
-            for ip in resp:
-                if ip:
-                    ipv4.append(ip.host)
-            # This statement checks if ipv4 list is empty
-            if not ipv4:
-                info['ipv4'] = None
-        except:
-            info['ipv4'] = None
-        else:
-            info['ipv4'] = ipv4
+    async with limiter or nullcontext():
+        tls_info_list = await tls_info(
+            record.domain_name, timeout, context, record.probed, port)
+
+    if limiter is not None:
+        latency_ms = None
+        if tls_info_list['tls_handshake_ms'] is not None:
+            latency_ms = (tls_info_list['tcp_connect_ms'] +
+                          tls_info_list['tls_handshake_ms'])
+        limiter.record(tls_info_list['error'] == 'timeout', latency_ms)
+    if metrics is not None:
+        metrics.count('tls_probe', tls_info_list['error'] or 'ok')
+        for timing in ('tcp_connect_ms', 'tls_handshake_ms'):
+            if tls_info_list[timing] is not None:
+                metrics.observe(timing[:-3], tls_info_list[timing])
+
+    record.tls_version = tls_info_list['version']
+    record.cipher = tls_info_list['cipher']
+    record.issuer_organ = tls_info_list['issuer']
+    record.tcp_connect_ms = tls_info_list['tcp_connect_ms']
+    record.tls_handshake_ms = tls_info_list['tls_handshake_ms']
+    record.scanned_at = int(time.time())
+    return record
+
+
+async def latency_stage(
+        record: ScanResult,
+        timeout: int,
+        pinger: IcmpPinger,
+        executor,
+        metrics: Metrics | None = None) -> ScanResult:
+    """
+    Latency stage, pings the probed address. It is optional, the TLS stage
+    already measured the TCP connect and TLS handshake durations.
 
-        try:
-            resp = await asyncio.wait_for(
-                resolver.query(domain_name, 'AAAA'), timeout=dns_timeout)
-            for ip in resp:
-                if ip:
-                    ipv6.append(ip.host)
-            if not ipv6:
-                info['ipv6'] = None
-        except:
-            info['ipv6'] = None
-        else:
-            info['ipv6'] = ipv6
+    Args:
+        record (ScanResult): The result record of the domain.
+        timeout (int): Timeout for ping operations.
+        pinger (IcmpPinger): ICMP echo engine shared by all pings.
+        executor (concurrent.futures.Executor): Executor for the ping3
+            fallback.
+        metrics (Metrics | None): Receives the outcome and round trip time
+            of the ping.
 
-        result[domain_name] = info
+    Returns:
+        ScanResult: The record with ping set.
+    """
 
-        return result
+    record.ping = await get_ping(pinger, executor, record.probed, timeout)
+    if metrics is not None:
+        # A ping without reply can't tell a timeout from a filter
+        metrics.count('ping', 'no_reply' if record.ping is None else 'ok')
+        if record.ping is not None:
+            metrics.observe('ping', record.ping)
+    return record
 
 
-def extract_results(result_list: list) -> list[tuple]:
+def geo_addresses(addresses: list[str]) -> list[list]:
     """
-    Extracts retrieved data from the get_info() function and organizes it into a
-    list of tuples. Each tuple contains the information for a single domain.
+    Looks up the geo information of every address of a domain, runs in the
+    geo worker pool.
 
     Args:
-        result_list (list): a list of dictionaries where each dictionary
-        contains the retrieved information for a domain.
+        addresses (list[str]): The resolved IPv4 and IPv6 addresses.
 
     Returns:
-        query_data: a compatible format of list includes tuples. including:
-        - domain_name (str)
-        - ipv4 (str or None)
-        - ipv6 (str or None)
-        - asn (str or None)
-        - asn_organ (str or None)
-        - iso_code (str or None)
-        - country (str or None)
-        - cipher (str or None)
-        - tls_version (str or None)
-        - issuer_organ (str or None)
-        - domain_ping (str or None)
-    """
-
-    asn = None
-    asn_organ = None
-    iso_code = None
-    country = None
-
-    query_data: list[tuple] = list()
-    '''Extract domain and ipv4, ipv6 and ... saves into query_data list'''
-    for result in result_list:
-        domain_name: str = list(result.keys())[0]
-        ipv4_list: list | None = list(result.values())[0]['ipv4']
-        ipv6_list: list | None = list(result.values())[0]['ipv6']
-        cipher = list(result.values())[0]['cipher']
-        tls_version = list(result.values())[0]['tls_version']
-        issuer_organ = list(result.values())[0]['issuer_organ']
-        domain_ping = list(result.values())[0]['ping']
-
-        if ipv4_list:
-            ipv4 = ','.join(ipv4_list)
-            '''this gets geo info from geo_ip module'''
-            geo_info = geo_information(ipv4_list[0])
-            asn = geo_info[0]
-            asn_organ = geo_info[1]
-            iso_code = geo_info[2]
-            country = geo_info[3]
-        else:
-            ipv4 = None
+        list[list]: Geo information (ASN, ASN organization, ISO code,
+        country) of each address, in the same order.
+    """
 
-        if ipv6_list:
-            ipv6 = ','.join(ipv6_list)
-        else:
-            ipv6 = None
+    return [geo_information(ip) for ip in addresses]
 
-        query_data.append(
-            (domain_name, ipv4, ipv6, asn, asn_organ, iso_code, country,
-             cipher, tls_version, issuer_organ, domain_ping))
 
-    return query_data
+def extract_results(
+        result_list: list[ScanResult]) -> dict[str, list[tuple]]:
+    """
+    Extracts retrieved data from the pipeline and organizes it into rows of
+    the normalized tables (see save_to_database.INSERTS).
+
+    Args:
+        result_list (list[ScanResult]): The result records of a batch.
 
+    Returns:
+        dict[str, list[tuple]]: The rows of each table, including:
+        - domains: (domain_name,)
+        - addresses: (ip, version, asn, asn_organ, iso_code, country) of
+          every resolved address
+        - certificates: (issuer_organ,)
+        - scans: (domain_name, probed ip, issuer_organ, tls_version, cipher,
+          ping_ms, tcp_connect_ms, tls_handshake_ms, scanned_at)
+        - scan_addresses: (index of the scan in scans, ip) of every
+          resolved address
+    """
 
-def create_tasks(domain_list: list) -> list:
+    tables: dict[str, list[tuple]] = {table: list() for table in INSERTS}
+    domains = tables['domains']
+    address_rows = tables['addresses']
+    certificates = tables['certificates']
+    scans = tables['scans']
+    scan_addresses = tables['scan_addresses']
+    for record in result_list:
+        domain_name = record.domain_name
+        addresses = record.addresses()
+
+        domains.append((domain_name,))
+        address_rows.extend(
+            (ip, ip_version(ip), *geo)
+            for ip, geo in zip(addresses, record.geo))
+        if record.issuer_organ is not None:
+            certificates.append((record.issuer_organ,))
+        scan_addresses.extend((len(scans), ip) for ip in addresses)
+        '''The probed address is the first IPv4 if there is one'''
+        scans.append(
+            (domain_name, addresses[0], record.issuer_organ,
+             record.tls_version, record.cipher, record.ping,
+             record.tcp_connect_ms, record.tls_handshake_ms,
+             record.scanned_at))
+
+    return tables
+
+
+def prepare_rows(result_list: list[ScanResult]) -> dict[str, list[tuple]]:
     """
-    Creates a list of tasks for retrieving information about domains.
+    Converts a batch of pipeline results into rows of the database tables,
+    it is called by the DatabaseWriter.
+    """
+
+    return extract_results(result_list)
+
+
+def create_tasks(
+        input_path: str,
+        options: dict,
+        domain_list_length: int | None,
+        shard: tuple[int, int] = (0, 1)) -> tuple[
+        Iterator[ScanResult], int | None, Pipeline, list[Callable]]:
+    """
+    Prepares the scan of the domains: selects the domains of the shard and
+    builds the staged pipeline with the shared resolver, executors,
+    SSLContext and pinger. Every stage gets its own concurrency limit and
+    timeout:
+
+        resolve -> enrich -> tls -> latency (optional)
+
+    With filters (see filters.Filters) every stage drops the domains its
+    result disqualifies. Unless a filter needs the geo information, the tls
+    stage runs first, so geo lookups are skipped for disqualified domains:
+
+        resolve -> tls -> enrich -> latency (optional)
 
     Args:
-        domain_list (list): A list of domain names to retrieve information for.
+        input_path (str): Path of the domain list, see input_reader.
+        options (dict): The options returned by get_options().
+        domain_list_length (int | None): Number of lines of the input file.
+        shard (tuple[int, int]): The shard index and the number of shards,
+            a shard scans its share of domain_chunk_len.
 
     Returns:
-        list: A list of asyncio Tasks for retrieving information about the
-              specified domains.
+        tuple[Iterator[ScanResult], int | None, Pipeline, list[Callable]]:
+        An iterator over the records of the selected domains, their
+        (maximum) number if it is known, the pipeline to run them through
+        (its metrics are in pipeline.metrics), and the cleanup callables to
+        run after the scan (they may return awaitables).
     """
 
-    domain_list_length: int = len(domain_list)
-    options = get_options(domain_list_length)
-    domain_chunk_len = options['domain_chunk_len']
+    from dns_cache import CachingResolver
+
+    domain_chunk_len: int | None = shard_share(
+        options['domain_chunk_len'], shard)
+    metrics = Metrics(
+        labels={'shard': f'{shard[0] + 1}/{shard[1]}'} if shard[1] > 1
+        else None)
+
+    domains: Iterator[str] = read_domains(
+        input_path, domain_list_length, metrics)
+    if shard[1] > 1:
+        domains = filter_shard(domains, shard)
 
+    # Resume mode, domains that are still fresh in output.db are not scanned
+    if options['resume_hours'] > 0:
+        domains = skip_fresh(domains, options['resume_hours'], metrics)
+
+    '''Random search keeps a reservoir of domain_chunk_len domains, normal
+    search streams the first domain_chunk_len domains'''
     if options['random_normal']:
-        shuffle(domain_list)
-        domain_chunk_list = domain_list[0: domain_chunk_len]
+        domains = iter(reservoir_sample(
+            domains,
+            sys.maxsize if domain_chunk_len is None else domain_chunk_len))
+    elif domain_chunk_len is not None:
+        domains = islice(domains, domain_chunk_len)
+
+    loop = asyncio.get_running_loop()
+    cleanups: list[Callable] = [partial(report_dropped, metrics)]
+
+    resolver = CachingResolver(
+        nameservers=options['nameservers'],
+        channels=options['dns_channels'],
+        cache_path=(os.path.join(this_path, 'dns_cache.db')
+                    if options['dns_cache'] else None))
+    # Saving the cache writes to disk, so it runs in the default executor
+    cleanups.append(partial(loop.run_in_executor, None, resolver.save))
+
+    '''In adaptive mode the stages get 'adaptive_max' workers and the
+    limiters decide how many of them are active'''
+    dns_limiter: AdaptiveLimiter | None = None
+    tls_limiter: AdaptiveLimiter | None = None
+    if options['adaptive']:
+        dns_limiter = AdaptiveLimiter(
+            options['dns_tasks'], maximum=options['adaptive_max'])
+        tls_limiter = AdaptiveLimiter(
+            options['tls_tasks'], maximum=options['adaptive_max'])
+        dns_tasks = tls_tasks = options['adaptive_max']
+    else:
+        dns_tasks = options['dns_tasks']
+        tls_tasks = options['tls_tasks']
+    executor = ThreadPoolExecutor(max_workers=options['max_workers'])
+    geo_workers = min(4, os.cpu_count() or 1)
+    geo_executor = ThreadPoolExecutor(
+        max_workers=geo_workers, thread_name_prefix='geo')
+    # Queued calls are cancelled, so a stopped scan doesn't wait for them
+    cleanups.append(
+        partial(executor.shutdown, wait=False, cancel_futures=True))
+    cleanups.append(
+        partial(geo_executor.shutdown, wait=False, cancel_futures=True))
+    metrics.executors = {'ping': executor, 'geo': geo_executor}
+    # Opens the GeoIP databases before the scan, a missing file fails early
+    get_geo_lookup()
+    context = create_context()
+
+    resolve = partial(resolve_stage, resolver=resolver, limiter=dns_limiter,
+                      metrics=metrics)
+    enrich = partial(enrich_stage, geo_executor=geo_executor,
+                     metrics=metrics)
+    probe = partial(tls_stage, context=context, limiter=tls_limiter,
+                    port=options['tls_port'], metrics=metrics)
+
+    filters = Filters.from_options(options)
+    if filters:
+        resolve = with_check(resolve, filters.check_addresses)
+        probe = with_check(probe, filters.check_tls)
+        if filters.needs_geo:
+            enrich = with_check(enrich, filters.check_geo)
+        cleanups.append(filters.report)
+
+    stages: list[Stage] = [
+        Stage('resolve', resolve, dns_tasks, options['dns_timeout']),
+        Stage('enrich', enrich, geo_workers * 2),
+        Stage('tls', probe, tls_tasks, options['tls_timeout']),
+    ]
+    if filters and not filters.needs_geo:
+        # Geo lookups only run for the domains that passed the tls filters
+        stages[1], stages[2] = stages[2], stages[1]
+    if options['ping']:
+        pinger = IcmpPinger()
+        cleanups.append(pinger.close)
+        stages.append(
+            Stage('latency',
+                  partial(latency_stage, pinger=pinger, executor=executor,
+                          metrics=metrics),
+                  options['ping_tasks'], options['ping_timeout']))
+
+    if domain_chunk_len is None:
+        # The size of a shard is only known approximately
+        total_tasks = shard_share(domain_list_length, shard)
     else:
-        domain_chunk_list = domain_list[0: domain_chunk_len]
+        total_tasks = min(domain_chunk_len, domain_list_length or sys.maxsize)
 
-    if options['update_geoip']:
-        update_geoip_db.update()
+    metrics.total = total_tasks
+    items = map(ScanResult, domains)
+    return items, total_tasks, Pipeline(stages, metrics=metrics), cleanups
 
-    active_tasks = options['active_tasks']
 
-    tls_timeout = options['tls_timeout']
-    ping_timeout = options['ping_timeout']
-    dns_timeout =  options['dns_timeout']
+def report_path(name: str, shard: tuple[int, int],
+                extension: str = '') -> str:
+    """
+    Path of a report file next to output.db, every shard gets its own one,
+    e.g. stats-2of4.json.
+    """
 
-    thread_pool_max_workers = options['max_workers']
+    if shard[1] > 1:
+        name = f'{name}-{shard[0] + 1}of{shard[1]}'
+    return os.path.join(this_path, name + extension)
 
-    print(f'|{95 * "_"}')
 
-    resolver = aiodns.DNSResolver()
-    semaphore = asyncio.Semaphore(active_tasks)
-    executor = ThreadPoolExecutor(max_workers=thread_pool_max_workers)
+def progress_rate(metrics: Metrics) -> str:
+    """
+    Formats the throughput and the ETA of the scan for the progress line.
+
+    Args:
+        metrics (Metrics): The metrics of the scan.
 
-    tasks = list()
-    for domain_name in domain_chunk_list:
-        if domain_name is not None:
-            tasks.append(get_info(
-                semaphore,
-                resolver,
-                domain_name,
-                executor,
-                dns_timeout,
-                tls_timeout,
-                ping_timeout
-            ))
+    Returns:
+        str: e.g. ' (120.5/s, ETA 0:01:23)', the ETA is left out if the
+        number of domains is not known.
+    """
 
-    return tasks
+    rate = f' ({metrics.throughput():.1f}/s'
+    if (eta := metrics.eta()) is None:
+        return rate + ')'
+    minutes, seconds = divmod(int(eta), 60)
+    hours, minutes = divmod(minutes, 60)
+    return rate + f', ETA {hours}:{minutes:02}:{seconds:02})'
 
 
-def open_csv() -> list:
+def find_input() -> str:
     """
-    Reads a CSV file containing domain names and extracts them into a list.
+    Finds the domain list in the current working directory, input.csv or
+    one of its compressed forms.
 
     Returns:
-        list: A list of domain names extracted from the CSV file.
+        str: Path of the first input file that exists, input.csv if none of
+        them does.
     """
 
-    domain_list: list[str] = []
-    print('| Start reading input.csv ...', end='')
-    csv_path: str = os.path.join(this_path, 'input.csv')
-
-    with open(csv_path) as csv_file:
-        rows = csv.reader(csv_file)
-        for row in rows:
-            domain_list.append(row[0])
+    for name in ('input.csv', 'input.csv.gz', 'input.csv.zst'):
+        csv_path: str = os.path.join(this_path, name)
+        if os.path.isfile(csv_path):
+            return csv_path
 
-    print('\r| Extracted domains from input.csv')
-    return domain_list
+    return os.path.join(this_path, 'input.csv')
 
 
-async def main() -> None:
+async def scan(
+        input_path: str,
+        options: dict,
+        domain_list_length: int | None,
+        shard: tuple[int, int] = (0, 1)) -> int | None:
     """
-    Main entry point of the program. Orchestrates the execution of tasks to
-    retrieve information about domains from a CSV file, saves the results, and
-    converts the database to a CSV file.
+    Scans the domains of one shard (all of them by default) and streams the
+    results into the database as they complete.
 
-    Raises:
-        KeyboardInterrupt: If the user interrupts the program execution.
+    Args:
+        input_path (str): Path of the domain list.
+        options (dict): The options returned by get_options().
+        domain_list_length (int | None): Number of lines of the input file.
+        shard (tuple[int, int]): The shard index and the number of shards.
 
-    Notes:
-        The main task is protected from being cancelled to avoid cancelling
-        all other tasks.
+    Returns:
+        int | None: The number of unscanned domains saved in remaining.csv
+        if the scan was stopped by a signal (see save_remaining), None if
+        it finished.
     """
-    setup_signal_handler()
 
-    '''Protects main task from being cancelled, otherwise it will cancel
-    all other tasks'''
-    _DO_NOT_CANCEL_TASKS.add(asyncio.current_task())
+    items, total_tasks, pipeline, cleanups = create_tasks(
+        input_path, options, domain_list_length, shard)
+    setup_signal_handler(pipeline, options['shutdown_timeout'])
+
+    '''Results are streamed into output.db while the scan is running'''
+    metrics = pipeline.metrics
+    writer = DatabaseWriter(prepare=prepare_rows, metrics=metrics)
+    await writer.start()
+
+    '''The stats file is rewritten every stats_interval seconds, the
+    Prometheus endpoint is optional'''
+    stats_path = report_path('stats', shard, '.json')
+    reporter: asyncio.Task | None = None
+    if options['stats_interval'] > 0:
+        reporter = asyncio.create_task(
+            write_stats(metrics, stats_path, options['stats_interval']))
+    server: asyncio.Server | None = None
+    if options['metrics_port']:
+        # Every shard process serves on its own port
+        port = options['metrics_port'] + shard[0]
+        try:
+            server = await serve_metrics(metrics, port)
+        except OSError as e:
+            print(f'| Metrics endpoint on port {port} was not started > {e}')
+        else:
+            print(f'| Metrics on http://127.0.0.1:{port}/metrics')
 
-    domain_list: list[str] = open_csv()
-    tasks = create_tasks(domain_list)
+    '''Profiling mode samples the loop lag, the executor queues and the
+    in-flight counts, see profiling.LoopMonitor'''
+    monitor: LoopMonitor | None = None
+    if options['profile']:
+        monitor = LoopMonitor(metrics, writer)
+        monitor.start()
 
-    results: list = []
+    # Shard processes share the terminal, so they print a line now and then
+    # instead of rewriting one progress line
+    prefix = f'Shard {shard[0] + 1}/{shard[1]} ' if shard[1] > 1 else ''
+    total = f"{'~' if shard[1] > 1 else ''}{total_tasks or '?'}"
+    reported = time.monotonic()
 
     '''waits for all tasks to finish and show progress bar, returning the
     result of each completed task'''
-    total_tasks = len(tasks)
-    progress = 0
     try:
-        print(f'| Initiating the process ...', end='')
-        for f in asyncio.as_completed(tasks):
-            result = await f
-            if result:
-                results.append(result)
-            progress += 1
-            print(f"\r| Progress: {progress}/{total_tasks} tasks completed",
-                  end="")
+        print(f'| {prefix}Initiating the process ...', end='')
+        async for record in pipeline.run(items):
+            if record is not None:
+                await writer.put(record)
+            if not prefix:
+                print(f"\r| Progress: {metrics.completed}/{total} "
+                      f"tasks completed{progress_rate(metrics)}  ", end="")
+            elif time.monotonic() - reported >= 5:
+                reported = time.monotonic()
+                print(f"\n| {prefix}progress: {metrics.completed}/{total} "
+                      f"tasks completed{progress_rate(metrics)}", end="")
     finally:
-        save(extract_results(results))
-        print('\n| Saved data into output.db ✓')
-        database_convert()
-        print('| Database successfully converted to csv file ✓')
+        try:
+            await writer.close()
+        finally:
+            # A failed writer raises here, the rest is cleaned up anyway
+            for cleanup in cleanups:
+                if inspect.isawaitable(result := cleanup()):
+                    await result
+            close_geo_lookup()
+            if reporter is not None:
+                reporter.cancel()
+            if server is not None:
+                server.close()
+            try:
+                metrics.write(stats_path)
+                if monitor is not None:
+                    monitor.stop()
+                    monitor.write_report(
+                        report_path('profile-report', shard, '.json'))
+                    summary = monitor.summary()
+                    print(f'\n| {prefix}Loop lag p99 '
+                          f'{summary["lag_p99_ms"] or 0:.1f} ms, max '
+                          f'{summary["lag_max_ms"]:.1f} ms, blocked for '
+                          f'{summary["blocked_seconds"]} s', end='')
+            except OSError as e:
+                print(f'\n| Stats file was not written > {e}')
+            print(f'\n| {prefix}Saved {writer.written} scans into '
+                  f'output.db ✓')
+
+    if pipeline.stopping:
+        '''The domains that were admitted but not finished and the ones that
+        were never admitted are kept for a later run'''
+        remaining_path = report_path('remaining', shard, '.csv')
+        loop = asyncio.get_running_loop()
+        remaining = await loop.run_in_executor(
+            None, save_remaining, remaining_path, pipeline.inside, items)
+        print(f'| {prefix}{remaining} unscanned domains saved into '
+              f'{os.path.basename(remaining_path)}, continue with '
+              f'--input {os.path.basename(remaining_path)}')
+        return remaining
+    return None
+
+
+def save_remaining(
+        remaining_path: str,
+        unfinished: set[ScanResult],
+        items: Iterator[ScanResult]) -> int:
+    """
+    Writes the domains of a stopped scan that were not scanned, one per line
+    like input.csv. It runs in a thread, the rest of items is read from the
+    domain list.
 
+    Args:
+        remaining_path (str): Path of the file.
+        unfinished (set[ScanResult]): The records that were abandoned.
+        items (Iterator[ScanResult]): The records that were not admitted.
 
-def shutdown(sig: signal.Signals) -> None:
+    Returns:
+        int: The number of written domains.
     """
-    Signal handler function to gracefully shut down the program in response to
-    received signals.
 
-    Args:
-        sig (signal.Signals): The signal received by the program.
+    written = 0
+    with open(remaining_path, 'w') as remaining_file:
+        for record in chain(unfinished, items):
+            remaining_file.write(record.domain_name + '\n')
+            written += 1
+    return written
 
-    Notes:
-        This function cancels all tasks except those protected by
-        _DO_NOT_CANCEL_TASKS set.
+
+async def main(
+        input_path: str,
+        options: dict,
+        domain_list_length: int | None,
+        shard: tuple[int, int] = (0, 1)) -> int | None:
+    """
+    Main entry point of the program. Scans the domains of a CSV file (or of
+    one shard of it) and converts the database to a CSV file.
+
+    Returns:
+        int | None: The number of unscanned domains of a stopped scan, None
+        if the scan finished.
 
     Raises:
-        asyncio.CancelledError: If a task is cancelled during the shutdown
-        process.
+        KeyboardInterrupt: If the user interrupts the program execution.
+    """
+
+    remaining = await scan(input_path, options, domain_list_length, shard)
+    if remaining is not None:
+        # The next full export includes the rows of the stopped scan
+        print('| The export is skipped for a stopped scan')
+        return remaining
+
+    '''The export runs in a thread, so the loop is not blocked'''
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(
+        None, database_convert, options['export_formats'],
+        options['incremental_export'])
+    print('| Database successfully exported ✓')
+    return None
+
 
+def loop_runner(name: str) -> Callable[[Coroutine], Any]:
     """
+    Selects the event loop of the scan. uvloop (libuv) runs the callbacks,
+    sockets and TLS transports of the loop in C, which lowers the overhead of
+    every DNS query and handshake; it is an optional dependency and is not
+    available on PyPy or Windows.
 
-    print(f'\n| Received {sig.name} signal')
+    Args:
+        name (str): 'auto' (uvloop if it is installed), 'asyncio' or
+            'uvloop'.
 
-    all_tasks = asyncio.all_tasks()
-    task_to_cancel = all_tasks - _DO_NOT_CANCEL_TASKS
+    Returns:
+        Callable[[Coroutine], Any]: asyncio.run() or uvloop.run().
 
-    # bottleneck of cancelling or killing processes!
-    for task in task_to_cancel:
-        task.cancel()
+    Raises:
+        SystemExit: If uvloop is required but not installed.
+    """
 
-    print(f'| Cancelled {len(task_to_cancel)} out of {len(all_tasks)}')
-    print(f'\n| Saving data ...', end='')
+    if name == 'asyncio':
+        return asyncio.run
+    try:
+        import uvloop
+    except ImportError:
+        if name == 'uvloop':
+            print('| uvloop is not installed (pip install uvloop)')
+            sys.exit(1)
+        return asyncio.run
+    return uvloop.run
+
+
+def run_shard(
+        input_path: str,
+        options: dict,
+        domain_list_length: int | None,
+        shard: tuple[int, int]) -> None:
+    """
+    Scans one shard in a local worker process with its own event loop. The
+    process exits with STOPPED_EXIT_CODE if the scan was stopped.
+    """
 
+    try:
+        with profiled(options['profile'], report_path('profile', shard)):
+            remaining = loop_runner(options['loop'])(
+                scan(input_path, options, domain_list_length, shard))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        print(f'\n| Shard {shard[0] + 1}/{shard[1]} was cancelled')
+        sys.exit(STOPPED_EXIT_CODE)
+    if remaining is not None:
+        sys.exit(STOPPED_EXIT_CODE)
+
+
+def shutdown(sig: signal.Signals, pipeline: Pipeline,
+             deadline: float) -> None:
+    """
+    Signal handler function to gracefully shut down the program in response to
+    received signals.
+
+    Args:
+        sig (signal.Signals): The signal received by the program.
+        pipeline (Pipeline): The pipeline of the running scan.
+        deadline (float): Seconds the running probes get to finish.
+
+    Notes:
+        The first signal stops admitting new domains, the running probes
+        finish until the deadline and are abandoned after it. A second signal
+        abandons them at once and restores the default handlers, so a third
+        one interrupts the program. Finished results are always saved.
+    """
 
-def setup_signal_handler() -> None:
+    loop = asyncio.get_running_loop()
+    if pipeline.stopping:
+        print(f'\n| Received {sig.name} signal again, abandoning the '
+              f'running probes')
+        pipeline.abort()
+        for handled in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(handled)
+        return
+
+    print(f'\n| Received {sig.name} signal, no new domains are scanned and '
+          f'the running probes get {deadline:g} s (send it again to stop '
+          f'now)')
+    pipeline.stop()
+    loop.call_later(deadline, pipeline.abort)
+
+
+def setup_signal_handler(pipeline: Pipeline, deadline: float) -> None:
     """
     Sets up signal handlers for specific signals to gracefully handle program
     termination.
 
+    Args:
+        pipeline (Pipeline): The pipeline of the running scan.
+        deadline (float): Seconds the running probes get to finish after
+            the first signal, see shutdown().
+
     Notes:
         This function adds signal handlers for the following signals:
         - SIGHUP: Hangup Signal (connection lost)
@@ -415,26 +882,145 @@ def setup_signal_handler() -> None:
         - SIGINT: Interrupt Signal (interrupt running process by pressing
           ctrl+c)
 
-        The second argument passed to the shutdown function is the received
-        signal.
+        The received signal is the first argument of the shutdown function.
     """
 
     loop = asyncio.get_running_loop()
 
     for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
-        loop.add_signal_handler(sig, shutdown, sig)
+        loop.add_signal_handler(sig, shutdown, sig, pipeline, deadline)
+
+
+def parse_arguments() -> argparse.Namespace:
+    """
+    Parses the command line arguments of the sharded and headless modes.
+
+    Returns:
+        argparse.Namespace: The parsed arguments.
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Scans the TLS information of a list of domains.')
+    parser.add_argument(
+        '--shard', metavar='i/N',
+        help='scan only shard i of N, e.g. on one of N machines; merge the '
+             'output.db files afterwards with --merge')
+    parser.add_argument(
+        '--processes', type=int, default=1, metavar='N',
+        help='split the domains into N shards scanned by N local processes')
+    parser.add_argument(
+        '--merge', nargs='+', metavar='DB',
+        help='merge the given databases into output.db and exit')
+    parser.add_argument(
+        '--input', metavar='PATH',
+        help="domain list to read, '-' for stdin [default: input.csv, "
+             "input.csv.gz or input.csv.zst]")
+    add_option_arguments(parser)
+    return parser.parse_args()
+
+
+def is_headless(args: argparse.Namespace) -> bool:
+    """
+    Whether the run takes its options from the command line or the config
+    file instead of asking questions. Giving any option flag is enough.
+    """
+
+    return bool(args.headless or args.config or any(
+        getattr(args, key, None) is not None for key in DEFAULT_OPTIONS))
+
+
+def run(args: argparse.Namespace) -> dict[str, int]:
+    """
+    Asks for the options (or takes them from the command line and the config
+    file in headless mode) and runs the scan in this process, or in one
+    process per shard.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+
+    Returns:
+        dict[str, int]: The remaining files of a stopped scan and their
+        number of unscanned domains, empty if the scan finished.
+    """
+
+    if args.merge:
+        merged = merge_databases(args.merge)
+        print(f'| Merged {merged} scans into output.db ✓')
+        database_convert(args.export_formats or ['csv'],
+                         bool(args.incremental_export))
+        print('| Database successfully exported ✓')
+        return dict()
+
+    shard: tuple[int, int] = (0, 1)
+    if args.shard:
+        shard = parse_shard(args.shard)
+    if args.processes > 1 and shard[1] > 1:
+        print('| --shard and --processes can not be combined')
+        sys.exit(1)
+
+    input_path: str = args.input or find_input()
+    if input_path == '-' and args.processes > 1:
+        print('| Shard processes can not read the domains from stdin')
+        sys.exit(1)
+    print(f'| Reading domains from {os.path.basename(input_path)}')
+    domain_list_length: int | None = count_lines(input_path)
+    if is_headless(args):
+        options = headless_options(args, domain_list_length)
+    else:
+        options = get_options(domain_list_length)
+
+    if options['update_geoip']:
+        # requests is only imported by the update
+        import update_geoip_db
+        update_geoip_db.update(options['geoip_api'])
+
+    print(f'|{95 * "_"}')
+
+    if args.processes > 1:
+        # Creates the tables once, the shards write into it concurrently
+        init_database()
+        exit_codes = run_local_shards(run_shard, args.processes,
+                                      input_path, options, domain_list_length)
+        remaining: dict[str, int] = dict()
+        for index, code in enumerate(exit_codes):
+            remaining_path = report_path(
+                'remaining', (index, args.processes), '.csv')
+            if code == STOPPED_EXIT_CODE and os.path.exists(remaining_path):
+                remaining[os.path.basename(remaining_path)] = \
+                    count_lines(remaining_path) or 0
+        if STOPPED_EXIT_CODE in exit_codes:
+            print('| The export is skipped for a stopped scan')
+            return remaining
+        database_convert(options['export_formats'],
+                         options['incremental_export'])
+        print('| Database successfully exported ✓')
+        return dict()
+
+    with profiled(options['profile'], report_path('profile', shard)):
+        left = loop_runner(options['loop'])(
+            main(input_path, options, domain_list_length, shard))
+    if left is None:
+        return dict()
+    return {os.path.basename(report_path('remaining', shard, '.csv')): left}
 
 
 if __name__ == '__main__':
+    arguments = parse_arguments()
+    if not is_headless(arguments):
+        try:
+            print_acii()
+        except Exception as e:
+            print(e)
     try:
-        print_acii()
-    except Exception as e:
-        print(e)
-    try:
-        asyncio.run(main())
+        stopped = run(arguments)
     except KeyboardInterrupt as e:
         print(f'| Process was interrupt by press ctrl+c: {e}')
+        sys.exit(STOPPED_EXIT_CODE)
     except asyncio.CancelledError:
         print(f'| TLS-Checker was cancelled')
-    else:
-        print('| Process is finished successfully ✓')
+        sys.exit(STOPPED_EXIT_CODE)
+    if stopped:
+        print(f'| Process was stopped, {sum(stopped.values())} domains left '
+              f'in {", ".join(stopped)}')
+        sys.exit(STOPPED_EXIT_CODE)
+    print('| Process is finished successfully ✓')
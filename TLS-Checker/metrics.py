@@ -0,0 +1,386 @@
+import os
+import ssl
+import json
+import time
+import asyncio
+from collections import Counter, deque
+from concurrent.futures import Executor
+
+
+"""
+Live metrics of a scan. Every stage of the pipeline counts its outcomes
+(passed, dropped or the class of the error) and its duration, the DNS
+queries, TLS probes, pings and database writes count their outcomes by error
+class (timeout, refused, cert_error, nxdomain, ...) and keep latency
+histograms. The metrics are written to a JSON stats file every few seconds
+and can be served in the Prometheus text format on a local port.
+"""
+
+
+# Upper bounds of the latency histogram buckets in milliseconds, the last
+# bucket (+Inf) is implicit
+LATENCY_BUCKETS: tuple[float, ...] = (
+    1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10_000, 30_000)
+
+# c-ares status codes of aiodns.error.DNSError. A refusal of the nameserver
+# (the REFUSED answer or a refused connection) is kept apart from a refused
+# TCP connection of a TLS probe
+DNS_ERRORS: dict[int, str] = {
+    1: 'no_data',
+    3: 'servfail',
+    4: 'nxdomain',
+    6: 'dns_refused',
+    11: 'dns_conn_refused',
+    12: 'timeout',
+}
+
+# Seconds of completions the throughput is computed from
+RATE_WINDOW: int = 30
+
+
+def error_class(error: BaseException) -> str:
+    """
+    Classifies an exception of a DNS query, TLS probe or ping.
+
+    Args:
+        error (BaseException): The exception.
+
+    Returns:
+        str: 'timeout', 'cert_error', 'tls_error', 'refused', 'reset',
+        'unreachable', one of DNS_ERRORS or 'error'.
+    """
+
+    # asyncio.TimeoutError and the ssl errors are OSErrors too
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+        return 'timeout'
+    if isinstance(error, ssl.SSLCertVerificationError):
+        return 'cert_error'
+    if isinstance(error, ssl.SSLError):
+        return 'tls_error'
+    if isinstance(error, ConnectionRefusedError):
+        return 'refused'
+    if isinstance(error, ConnectionResetError):
+        return 'reset'
+    if isinstance(error, OSError):
+        return 'unreachable'
+    # aiodns.error.DNSError carries the c-ares status code as first argument
+    if error.args and isinstance(error.args[0], int):
+        return DNS_ERRORS.get(error.args[0], 'dns_error')
+    return 'error'
+
+
+def queue_depth(executor: Executor) -> int | None:
+    """
+    Returns:
+        int | None: The number of calls waiting for a worker of a thread
+        pool, None if the executor doesn't expose its queue.
+    """
+
+    work_queue = getattr(executor, '_work_queue', None)
+    return None if work_queue is None else work_queue.qsize()
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets, see LATENCY_BUCKETS.
+    """
+
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self) -> None:
+        self.counts: list[int] = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count: int = 0
+        self.sum: float = 0.0
+        self.max: float = 0.0
+
+    def observe(self, value: float) -> None:
+        """Adds one duration in milliseconds."""
+
+        index = 0
+        for bound in LATENCY_BUCKETS:
+            if value <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, share: float) -> float | None:
+        """
+        Estimates a quantile by interpolating inside its bucket, it is never
+        larger than the largest observed value.
+
+        Args:
+            share (float): The quantile, e.g. 0.99.
+
+        Returns:
+            float | None: The estimate in milliseconds, None if empty.
+        """
+
+        if not self.count:
+            return None
+        rank = share * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = LATENCY_BUCKETS[index - 1] if index else 0.0
+                if index == len(LATENCY_BUCKETS):
+                    return self.max
+                upper = LATENCY_BUCKETS[index]
+                return min(self.max,
+                           lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+        return self.max
+
+
+class Metrics:
+    """
+    The metrics of one scan, shared by the pipeline, the stage handlers and
+    the DatabaseWriter.
+
+    Args:
+        total (int | None): Number of domains of the scan if it is known,
+            used for the ETA.
+        labels (dict[str, str] | None): Labels of every Prometheus sample,
+            e.g. the shard.
+    """
+
+    def __init__(self, total: int | None = None,
+                 labels: dict[str, str] | None = None) -> None:
+        self.total = total
+        self.labels = labels or dict()
+        self.started: float = time.monotonic()
+        self.completed: int = 0
+        self.saved: int = 0
+        # (stage or operation, outcome) -> count
+        self.outcomes: Counter = Counter()
+        # stage or operation -> latency histogram
+        self.latency: dict[str, Histogram] = dict()
+        # The stages of the pipeline, for their in-flight counts
+        self.stages: list = list()
+        # name -> executor of the scan, for its queue depth
+        self.executors: dict[str, Executor] = dict()
+        # [second, completions] of the last RATE_WINDOW seconds
+        self._completions: deque[list[int]] = deque(maxlen=RATE_WINDOW + 1)
+
+    def count(self, name: str, outcome: str) -> None:
+        """Counts one outcome of a stage or operation."""
+
+        self.outcomes[(name, outcome)] += 1
+
+    def observe(self, name: str, milliseconds: float) -> None:
+        """Adds one duration of a stage or operation."""
+
+        histogram = self.latency.get(name)
+        if histogram is None:
+            histogram = self.latency[name] = Histogram()
+        histogram.observe(milliseconds)
+
+    def complete(self) -> None:
+        """Counts one domain that left the pipeline."""
+
+        self.completed += 1
+        second = int(time.monotonic())
+        if self._completions and self._completions[-1][0] == second:
+            self._completions[-1][1] += 1
+        else:
+            self._completions.append([second, 1])
+
+    def throughput(self) -> float:
+        """Domains per second over the last RATE_WINDOW seconds."""
+
+        now = time.monotonic()
+        window = min(RATE_WINDOW, max(now - self.started, 1.0))
+        # Counts every second that overlaps the window
+        recent = sum(count for second, count in self._completions
+                     if second + 1 > now - window)
+        return recent / window
+
+    def eta(self) -> float | None:
+        """Seconds until the scan is finished at the current throughput."""
+
+        rate = self.throughput()
+        if self.total is None or not rate:
+            return None
+        return max(0, self.total - self.completed) / rate
+
+    def snapshot(self) -> dict:
+        """
+        Returns:
+            dict: The current metrics, as written to the stats file.
+        """
+
+        outcomes: dict[str, dict[str, int]] = dict()
+        for (name, outcome), count in sorted(self.outcomes.items()):
+            outcomes.setdefault(name, dict())[outcome] = count
+        return {
+            'time': time.time(),
+            'elapsed_seconds': round(time.monotonic() - self.started, 3),
+            'completed': self.completed,
+            'total': self.total,
+            'saved': self.saved,
+            'throughput': round(self.throughput(), 2),
+            'eta_seconds': (None if (eta := self.eta()) is None
+                            else round(eta, 1)),
+            'in_flight': {stage.name: stage.in_flight
+                          for stage in self.stages},
+            'executor_queue': {name: queue_depth(executor)
+                               for name, executor in self.executors.items()},
+            'outcomes': outcomes,
+            'latency_ms': {
+                name: {'count': histogram.count,
+                       'mean': round(histogram.sum / histogram.count, 2),
+                       'max': round(histogram.max, 2),
+                       **{f'p{round(share * 100)}':
+                          round(histogram.quantile(share), 2)
+                          for share in (0.5, 0.95, 0.99)}}
+                for name, histogram in sorted(self.latency.items())
+                if histogram.count},
+        }
+
+    def write(self, stats_path: str) -> None:
+        """Writes the snapshot to a JSON file, the file is replaced."""
+
+        _write_json(self.snapshot(), stats_path)
+
+    def prometheus(self) -> str:
+        """
+        Returns:
+            str: The metrics in the Prometheus text exposition format.
+        """
+
+        def labels(**extra) -> str:
+            pairs = {**self.labels, **extra}
+            if not pairs:
+                return ''
+            return '{' + ','.join(
+                f'{key}="{value}"' for key, value in pairs.items()) + '}'
+
+        lines: list[str] = [
+            '# TYPE tls_checker_completed_total counter',
+            f'tls_checker_completed_total{labels()} {self.completed}',
+            '# TYPE tls_checker_saved_total counter',
+            f'tls_checker_saved_total{labels()} {self.saved}',
+            '# TYPE tls_checker_throughput gauge',
+            f'tls_checker_throughput{labels()} {self.throughput():.3f}',
+        ]
+        if self.total is not None:
+            lines += ['# TYPE tls_checker_total gauge',
+                      f'tls_checker_total{labels()} {self.total}']
+        if (eta := self.eta()) is not None:
+            lines += ['# TYPE tls_checker_eta_seconds gauge',
+                      f'tls_checker_eta_seconds{labels()} {eta:.1f}']
+
+        lines.append('# TYPE tls_checker_in_flight gauge')
+        lines += [f'tls_checker_in_flight{labels(stage=stage.name)} '
+                  f'{stage.in_flight}' for stage in self.stages]
+
+        lines.append('# TYPE tls_checker_executor_queue gauge')
+        lines += [f'tls_checker_executor_queue{labels(executor=name)} '
+                  f'{depth}' for name, executor in self.executors.items()
+                  if (depth := queue_depth(executor)) is not None]
+
+        lines.append('# TYPE tls_checker_outcomes_total counter')
+        lines += [f'tls_checker_outcomes_total'
+                  f'{labels(name=name, outcome=outcome)} {count}'
+                  for (name, outcome), count in sorted(self.outcomes.items())]
+
+        lines.append('# TYPE tls_checker_latency_ms histogram')
+        for name, histogram in sorted(self.latency.items()):
+            cumulative = 0
+            for bound, count in zip(
+                    (*LATENCY_BUCKETS, '+Inf'), histogram.counts):
+                cumulative += count
+                lines.append(f'tls_checker_latency_ms_bucket'
+                             f'{labels(name=name, le=bound)} {cumulative}')
+            lines.append(f'tls_checker_latency_ms_sum{labels(name=name)} '
+                         f'{histogram.sum:.3f}')
+            lines.append(f'tls_checker_latency_ms_count{labels(name=name)} '
+                         f'{histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+async def write_stats(metrics: Metrics, stats_path: str,
+                      interval: float) -> None:
+    """
+    Writes the stats file every interval seconds until it is cancelled.
+
+    Args:
+        metrics (Metrics): The metrics of the scan.
+        stats_path (str): Path of the JSON stats file.
+        interval (float): Seconds between two writes.
+    """
+
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # The snapshot is taken on the loop, only the file is written
+            # in the executor
+            await loop.run_in_executor(
+                None, _write_json, metrics.snapshot(), stats_path)
+        except OSError as e:
+            print(f'\n| Stats file was not written > {e}')
+
+
+def _write_json(snapshot: dict, stats_path: str) -> None:
+    """Writes a snapshot to a temporary file and moves it into place."""
+
+    with open(stats_path + '.tmp', 'w') as stats_file:
+        json.dump(snapshot, stats_file, indent=2)
+    os.replace(stats_path + '.tmp', stats_path)
+
+
+async def serve_metrics(metrics: Metrics, port: int,
+                        host: str = '127.0.0.1') -> asyncio.Server:
+    """
+    Serves the metrics in the Prometheus text format on
+    http://host:port/metrics, the stats snapshot is served as JSON on
+    /stats.
+
+    Args:
+        metrics (Metrics): The metrics of the scan.
+        port (int): The TCP port.
+        host (str): The address to listen on, local only by default.
+
+    Returns:
+        asyncio.Server: The server, it is closed by the caller.
+    """
+
+    async def handle(reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        try:
+            try:
+                request = await asyncio.wait_for(
+                    reader.readline(), timeout=5)
+            except ValueError:
+                # The request line is longer than the limit of the reader
+                request = b''
+            # 'GET /metrics HTTP/1.1', anything else is a bad request
+            parts = request.split()
+            target = parts[1].decode('latin-1') if len(parts) >= 2 else None
+            if target is None:
+                status, body, content_type = (
+                    '400 Bad Request', '', 'text/plain')
+            elif target.startswith('/metrics'):
+                status, body = '200 OK', metrics.prometheus()
+                content_type = 'text/plain; version=0.0.4'
+            elif target.startswith('/stats'):
+                status = '200 OK'
+                body = json.dumps(metrics.snapshot(), indent=2)
+                content_type = 'application/json'
+            else:
+                status, body, content_type = '404 Not Found', '', 'text/plain'
+            payload = body.encode()
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+                f'Content-Length: {len(payload)}\r\n'
+                f'Connection: close\r\n\r\n'.encode() + payload)
+            await writer.drain()
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
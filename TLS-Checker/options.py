@@ -1,10 +1,84 @@
-def get_options(domain_list_length: int) -> dict:
+import json
+import argparse
+from sys import exit
+
+
+# Options of a headless run that are not given by flags or the config file,
+# the same defaults as the answers of get_options()
+DEFAULT_OPTIONS: dict = {
+    'domain_chunk_len': None,
+    'random_normal': False,
+    'update_geoip': False,
+    'resume_hours': 0,
+    'active_tasks': 100,
+    # Concurrency of the pipeline stages and upper bound of the adaptive
+    # limits, None derives them from active_tasks (see add_fixed_options)
+    'dns_tasks': None,
+    'tls_tasks': None,
+    'ping_tasks': None,
+    'adaptive_max': None,
+    'adaptive': False,
+    'max_workers': None,
+    'tls_timeout': 2,
+    'ping': False,
+    'ping_timeout': 5,
+    'dns_timeout': None,
+    'nameservers': [],
+    # Resolver channels per nameserver
+    'dns_channels': 2,
+    # Persistent DNS cache (dns_cache.db) reused by the next runs
+    'dns_cache': True,
+    # Early-exit filters, see filters.Filters
+    'require_tls': [],
+    'require_ipv6': False,
+    'exclude_issuers': [],
+    'exclude_asns': [],
+    'exclude_countries': [],
+    # Export of output.db after the scan, see csv_convertor
+    'export_formats': ['csv'],
+    'incremental_export': False,
+    # Port of the TLS probes, e.g. of local test servers
+    'tls_port': 443,
+    # Live metrics, see metrics.Metrics
+    'stats_interval': 10,
+    'metrics_port': None,
+    # Profiling mode, see profiling.PROFILE_MODES
+    'profile': None,
+    # Seconds the running probes get after a shutdown signal
+    'shutdown_timeout': 5,
+    # Release API of the GeoLite databases, see update_geoip_db
+    'geoip_api': None,
+    # Event loop of the scan: 'auto' (uvloop if it is installed), 'asyncio'
+    # or 'uvloop'
+    'loop': 'auto',
+}
+
+# Options that get_options() doesn't ask for
+NOT_ASKED: tuple[str, ...] = (
+    'require_tls', 'require_ipv6', 'exclude_issuers', 'exclude_asns',
+    'exclude_countries', 'export_formats', 'incremental_export', 'tls_port',
+    'stats_interval', 'metrics_port', 'profile', 'shutdown_timeout',
+    'geoip_api', 'loop', 'dns_tasks', 'tls_tasks', 'ping_tasks',
+    'adaptive_max', 'dns_channels')
+
+# Options that are at least 1 if they are given
+POSITIVE_OPTIONS: tuple[str, ...] = (
+    'dns_tasks', 'tls_tasks', 'ping_tasks', 'adaptive_max', 'dns_channels')
+
+
+def comma_list(value: str) -> list[str]:
+    """Splits a comma separated flag value."""
+
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def get_options(domain_list_length: int | None) -> dict:
     """
    Retrieves options from the user for customizing the scanning process.
 
    Args:
-       domain_list_length (int): The length of the domain list
-       obtained from the CSV file.
+       domain_list_length (int | None): The number of lines of the input
+       file, or None if it is not known (compressed input or stdin).
 
    Returns:
        dict: A dictionary containing the options selected by the user.
@@ -13,39 +87,52 @@ def get_options(domain_list_length: int) -> dict:
        The function prompts the user to input various options
        for the scanning process,
        including:
-       - Number of domains to scan in each chunk.
+       - Number of domains to scan in each chunk (None means all of them).
        - Whether to perform randomized search or normal search.
        - Whether to update the Geo-IP database or use the existing one.
+       - Freshness window in hours, domains scanned within it are skipped
+         (resume mode, 0 disables it).
        - Number of active tasks to run concurrently.
+       - Whether the number of active DNS queries and TLS handshakes is
+         adapted at runtime (the active tasks are the starting point).
        - Number of maximum workers (auto by default).
        - Timeout for the tls_info function in seconds.
+       - Whether to run the separate ping stage, the TLS probe already
+         measures the TCP connect and TLS handshake durations.
        - Timeout for the ping function in seconds.
        - Timeout for tasks in seconds.
+       - DNS nameservers (the system configuration by default).
+       - Whether DNS answers are kept in dns_cache.db for the next runs.
        The function handles user input validation and provides default
        values for options
        if no input or invalid input is provided.
    """
 
     options = dict()
-    domain_chunk_len: int = domain_list_length
+    domain_chunk_len: int | None = domain_list_length
     active_tasks: int = 100
     max_workers: int | None = None
     tls_timeout: int = 2
     ping_timeout: int = 5
     dns_timeout: int = ping_timeout + tls_timeout + 5
 
-    print(f'| input.csv includes {domain_list_length} domains')
+    if domain_list_length is None:
+        print('| The number of domains is unknown until the input is read')
+    else:
+        print(f'| input includes {domain_list_length} domains')
 
 
     try:
         domain_chunk_len = domain_list_length
         domain_chunk_len: int = int(input(
-            f'| How many of them? [default={domain_list_length}]: ').strip())
+            f'| How many of them? '
+            f'[default={domain_list_length or "all"}]: ').strip())
     except ValueError:
         domain_chunk_len = domain_list_length
     else:
         match domain_chunk_len:
-            case domain_chunk_len if domain_chunk_len > domain_list_length:
+            case domain_chunk_len if (domain_list_length is not None and
+                                      domain_chunk_len > domain_list_length):
                 domain_chunk_len = domain_list_length
             case domain_chunk_len if domain_chunk_len < 0:
                 domain_chunk_len = 0
@@ -80,6 +167,20 @@ def get_options(domain_list_length: int) -> dict:
                 options['update_geoip'] = False
 
 
+    try:
+        resume_hours: float = float(input(
+            '| Skip domains scanned in the last N hours? '
+            '[default=0 (scan all)]: ').strip())
+    except ValueError:
+        resume_hours = 0
+    else:
+        match resume_hours:
+            case resume_hours if resume_hours < 0:
+                resume_hours = 0
+    finally:
+        options['resume_hours'] = resume_hours
+
+
     try:
         active_tasks: int = int(input(f'| Number of active tasks?'
                                       f' [default={active_tasks}]: ').strip())
@@ -93,6 +194,19 @@ def get_options(domain_list_length: int) -> dict:
         options['active_tasks'] = active_tasks
 
 
+    try:
+        adaptive: str = input('| [A]: Adaptive concurrency  [F]: Fixed '
+                              '[default=F]: ').strip().lower()
+    except ValueError:
+        options['adaptive'] = False
+    else:
+        match adaptive:
+            case 'a':
+                options['adaptive'] = True
+            case _:
+                options['adaptive'] = False
+
+
     '''If max_workers is None or not given Default value of max_workers is 
     min(32, os.cpu_count() + 4). This default value preserves at least 5
     workers for I/O bound tasks. It utilizes at most 32 CPU cores for CPU 
@@ -126,16 +240,30 @@ def get_options(domain_list_length: int) -> dict:
 
 
     try:
-        ping_timeout =  int(input(f'| Timeout of ping in seconds?'
-                                  f' [default={ping_timeout}]: ').strip())
+        ping_stage: str = input('| [P]: Ping stage  [S]: Skip ping '
+                                '[default=S]: ').strip().lower()
     except ValueError:
-        ping_timeout = 5
+        options['ping'] = False
     else:
-        match ping_timeout:
-            case ping_timeout if ping_timeout < 0:
-                ping_timeout = 0
-    finally:
-        options['ping_timeout'] = ping_timeout
+        match ping_stage:
+            case 'p':
+                options['ping'] = True
+            case _:
+                options['ping'] = False
+
+
+    # The timeout is only asked for when the ping stage runs
+    if options['ping']:
+        try:
+            ping_timeout =  int(input(f'| Timeout of ping in seconds?'
+                                      f' [default={ping_timeout}]: ').strip())
+        except ValueError:
+            ping_timeout = 5
+        else:
+            match ping_timeout:
+                case ping_timeout if ping_timeout < 0:
+                    ping_timeout = 0
+    options['ping_timeout'] = ping_timeout
 
 
     try:
@@ -151,4 +279,263 @@ def get_options(domain_list_length: int) -> dict:
     finally:
         options['dns_timeout'] = dns_timeout
 
+    try:
+        nameservers: str = input('| DNS nameservers, comma separated '
+                                 '[default=system]: ').strip()
+    except ValueError:
+        nameservers = ''
+    finally:
+        options['nameservers'] = [
+            ns.strip() for ns in nameservers.split(',') if ns.strip()]
+
+
+    try:
+        dns_cache: str = input('| [C]: Cache DNS answers in dns_cache.db  '
+                               '[F]: Fresh DNS answers '
+                               '[default=C]: ').strip().lower()
+    except ValueError:
+        options['dns_cache'] = True
+    else:
+        match dns_cache:
+            case 'f':
+                options['dns_cache'] = False
+            case _:
+                options['dns_cache'] = True
+
+    return add_fixed_options(options)
+
+
+def add_fixed_options(options: dict) -> dict:
+    """
+    Adds the options that are not asked for and derives the ones that are
+    not given from the answers.
+
+    Args:
+        options (dict): The answers of get_options() or headless_options().
+
+    Returns:
+        dict: The same dictionary including the derived options.
+
+    Raises:
+        SystemExit: If a concurrency option is not a number of at least 1.
+    """
+
+    active_tasks: int = max(options['active_tasks'], 1)
+
+    # Only flags and the config file set them
+    for key in NOT_ASKED:
+        options.setdefault(key, DEFAULT_OPTIONS[key])
+
+    for key in POSITIVE_OPTIONS:
+        value = options[key]
+        if value is not None and (
+                not isinstance(value, int) or isinstance(value, bool) or
+                value < 1):
+            print(f'| {key} must be a number of at least 1, not {value!r}')
+            exit(1)
+
+    # Concurrency limits of the pipeline stages, by default each stage gets
+    # the number of active tasks
+    for key in ('dns_tasks', 'tls_tasks', 'ping_tasks'):
+        if options[key] is None:
+            options[key] = active_tasks
+    # Upper bound of the adaptive limits
+    if options['adaptive_max'] is None:
+        options['adaptive_max'] = active_tasks * 10
+
     return options
+
+
+def add_option_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Adds the flags of the headless mode, one per question of get_options().
+    Flags that are not given default to None, so they don't override the
+    config file.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser of main.py.
+    """
+
+    group = parser.add_argument_group(
+        'headless mode',
+        'run without questions, the options are taken from these flags and '
+        'the JSON config file (flags win), the rest get their defaults')
+    group.add_argument('--headless', action='store_true',
+                       help='don\'t ask questions, use the defaults')
+    group.add_argument('--config', metavar='PATH',
+                       help='JSON file with the options, e.g. '
+                            '{"active_tasks": 500, "tls_timeout": 3}')
+    group.add_argument('--chunk', type=int, dest='domain_chunk_len',
+                       metavar='N', help='number of domains to scan')
+    group.add_argument('--random', action='store_true', default=None,
+                       dest='random_normal', help='randomized search')
+    group.add_argument('--update-geoip', action='store_true', default=None,
+                       help='update the Geo-IP database first')
+    group.add_argument('--geoip-api', metavar='URL',
+                       help='release API of the Geo-IP update, e.g. a local '
+                            'mirror [default: GitHub]')
+    group.add_argument('--resume-hours', type=float, metavar='HOURS',
+                       help='skip domains scanned in the last HOURS hours')
+    group.add_argument('--active-tasks', type=int, metavar='N',
+                       help='number of active tasks per stage')
+    group.add_argument('--dns-tasks', type=int, metavar='N',
+                       help='DNS queries at the same time [default: active '
+                            'tasks]')
+    group.add_argument('--tls-tasks', type=int, metavar='N',
+                       help='TLS probes at the same time [default: active '
+                            'tasks]')
+    group.add_argument('--ping-tasks', type=int, metavar='N',
+                       help='pings at the same time [default: active tasks]')
+    group.add_argument('--adaptive', action='store_true', default=None,
+                       help='adaptive concurrency')
+    group.add_argument('--adaptive-max', type=int, metavar='N',
+                       help='upper bound of the adaptive DNS and TLS limits '
+                            '[default: 10 x active tasks]')
+    group.add_argument('--max-workers', type=int, metavar='N',
+                       help='number of max workers')
+    group.add_argument('--tls-timeout', type=int, metavar='SECONDS',
+                       help='timeout of tls_info')
+    group.add_argument('--tls-port', type=int, metavar='PORT',
+                       help='port of the TLS probes [default: 443]')
+    group.add_argument('--ping', action='store_true', default=None,
+                       help='run the ping stage')
+    group.add_argument('--ping-timeout', type=int, metavar='SECONDS',
+                       help='timeout of ping')
+    group.add_argument('--dns-timeout', type=int, metavar='SECONDS',
+                       help='timeout of tasks (DNS stage)')
+    group.add_argument('--nameservers', metavar='NS[,NS...]',
+                       type=comma_list,
+                       help='DNS nameservers, comma separated')
+    group.add_argument('--dns-channels', type=int, metavar='N',
+                       help='resolver channels per nameserver [default: 2]')
+    group.add_argument('--dns-cache', action=argparse.BooleanOptionalAction,
+                       default=None,
+                       help='keep DNS answers in dns_cache.db for the next '
+                            'runs [default: on]')
+    group.add_argument('--shutdown-timeout', type=float, metavar='SECONDS',
+                       help='after ctrl+c the running probes get SECONDS '
+                            'seconds before they are abandoned [default: 5]')
+    group.add_argument('--loop', choices=('auto', 'asyncio', 'uvloop'),
+                       help='event loop of the scan, auto uses uvloop if it '
+                            'is installed [default: auto]')
+
+    group = parser.add_argument_group(
+        'filters',
+        'drop domains as soon as a stage disqualifies them, they are not '
+        'probed any further and not saved')
+    group.add_argument('--require-tls', type=comma_list,
+                       metavar='VERSION[,VERSION...]',
+                       help='keep only these TLS versions, e.g. TLSv1.3')
+    group.add_argument('--require-ipv6', action='store_true', default=None,
+                       help='keep only domains with an IPv6 address')
+    group.add_argument('--exclude-issuers', type=comma_list,
+                       metavar='ISSUER[,ISSUER...]',
+                       help='drop certificates of these issuer organizations')
+    group.add_argument('--exclude-asns', type=comma_list,
+                       metavar='ASN[,ASN...]',
+                       help='drop addresses of these ASNs, e.g. AS13335')
+    group.add_argument('--exclude-countries', type=comma_list,
+                       metavar='COUNTRY[,COUNTRY...]',
+                       help='drop addresses of these countries (ISO code or '
+                            'name)')
+
+    group = parser.add_argument_group(
+        'metrics',
+        'outcomes by error class, latency histograms, throughput and ETA of '
+        'the running scan')
+    group.add_argument('--stats-interval', type=float, metavar='SECONDS',
+                       help='rewrite stats.json every SECONDS seconds, 0 '
+                            'turns it off [default: 10]')
+    group.add_argument('--metrics-port', type=int, metavar='PORT',
+                       help='serve Prometheus metrics on '
+                            'http://127.0.0.1:PORT/metrics')
+    group.add_argument('--profile', nargs='?', const='lag',
+                       choices=('lag', 'cprofile', 'sample'),
+                       help='sample the event-loop lag, executor queues and '
+                            'in-flight counts; cprofile or sample also '
+                            'profile the run [default: lag]')
+
+    group = parser.add_argument_group('export')
+    group.add_argument('--export', type=comma_list, dest='export_formats',
+                       metavar='FORMAT[,FORMAT...]',
+                       help='export formats of output.db: csv, jsonl, '
+                            'parquet (needs pyarrow) [default: csv]')
+    group.add_argument('--incremental-export', action='store_true',
+                       default=None,
+                       help='append only the rows scanned since the last '
+                            'export')
+
+
+def load_config(config_path: str) -> dict:
+    """
+    Reads the options of a JSON config file.
+
+    Args:
+        config_path (str): Path of the config file.
+
+    Returns:
+        dict: The known options of the file.
+
+    Raises:
+        SystemExit: If the file can't be read or is not a JSON object.
+    """
+
+    try:
+        with open(config_path) as config_file:
+            config = json.load(config_file)
+    except (OSError, ValueError) as e:
+        print(f'| Config file could not be read > {e}')
+        exit(1)
+    if not isinstance(config, dict):
+        print('| Config file must contain a JSON object')
+        exit(1)
+
+    for key in config.keys() - DEFAULT_OPTIONS.keys():
+        print(f'| Unknown option in config file: {key}')
+    return {key: value for key, value in config.items()
+            if key in DEFAULT_OPTIONS}
+
+
+def headless_options(
+        args: argparse.Namespace,
+        domain_list_length: int | None) -> dict:
+    """
+    Builds the options without asking questions, for cron jobs, containers
+    and shard workers.
+
+    Args:
+        args (argparse.Namespace): The parsed flags, see
+            add_option_arguments().
+        domain_list_length (int | None): The number of lines of the input
+            file, or None if it is not known.
+
+    Returns:
+        dict: The same options as get_options() returns.
+    """
+
+    options = dict(DEFAULT_OPTIONS)
+    if args.config:
+        options.update(load_config(args.config))
+    for key in DEFAULT_OPTIONS:
+        value = getattr(args, key, None)
+        if value is not None:
+            options[key] = value
+
+    # The same corrections as the answers of get_options()
+    chunk = options['domain_chunk_len']
+    if chunk is not None:
+        if chunk < 0:
+            chunk = 0
+        elif domain_list_length is not None and chunk > domain_list_length:
+            chunk = domain_list_length
+    options['domain_chunk_len'] = chunk
+    options['resume_hours'] = max(0, options['resume_hours'])
+    options['active_tasks'] = max(0, options['active_tasks'])
+    if options['max_workers'] is not None:
+        options['max_workers'] = max(1, options['max_workers'])
+    options['ping_timeout'] = max(0, options['ping_timeout'])
+    if options['dns_timeout'] is None or options['dns_timeout'] < 0:
+        options['dns_timeout'] = (
+            options['ping_timeout'] + options['tls_timeout'] + 5)
+
+    return add_fixed_options(options)
@@ -0,0 +1,244 @@
+import time
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Iterator
+
+from metrics import Metrics, error_class
+
+
+"""
+Staged scan pipeline. Every stage has its own pool of worker coroutines (its
+concurrency limit) and its own timeout, and the stages are connected by
+bounded queues. A slow stage therefore doesn't starve the other ones, the
+work of different domains overlaps across the stages, and memory depends on
+the queue sizes and not on the number of domains.
+"""
+
+
+# Marks the end of the input of a queue
+_DONE = object()
+
+
+class Stage:
+    """
+    One stage of the pipeline.
+
+    Args:
+        name (str): Name of the stage, used in messages.
+        handler (Callable[[object, float | None], Awaitable]): Processes one
+            item and returns it for the next stage, or None to drop it. It
+            receives the timeout of the stage as its second argument.
+        concurrency (int): Number of items processed at the same time.
+        timeout (float | None): Timeout of one item, it is enforced by the
+            handler so a timeout can keep partial results.
+        errors (tuple[type[Exception], ...]): The expected failures of the
+            handler (network errors and timeouts by default), they drop the
+            item and are counted by error class. Any other exception is a
+            bug and fails the pipeline.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            handler: Callable[[object, float | None], Awaitable],
+            concurrency: int,
+            timeout: float | None = None,
+            errors: tuple[type[Exception], ...] = (
+                OSError, asyncio.TimeoutError)) -> None:
+        self.name = name
+        self.handler = handler
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.errors = errors
+        self.in_flight: int = 0
+
+
+class Pipeline:
+    """
+    Runs items through a list of stages.
+
+    The admitted items that are not finished are kept in inside, by
+    identity, so the handlers return the item they received. After stop()
+    or abort() they are the items that still have to be processed.
+
+    Args:
+        stages (list[Stage]): The stages in order.
+        queue_factor (int): Size of the queue in front of a stage as a
+            multiple of its concurrency.
+        metrics (Metrics | None): Receives the outcome and duration of
+            every handler call and every finished item.
+    """
+
+    def __init__(self, stages: list[Stage], queue_factor: int = 2,
+                 metrics: Metrics | None = None) -> None:
+        self.stages = stages
+        self.queue_factor = queue_factor
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.stages = stages
+        self.inside: set = set()
+        self.stopping: bool = False
+        self.aborted: bool = False
+        self._tasks: list[asyncio.Task] = list()
+
+    def stop(self) -> None:
+        """
+        Stops admitting new items, the admitted ones are still processed and
+        run() ends when they are finished.
+        """
+
+        self.stopping = True
+
+    def abort(self) -> None:
+        """
+        Stops at once, the running handlers are cancelled. Items that already
+        passed the last stage are still yielded by run(), the unfinished ones
+        stay in inside.
+        """
+
+        if self.aborted:
+            return
+        self.stopping = self.aborted = True
+        for task in self._tasks:
+            task.cancel()
+
+    async def run(self, items: Iterator) -> AsyncIterator:
+        """
+        Feeds the items lazily into the first stage.
+
+        Args:
+            items (Iterator): The items to process, the items that are not
+                admitted after stop() are left in it.
+
+        Yields:
+            The output of the last stage for every item that passed all of
+            them, and None for every item that was dropped by a stage. So
+            each admitted item yields exactly once, unless it is abandoned
+            by abort().
+
+        Raises:
+            asyncio.CancelledError: If a worker of the pipeline was cancelled
+            by something else than abort().
+            Exception: An unexpected exception of a handler, see
+            Stage.errors.
+        """
+
+        queues: list[asyncio.Queue] = [
+            asyncio.Queue(maxsize=stage.concurrency * self.queue_factor)
+            for stage in self.stages]
+        output: asyncio.Queue = asyncio.Queue(
+            maxsize=self.stages[-1].concurrency * self.queue_factor)
+        queues.append(output)
+
+        tasks = self._tasks = [
+            asyncio.create_task(self._feed(items, queues[0]))]
+        for index, stage in enumerate(self.stages):
+            workers = [
+                asyncio.create_task(
+                    self._work(stage, queues[index], queues[index + 1],
+                               output))
+                for _ in range(stage.concurrency)]
+            tasks.extend(workers)
+            next_workers = (self.stages[index + 1].concurrency
+                            if index + 1 < len(self.stages) else 1)
+            tasks.append(asyncio.create_task(
+                self._close(workers, queues[index + 1], next_workers)))
+
+        supervisor = asyncio.gather(*tasks)
+        try:
+            while True:
+                if output.empty():
+                    getter = asyncio.ensure_future(output.get())
+                    await asyncio.wait(
+                        {getter, supervisor},
+                        return_when=asyncio.FIRST_COMPLETED)
+                    if not getter.done():
+                        # A worker failed or was cancelled
+                        getter.cancel()
+                        if self.aborted:
+                            break
+                        supervisor.result()
+                        continue
+                    item = getter.result()
+                else:
+                    item = output.get_nowait()
+
+                if item is _DONE:
+                    break
+                if self.metrics is not None:
+                    self.metrics.complete()
+                yield item
+            if not self.aborted:
+                await supervisor
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Retrieves the exception so it is not reported as never retrieved
+            if supervisor.done() and not supervisor.cancelled():
+                supervisor.exception()
+
+    async def _feed(self, items: Iterator, queue: asyncio.Queue) -> None:
+        """
+        Puts the items into the first queue, waits while it is full. No item
+        is taken from items after stop().
+        """
+
+        while not self.stopping:
+            item = next(items, _DONE)
+            if item is _DONE:
+                break
+            self.inside.add(item)
+            await queue.put(item)
+        for _ in range(self.stages[0].concurrency):
+            await queue.put(_DONE)
+
+    async def _work(
+            self,
+            stage: Stage,
+            queue: asyncio.Queue,
+            next_queue: asyncio.Queue,
+            output: asyncio.Queue) -> None:
+        """Processes items of one stage until the end of its input."""
+
+        metrics = self.metrics
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                return
+
+            stage.in_flight += 1
+            started = time.perf_counter()
+            outcome = 'passed'
+            try:
+                result = await stage.handler(item, stage.timeout)
+            except stage.errors as e:
+                result = None
+                outcome = error_class(e)
+            finally:
+                stage.in_flight -= 1
+
+            if metrics is not None:
+                if result is None and outcome == 'passed':
+                    outcome = 'dropped'
+                metrics.count(stage.name, outcome)
+                metrics.observe(
+                    stage.name, (time.perf_counter() - started) * 1000)
+
+            if result is None:
+                self.inside.discard(item)
+                await output.put(None)
+            else:
+                await next_queue.put(result)
+                # A finished item leaves inside once it is in the output
+                if next_queue is output:
+                    self.inside.discard(item)
+
+    @staticmethod
+    async def _close(
+            workers: list[asyncio.Task],
+            next_queue: asyncio.Queue,
+            next_workers: int) -> None:
+        """Ends the input of the next stage when every worker is finished."""
+
+        await asyncio.gather(*workers)
+        for _ in range(next_workers):
+            await next_queue.put(_DONE)
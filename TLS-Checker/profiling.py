@@ -0,0 +1,284 @@
+import io
+import sys
+import json
+import time
+import asyncio
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterator
+
+from metrics import Histogram, Metrics, queue_depth
+from save_to_database import DatabaseWriter
+
+
+"""
+Profiling mode. A LoopMonitor samples the event-loop lag (how late a timer
+fires, i.e. how long the loop was blocked), the queue depth of the executors,
+the queued results of the DatabaseWriter and the in-flight counts of the
+stages. The whole run can also be wrapped in cProfile or in a sampling
+profiler that records the stacks of every thread. Everything is written as
+a report next to output.db.
+
+    profile-report.json  summary and timeline of the LoopMonitor
+    profile.txt          hot spots of cProfile or of the sampling profiler
+    profile.pstats       raw cProfile data (python -m pstats profile.pstats)
+    profile-stacks.txt   collapsed stacks of the sampling profiler, the input
+                         format of flamegraph.pl and speedscope
+"""
+
+
+PROFILE_MODES: tuple[str, ...] = ('lag', 'cprofile', 'sample')
+
+# Number of functions listed in profile.txt
+TOP_FUNCTIONS: int = 40
+
+# Top frames of threads that wait for work, they are not counted as hot
+# spots: idle pool workers, threads waiting on a lock or event and the
+# shutdown thread of pycares
+IDLE_FRAMES: tuple[str, ...] = (
+    '_worker (thread.py:', 'wait (threading.py:',
+    '_run_safe_shutdown_loop (')
+
+
+class LoopMonitor:
+    """
+    Samples the event loop while the scan is running. The samples are folded
+    into one timeline row per second, so the report of a long scan stays
+    small.
+
+    Args:
+        metrics (Metrics): The metrics of the scan, its stages and
+            executors are sampled and the lag is added to its latency
+            histograms as 'loop_lag'.
+        writer (DatabaseWriter | None): Its queue depth is sampled.
+        interval (float): Seconds between two samples.
+    """
+
+    def __init__(self, metrics: Metrics,
+                 writer: DatabaseWriter | None = None,
+                 interval: float = 0.1) -> None:
+        self.metrics = metrics
+        self.writer = writer
+        self.interval = interval
+        self.lag = Histogram()
+        self.max_lag: float = 0.0
+        self.timeline: list[dict] = list()
+        self._started: float = time.monotonic()
+        self._row: dict | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        """Starts sampling on the running loop."""
+
+        self._started = time.monotonic()
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        """Stops sampling and closes the current timeline row."""
+
+        if self._task is not None:
+            self._task.cancel()
+        if self._row is not None:
+            self.timeline.append(self._row)
+            self._row = None
+
+    async def _run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag_ms = max(
+                0.0, (time.perf_counter() - started - self.interval) * 1000)
+            self._sample(lag_ms)
+
+    def _sample(self, lag_ms: float) -> None:
+        """Adds one sample to the histograms and the timeline."""
+
+        self.lag.observe(lag_ms)
+        self.metrics.observe('loop_lag', lag_ms)
+        self.max_lag = max(self.max_lag, lag_ms)
+
+        second = int(time.monotonic() - self._started)
+        if self._row is not None and self._row['second'] != second:
+            self.timeline.append(self._row)
+            self._row = None
+        if self._row is None:
+            self._row = {'second': second, 'samples': 0, 'lag_max_ms': 0.0,
+                         'lag_sum_ms': 0.0}
+        row = self._row
+        row['samples'] += 1
+        row['lag_max_ms'] = round(max(row['lag_max_ms'], lag_ms), 2)
+        row['lag_sum_ms'] = round(row['lag_sum_ms'] + lag_ms, 2)
+        # The last sample of the second is kept for the gauges
+        row['completed'] = self.metrics.completed
+        row['in_flight'] = {
+            stage.name: stage.in_flight for stage in self.metrics.stages}
+        row['executor_queue'] = {
+            name: queue_depth(executor)
+            for name, executor in self.metrics.executors.items()}
+        if self.writer is not None:
+            row['writer_queue'] = self.writer.queued
+
+    def summary(self) -> dict:
+        """
+        Returns:
+            dict: Lag quantiles, the number of seconds the loop was blocked
+            for more than 100 ms, and the largest queue depths.
+        """
+
+        executor_queue: dict[str, int] = dict()
+        for row in self.timeline:
+            for name, depth in row['executor_queue'].items():
+                if depth is not None:
+                    executor_queue[name] = max(
+                        executor_queue.get(name, 0), depth)
+        return {
+            'samples': self.lag.count,
+            'lag_p50_ms': self.lag.quantile(0.5),
+            'lag_p99_ms': self.lag.quantile(0.99),
+            'lag_max_ms': round(self.max_lag, 2),
+            'blocked_seconds': sum(
+                1 for row in self.timeline if row['lag_max_ms'] > 100),
+            'max_executor_queue': executor_queue,
+            'max_writer_queue': max(
+                (row.get('writer_queue', 0) for row in self.timeline),
+                default=0),
+        }
+
+    def write_report(self, report_path: str) -> None:
+        """Writes the summary and the timeline as JSON."""
+
+        with open(report_path, 'w') as report_file:
+            json.dump({'summary': self.summary(), 'timeline': self.timeline},
+                      report_file, indent=1)
+
+
+class StackSampler:
+    """
+    Sampling profiler. A background thread records the stack of every other
+    thread every interval seconds, which costs far less than cProfile in a
+    long scan and also sees the executor threads.
+
+    Args:
+        interval (float): Seconds between two samples.
+    """
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        # Collapsed stack (thread;outer;...;inner) -> number of samples
+        self.stacks: Counter = Counter()
+        self.samples: int = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name
+                     for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                functions: list[str] = list()
+                while frame is not None:
+                    code = frame.f_code
+                    module = code.co_filename.rsplit('/', 1)[-1]
+                    functions.append(
+                        f'{code.co_name} ({module}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                functions.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(functions))] += 1
+            self.samples += 1
+
+    def write_stacks(self, stacks_path: str) -> None:
+        """Writes the collapsed stacks, one 'stack count' line each."""
+
+        with open(stacks_path, 'w') as stacks_file:
+            for stack, count in self.stacks.most_common():
+                stacks_file.write(f'{stack} {count}\n')
+
+    def hot_spots(self) -> str:
+        """
+        Returns:
+            str: The functions with the most samples on top of the stack
+            (self, see IDLE_FRAMES) and anywhere in the stack (total), per
+            thread.
+        """
+
+        own: Counter = Counter()
+        total: Counter = Counter()
+        for stack, count in self.stacks.items():
+            thread, *functions = stack.split(';')
+            if not functions:
+                continue
+            if not functions[-1].startswith(IDLE_FRAMES):
+                own[(thread, functions[-1])] += count
+            for function in set(functions):
+                total[(thread, function)] += count
+
+        lines = [f'{self.samples} samples every {self.interval * 1000:g} ms',
+                 '', 'self samples (function on top of the stack, idle '
+                 'threads are left out):']
+        lines += [f'{count:>8}  {thread}: {function}'
+                  for (thread, function), count in
+                  own.most_common(TOP_FUNCTIONS)]
+        lines += ['', 'total samples (function anywhere in the stack):']
+        lines += [f'{count:>8}  {thread}: {function}'
+                  for (thread, function), count in
+                  total.most_common(TOP_FUNCTIONS)]
+        return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def profiled(mode: str | None, stem: str) -> Iterator[None]:
+    """
+    Runs the body under cProfile or the sampling profiler and writes its
+    report, see the module docstring.
+
+    Args:
+        mode (str | None): One of PROFILE_MODES, 'lag' and None don't
+            profile the body (the LoopMonitor is started by the scan).
+        stem (str): Path of the report without extension, e.g.
+            '/path/profile'.
+    """
+
+    if mode == 'cprofile':
+        import pstats
+        import cProfile
+
+        # cProfile only sees the thread that enabled it, the event loop
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(stem + '.pstats')
+            text = io.StringIO()
+            stats = pstats.Stats(profiler, stream=text)
+            stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+            stats.sort_stats('tottime').print_stats(TOP_FUNCTIONS)
+            with open(stem + '.txt', 'w') as report_file:
+                report_file.write(text.getvalue())
+            print(f'\n| cProfile report saved to {stem}.txt ✓')
+    elif mode == 'sample':
+        sampler = StackSampler()
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            sampler.write_stacks(stem + '-stacks.txt')
+            with open(stem + '.txt', 'w') as report_file:
+                report_file.write(sampler.hot_spots())
+            print(f'\n| Sampling profiler report saved to {stem}.txt ✓')
+    else:
+        yield
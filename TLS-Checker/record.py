@@ -0,0 +1,65 @@
+"""
+Result record of one domain. It is created when the domain is read, every
+stage of the pipeline fills in its fields, and the DatabaseWriter turns it
+into rows. The fields live in __slots__, so a record needs no per-instance
+dictionary and every field is read as an attribute instead of a key.
+"""
+
+
+class ScanResult:
+    """
+    The scan result of one domain.
+
+    Attributes:
+        domain_name (str): The normalised domain name.
+        ipv4 (list[str] | None): The resolved IPv4 addresses.
+        ipv6 (list[str] | None): The resolved IPv6 addresses.
+        geo (list[list] | None): [asn, asn_organ, iso_code, country] of
+            every address, in the order of addresses().
+        tls_version (str | None): The negotiated TLS version.
+        cipher (str | None): The negotiated cipher.
+        issuer_organ (str | None): The issuer organization of the
+            certificate.
+        ping (float | None): The ICMP round trip time in milliseconds.
+        tcp_connect_ms (float | None): The TCP connect duration.
+        tls_handshake_ms (float | None): The TLS handshake duration.
+        scanned_at (int | None): Unix time of the TLS probe.
+    """
+
+    __slots__ = (
+        'domain_name', 'ipv4', 'ipv6', 'geo', 'tls_version', 'cipher',
+        'issuer_organ', 'ping', 'tcp_connect_ms', 'tls_handshake_ms',
+        'scanned_at')
+
+    def __init__(self, domain_name: str) -> None:
+        self.domain_name = domain_name
+        self.ipv4: list[str] | None = None
+        self.ipv6: list[str] | None = None
+        self.geo: list[list] | None = None
+        self.tls_version: str | None = None
+        self.cipher: str | None = None
+        self.issuer_organ: str | None = None
+        self.ping: float | None = None
+        self.tcp_connect_ms: float | None = None
+        self.tls_handshake_ms: float | None = None
+        self.scanned_at: int | None = None
+
+    def __repr__(self) -> str:
+        return f'ScanResult({self.domain_name!r})'
+
+    def addresses(self) -> list[str]:
+        """Returns the IPv4 addresses followed by the IPv6 addresses."""
+
+        return (self.ipv4 or []) + (self.ipv6 or [])
+
+    @property
+    def probed(self) -> str:
+        """The probed address, the first IPv4 if there is one."""
+
+        return (self.ipv4 or self.ipv6)[0]
+
+    @property
+    def probed_geo(self) -> list:
+        """The geo information of the probed address."""
+
+        return self.geo[0]
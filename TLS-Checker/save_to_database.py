@@ -1,17 +1,583 @@
 import os
+import time
 import sqlite3
+import asyncio
 from sys import exit
+from itertools import islice
+from typing import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import Metrics
+
+
+"""
+Schema of output.db. Every scan of a domain is kept as a row of 'scans'
+(its history), the resolved addresses with their geo information and the
+certificate issuers are stored once and referenced by id:
+
+    domains         one row per domain, last_scan_id points to its newest scan
+    addresses       one row per IP address with its ASN and country
+    certificates    one row per issuer organization
+    scans           one row per scan: probed address, certificate, TLS
+                    version, cipher and the typed latency columns
+    scan_addresses  the addresses a domain resolved to in a scan
+
+The views 'results' and 'address_geo' show the newest scan of every domain in
+the layout of the older versions.
+"""
 
 path = os.getcwd()
 
+# Seconds a connection waits for the lock of another writer, e.g. the other
+# shard processes writing into the same output.db
+BUSY_TIMEOUT: float = 60.0
+
+# Version of the schema in PRAGMA user_version, databases of older versions
+# (one 'results' row per domain) are migrated by create_table()
+SCHEMA_VERSION: int = 2
+
+# Tables, indexes, trigger and views of the schema
+SCHEMA: tuple[str, ...] = (
+    '''
+    CREATE TABLE IF NOT EXISTS domains (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    last_scan_id INTEGER
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS addresses (
+    id INTEGER PRIMARY KEY,
+    ip TEXT NOT NULL UNIQUE,
+    version INTEGER,
+    asn INTEGER,
+    asn_organ TEXT,
+    iso_code TEXT,
+    country TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS certificates (
+    id INTEGER PRIMARY KEY,
+    issuer_organ TEXT NOT NULL UNIQUE
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    domain_id INTEGER NOT NULL REFERENCES domains (id),
+    address_id INTEGER REFERENCES addresses (id),
+    certificate_id INTEGER REFERENCES certificates (id),
+    tls_version TEXT,
+    cipher TEXT,
+    ping_ms REAL,
+    tcp_connect_ms REAL,
+    tls_handshake_ms REAL,
+    scanned_at INTEGER
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS scan_addresses (
+    scan_id INTEGER NOT NULL REFERENCES scans (id),
+    address_id INTEGER NOT NULL REFERENCES addresses (id),
+    PRIMARY KEY (scan_id, address_id)
+    ) WITHOUT ROWID
+    ''',
+    # History of a domain
+    'CREATE INDEX IF NOT EXISTS scans_domain ON scans (domain_id, scanned_at)',
+    'CREATE INDEX IF NOT EXISTS scans_scanned_at ON scans (scanned_at)',
+    'CREATE INDEX IF NOT EXISTS scans_tls_version ON scans (tls_version)',
+    'CREATE INDEX IF NOT EXISTS scans_address ON scans (address_id)',
+    'CREATE INDEX IF NOT EXISTS scans_certificate ON scans (certificate_id)',
+    'CREATE INDEX IF NOT EXISTS addresses_asn ON addresses (asn)',
+    'CREATE INDEX IF NOT EXISTS addresses_iso_code ON addresses (iso_code)',
+    'CREATE INDEX IF NOT EXISTS addresses_country ON addresses (country)',
+    'CREATE INDEX IF NOT EXISTS domains_last_scan ON domains (last_scan_id)',
+    # Keeps last_scan_id on the newest scan, also when older scans are
+    # merged later
+    '''
+    CREATE TRIGGER IF NOT EXISTS scans_latest AFTER INSERT ON scans
+    BEGIN
+        UPDATE domains SET last_scan_id = NEW.id
+        WHERE id = NEW.domain_id AND (
+            last_scan_id IS NULL OR
+            (SELECT coalesce(scanned_at, 0) FROM scans
+             WHERE id = last_scan_id) <= coalesce(NEW.scanned_at, 0));
+    END
+    ''',
+    '''
+    CREATE VIEW IF NOT EXISTS results AS
+    SELECT
+        d.name AS domain_name,
+        (SELECT group_concat(a.ip, ',') FROM scan_addresses sa
+         JOIN addresses a ON a.id = sa.address_id
+         WHERE sa.scan_id = s.id AND a.version = 4) AS ipv4,
+        (SELECT group_concat(a.ip, ',') FROM scan_addresses sa
+         JOIN addresses a ON a.id = sa.address_id
+         WHERE sa.scan_id = s.id AND a.version = 6) AS ipv6,
+        p.asn AS asn,
+        p.asn_organ AS asn_organ,
+        p.iso_code AS iso_code,
+        p.country AS country,
+        s.cipher AS cipher,
+        s.tls_version AS tls_version,
+        c.issuer_organ AS issuer_organ,
+        s.ping_ms AS ping,
+        s.tcp_connect_ms AS tcp_connect_ms,
+        s.tls_handshake_ms AS tls_handshake_ms,
+        s.scanned_at AS scanned_at
+    FROM domains d
+    JOIN scans s ON s.id = d.last_scan_id
+    LEFT JOIN addresses p ON p.id = s.address_id
+    LEFT JOIN certificates c ON c.id = s.certificate_id
+    ''',
+    '''
+    CREATE VIEW IF NOT EXISTS address_geo AS
+    SELECT
+        d.name AS domain_name,
+        a.ip AS ip,
+        a.asn AS asn,
+        a.asn_organ AS asn_organ,
+        a.iso_code AS iso_code,
+        a.country AS country
+    FROM domains d
+    JOIN scan_addresses sa ON sa.scan_id = d.last_scan_id
+    JOIN addresses a ON a.id = sa.address_id
+    ''',
+)
+
+# Insert statement of each table written by the DatabaseWriter, in the order
+# they have to run. Scans reference the other tables by their natural keys,
+# the rows of scan_addresses reference their scan by its index in the rows of
+# scans (see write_rows).
+INSERTS: dict[str, str] = {
+    'domains': '''
+        INSERT OR IGNORE INTO domains (name) VALUES (?)
+    ''',
+    'addresses': '''
+        INSERT INTO addresses (
+            ip,
+            version,
+            asn,
+            asn_organ,
+            iso_code,
+            country
+        ) VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (ip) DO UPDATE SET
+            asn = excluded.asn,
+            asn_organ = excluded.asn_organ,
+            iso_code = excluded.iso_code,
+            country = excluded.country
+    ''',
+    'certificates': '''
+        INSERT OR IGNORE INTO certificates (issuer_organ) VALUES (?)
+    ''',
+    'scans': '''
+        INSERT INTO scans (
+            domain_id,
+            address_id,
+            certificate_id,
+            tls_version,
+            cipher,
+            ping_ms,
+            tcp_connect_ms,
+            tls_handshake_ms,
+            scanned_at
+        ) VALUES (
+            (SELECT id FROM domains WHERE name = ?),
+            (SELECT id FROM addresses WHERE ip = ?),
+            (SELECT id FROM certificates WHERE issuer_organ = ?),
+            ?, ?, ?, ?, ?, ?)
+    ''',
+    'scan_addresses': '''
+        INSERT OR IGNORE INTO scan_addresses (scan_id, address_id) VALUES (
+            ?, (SELECT id FROM addresses WHERE ip = ?))
+    ''',
+}
+
+# Fills in the geo information of an address without overwriting it, used
+# for data of older versions that only has it for some addresses
+FILL_ADDRESS: str = '''
+    INSERT INTO addresses (
+        ip,
+        version,
+        asn,
+        asn_organ,
+        iso_code,
+        country
+    ) VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (ip) DO UPDATE SET
+        asn = coalesce(asn, excluded.asn),
+        asn_organ = coalesce(asn_organ, excluded.asn_organ),
+        iso_code = coalesce(iso_code, excluded.iso_code),
+        country = coalesce(country, excluded.country)
+'''
+
+# Columns added to the results table of version 1 after its first release,
+# they are added before such a table is migrated
+ADDED_COLUMNS: dict[str, str] = {
+    'tcp_connect_ms': 'REAL',
+    'tls_handshake_ms': 'REAL',
+    'scanned_at': 'INTEGER',
+}
+
+
+def ip_version(ip: str) -> int:
+    """Returns 6 for an IPv6 and 4 for an IPv4 address."""
+
+    return 6 if ':' in ip else 4
+
+
+def create_table(cur: sqlite3.Cursor) -> None:
+    """
+    Creates the tables, indexes and views of the schema if they don't exist
+    and migrates a database of an older version. The migration runs in a
+    transaction that is committed by the caller.
+
+    Args:
+        cur (sqlite3.Cursor): The cursor object for executing SQL queries.
+    """
+
+    cur.execute('PRAGMA user_version')
+    if cur.fetchone()[0] >= SCHEMA_VERSION:
+        return
+
+    # Another process may be creating or migrating it at the same time
+    if not cur.connection.in_transaction:
+        cur.execute('BEGIN IMMEDIATE')
+    cur.execute('PRAGMA user_version')
+    if cur.fetchone()[0] >= SCHEMA_VERSION:
+        return
+
+    cur.execute('''
+        SELECT name FROM sqlite_master
+        WHERE type = 'table' AND name IN ('results', 'address_geo')
+    ''')
+    legacy: set[str] = {row[0] for row in cur.fetchall()}
+    '''Version 1 replaced the rows of a domain at every save, so the last
+    change of the file is the scan time of its newest rows, and an upper
+    bound for the others; it is read before the migration changes it'''
+    legacy_time: int | None = None
+    cur.execute('PRAGMA database_list')
+    for _, name, file in cur.fetchall():
+        if name == 'main' and file and os.path.isfile(file):
+            legacy_time = int(os.path.getmtime(file))
+    for table in legacy:
+        cur.execute(f'ALTER TABLE {table} RENAME TO {table}_v1')
+
+    for statement in SCHEMA:
+        cur.execute(statement)
+
+    if 'results' in legacy:
+        migrate_v1(cur, 'address_geo' in legacy, legacy_time)
+    for table in legacy:
+        cur.execute(f'DROP TABLE {table}_v1')
+
+    cur.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+
+def migrate_v1(cur: sqlite3.Cursor, address_geo: bool,
+               legacy_time: int | None = None) -> None:
+    """
+    Moves the rows of the version 1 tables (renamed to results_v1 and
+    address_geo_v1) into the normalized tables, every row becomes the only
+    scan of its domain.
+
+    Args:
+        cur (sqlite3.Cursor): The cursor object for executing SQL queries.
+        address_geo (bool): Whether the address_geo_v1 table exists.
+        legacy_time (int | None): The scan time of the rows without one
+            (version 1 didn't keep it), see create_table().
+    """
+
+    print('| Migrating output.db to the normalized schema ...')
+    cur.execute('PRAGMA table_info(results_v1)')
+    columns: set[str] = {row[1] for row in cur.fetchall()}
+    for column, column_type in ADDED_COLUMNS.items():
+        if column not in columns:
+            cur.execute(
+                f'ALTER TABLE results_v1 ADD COLUMN {column} {column_type}')
+
+    if address_geo:
+        cur.execute('''
+            INSERT INTO addresses (
+                ip, version, asn, asn_organ, iso_code, country)
+            SELECT ip, CASE WHEN instr(ip, ':') THEN 6 ELSE 4 END,
+                asn, asn_organ, iso_code, country
+            FROM address_geo_v1 WHERE true
+            ON CONFLICT (ip) DO NOTHING
+        ''')
+
+    con = cur.connection
+    rows = con.execute('''
+        SELECT domain_name, ipv4, ipv6, asn, asn_organ, iso_code, country,
+            cipher, tls_version, issuer_organ, ping, tcp_connect_ms,
+            tls_handshake_ms, scanned_at
+        FROM results_v1
+    ''')
+    while batch := rows.fetchmany(1000):
+        tables: dict[str, list[tuple]] = {table: list() for table in INSERTS}
+        for (domain_name, ipv4, ipv6, asn, asn_organ, iso_code, country,
+             cipher, tls_version, issuer_organ, ping, tcp_connect_ms,
+             tls_handshake_ms, scanned_at) in batch:
+            addresses = [
+                ip for ip in f'{ipv4 or ""},{ipv6 or ""}'.split(',') if ip]
+            probed = addresses[0] if addresses else None
+            try:
+                ping_ms = float(ping) if ping is not None else None
+            except ValueError:
+                ping_ms = None
+
+            tables['domains'].append((domain_name,))
+            # Version 1 only stored the geo information of the probed address
+            tables['addresses'].extend(
+                (ip, ip_version(ip),
+                 *((asn, asn_organ, iso_code, country) if ip == probed
+                   else (None, None, None, None)))
+                for ip in addresses)
+            if issuer_organ is not None:
+                tables['certificates'].append((issuer_organ,))
+            tables['scan_addresses'].extend(
+                (len(tables['scans']), ip) for ip in addresses)
+            tables['scans'].append(
+                (domain_name, probed, issuer_organ, tls_version, cipher,
+                 ping_ms, tcp_connect_ms, tls_handshake_ms,
+                 legacy_time if scanned_at is None else scanned_at))
+        write_rows(con, tables, {'addresses': FILL_ADDRESS})
+
+
+def write_rows(
+        con: sqlite3.Connection,
+        tables: dict[str, list[tuple]],
+        inserts: dict[str, str] | None = None) -> None:
+    """
+    Inserts rows of the tables in the order of INSERTS. The scans are
+    inserted one by one, so every scan_addresses row is linked to the id of
+    its own scan, also when a batch has several scans of one domain or
+    older scans than the newest one of the domain.
+
+    Args:
+        con (sqlite3.Connection): The connection, the caller commits.
+        tables (dict[str, list[tuple]]): The rows of each table, the rows of
+            scan_addresses are (index of the scan in the rows of scans, ip).
+        inserts (dict[str, str] | None): Statements used instead of the ones
+            of INSERTS.
+    """
+
+    scan_ids: list[int] = list()
+    for table, query in INSERTS.items():
+        rows = tables.get(table)
+        if not rows:
+            continue
+        query = (inserts or {}).get(table, query)
+        if table == 'scans':
+            scan_ids = [con.execute(query, row).lastrowid for row in rows]
+        elif table == 'scan_addresses':
+            con.executemany(query, ((scan_ids[index], ip)
+                                    for index, ip in rows))
+        else:
+            con.executemany(query, rows)
+
+
+def init_database() -> None:
+    """
+    Creates or upgrades the tables of 'output.db' and switches it to WAL mode,
+    so processes that write into it at the same time don't race on that.
+    """
+
+    try:
+        con = sqlite3.connect(os.path.join(path, 'output.db'),
+                              timeout=BUSY_TIMEOUT)
+        con.execute('PRAGMA journal_mode=WAL')
+        create_table(con.cursor())
+        con.commit()
+    except sqlite3.Error as e:
+        print(f'| init_database > {e}')
+        exit(1)
+    else:
+        con.close()
+
+
+def iter_scans(con: sqlite3.Connection) -> Iterator[tuple]:
+    """
+    Streams the scans of an attached 'shard' database with the natural keys
+    of the rows they reference.
+
+    Yields:
+        tuple: The id of the scan followed by the values of INSERTS['scans'].
+    """
+
+    yield from con.execute('''
+        SELECT s.id, d.name, a.ip, c.issuer_organ, s.tls_version, s.cipher,
+            s.ping_ms, s.tcp_connect_ms, s.tls_handshake_ms, s.scanned_at
+        FROM shard.scans s
+        JOIN shard.domains d ON d.id = s.domain_id
+        LEFT JOIN shard.addresses a ON a.id = s.address_id
+        LEFT JOIN shard.certificates c ON c.id = s.certificate_id
+        ORDER BY s.id
+    ''')
+
+
+def merge_databases(sources: list[str]) -> int:
+    """
+    Merges the scans of other 'output.db' files, e.g. of shards scanned on
+    other machines, into 'output.db'. Databases of older versions are
+    migrated first. Scans that are already there (same domain, address and
+    scan time) are skipped, so merging a database twice doesn't duplicate
+    them.
+
+    Args:
+        sources (list[str]): Paths of the databases to merge.
+
+    Returns:
+        int: The number of merged scans.
+    """
+
+    merged = 0
+    con = sqlite3.connect(os.path.join(path, 'output.db'),
+                          timeout=BUSY_TIMEOUT)
+    try:
+        create_table(con.cursor())
+        con.commit()
+        for source in sources:
+            if not os.path.isfile(source):
+                print(f'| There is no such database: {source}')
+                continue
+            source_con = sqlite3.connect(source, timeout=BUSY_TIMEOUT)
+            create_table(source_con.cursor())
+            source_con.commit()
+            source_con.close()
+
+            con.execute('ATTACH DATABASE ? AS shard', (source,))
+            try:
+                with con:
+                    con.execute('''
+                        INSERT OR IGNORE INTO main.domains (name)
+                        SELECT name FROM shard.domains
+                    ''')
+                    con.execute('''
+                        INSERT INTO main.addresses (
+                            ip, version, asn, asn_organ, iso_code, country)
+                        SELECT ip, version, asn, asn_organ, iso_code, country
+                        FROM shard.addresses WHERE true
+                        ON CONFLICT (ip) DO UPDATE SET
+                            asn = coalesce(excluded.asn, asn),
+                            asn_organ = coalesce(excluded.asn_organ,
+                                                 asn_organ),
+                            iso_code = coalesce(excluded.iso_code, iso_code),
+                            country = coalesce(excluded.country, country)
+                    ''')
+                    con.execute('''
+                        INSERT OR IGNORE INTO main.certificates (issuer_organ)
+                        SELECT issuer_organ FROM shard.certificates
+                    ''')
+
+                    # Scan ids of the shard -> scan ids of output.db
+                    scan_ids: dict[int, int] = dict()
+                    for shard_id, *scan in iter_scans(con):
+                        if con.execute('''
+                            SELECT 1 FROM main.scans s
+                            JOIN main.domains d ON d.id = s.domain_id
+                            WHERE d.name = ? AND s.scanned_at IS ? AND
+                                s.address_id IS (
+                                    SELECT id FROM main.addresses
+                                    WHERE ip = ?)
+                        ''', (scan[0], scan[-1], scan[1])).fetchone():
+                            continue
+                        scan_ids[shard_id] = con.execute(
+                            INSERTS['scans'], scan).lastrowid
+
+                    con.executemany('''
+                        INSERT OR IGNORE INTO main.scan_addresses (
+                            scan_id, address_id)
+                        VALUES (?, (SELECT id FROM main.addresses
+                                    WHERE ip = ?))
+                    ''', (
+                        (scan_ids[scan_id], ip)
+                        for scan_id, ip in con.execute('''
+                            SELECT sa.scan_id, a.ip
+                            FROM shard.scan_addresses sa
+                            JOIN shard.addresses a ON a.id = sa.address_id
+                        ''') if scan_id in scan_ids))
+                    merged += len(scan_ids)
+            finally:
+                con.execute('DETACH DATABASE shard')
+            print(f'| Merged {os.path.basename(source)} ✓')
+    except sqlite3.Error as e:
+        print(f'| merge_databases > {e}')
+        exit(1)
+    finally:
+        con.close()
+    return merged
+
 
-def save(query_data: list[tuple]) -> None:
+def skip_fresh(
+        domains: Iterable[str],
+        max_age: float,
+        metrics: Metrics | None = None,
+        batch_size: int = 500) -> Iterator[str]:
+    """
+    Drops the domains that were scanned within the freshness window (resume
+    mode). The names are looked up in batches by the unique index of
+    domains.name and the newest scan of each domain, so memory doesn't grow
+    with the history in output.db.
+
+    Args:
+        domains (Iterable[str]): The domains of the input.
+        max_age (float): The freshness window in hours.
+        metrics (Metrics | None): Counts the dropped domains as the 'input'
+            outcome 'fresh'.
+        batch_size (int): Number of names looked up in one query.
+
+    Yields:
+        str: The domains that were not scanned within the last max_age
+        hours, in input order.
+    """
+
+    db_path = os.path.join(path, 'output.db')
+    if max_age <= 0 or not os.path.isfile(db_path):
+        yield from domains
+        return
+
+    try:
+        con = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT)
+        create_table(con.cursor())
+        con.commit()
+    except sqlite3.Error as e:
+        print(f'| skip_fresh > {e}')
+        exit(1)
+
+    since = int(time.time() - max_age * 3600)
+    domains = iter(domains)
+    try:
+        while batch := list(islice(domains, batch_size)):
+            try:
+                cur = con.execute(f'''
+                    SELECT d.name FROM domains d
+                    JOIN scans s ON s.id = d.last_scan_id
+                    WHERE d.name IN ({','.join('?' * len(batch))})
+                        AND s.scanned_at >= ?
+                ''', (*batch, since))
+                fresh: set[str] = {row[0] for row in cur}
+            except sqlite3.Error as e:
+                print(f'| skip_fresh > {e}')
+                exit(1)
+            for domain_name in batch:
+                if domain_name not in fresh:
+                    yield domain_name
+                elif metrics is not None:
+                    metrics.count('input', 'fresh')
+    finally:
+        con.close()
+
+
+def save(tables: dict[str, list[tuple]]) -> None:
     """
     Saves the retrieved data into a SQLite database.
 
     Args:
-        query_data (list): A list of tuples containing the retrieved
-        data for each domain.
+        tables (dict[str, list[tuple]]): The rows of each table, keyed by
+        the table name (see INSERTS).
 
     Returns:
         None
@@ -19,60 +585,19 @@ def save(query_data: list[tuple]) -> None:
     Notes:
         The function creates or connects to a SQLite database named 'output.db'
         in the current working directory.
-        It creates a table named 'results' if it doesn't exist,
-        with the following schema:
-            - domain_name TEXT PRIMARY KEY
-            - ipv4 TEXT
-            - ipv6 TEXT
-            - asn INTEGER
-            - asn_organ TEXT
-            - iso_code INTEGER
-            - country TEXT
-            - cipher TEXT
-            - tls_version TEXT
-            - issuer_organ TEXT
-            - ping TEXT
-        The function then inserts or replaces rows in the 'results' table with
-        the data provided in query_data.
+        It creates the tables of the schema if they don't exist (see
+        SCHEMA), databases of older versions are migrated.
+        The function then inserts the rows, every scan is added to the
+        history of its domain.
         If an error occurs during the database operation, the function prints
         an error message and exits with status code 1.
     """
 
     try:
-        con = sqlite3.connect(os.path.join(path, 'output.db'))
-        cur = con.cursor()
-
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS results (
-            domain_name TEXT PRIMARY KEY,
-            ipv4 TEXT,
-            ipv6 TEXT,
-            asn INTEGER,
-            asn_organ TEXT,
-            iso_code INTEGER,
-            country TEXT,
-            cipher TEXT,
-            tls_version TEXT,
-            issuer_organ TEXT,
-            ping TEXT
-            )
-        ''')
-
-        cur.executemany('''
-            INSERT OR REPLACE INTO results (
-                domain_name,
-                ipv4,
-                ipv6,
-                asn,
-                asn_organ,
-                iso_code,
-                country,
-                cipher,
-                tls_version,
-                issuer_organ,
-                ping
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', query_data)
+        con = sqlite3.connect(os.path.join(path, 'output.db'),
+                              timeout=BUSY_TIMEOUT)
+        create_table(con.cursor())
+        write_rows(con, tables)
     except Exception as e:
         print(f'Database connection was failed: {e}')
         exit(1)
@@ -80,3 +605,183 @@ def save(query_data: list[tuple]) -> None:
         con.commit()
         if con:
             con.close()
+
+
+class DatabaseWriter:
+    """
+    Streams results into 'output.db' while the scan is running.
+
+    Results are put into a bounded queue and a background task drains it,
+    writing a batch every batch_size rows or every flush_interval seconds,
+    whichever comes first. The batches are written by a single thread that
+    owns one long-lived connection in WAL mode, so the event loop never waits
+    for the disk and every committed batch survives a crash of the scan.
+
+    Args:
+        prepare (Callable[[list], dict[str, list[tuple]]] | None): Converts
+            a batch of queued results into rows, keyed by the table name (see
+            INSERTS). It runs in the writer thread. Queued items are used as
+            such rows if it is None.
+        batch_size (int): Number of rows written in one transaction.
+        flush_interval (float): Maximum seconds a queued row waits before
+            it is written.
+        max_queue (int): Maximum number of queued results, put() waits when
+            the queue is full.
+        metrics (Metrics | None): Receives the duration of every
+            batch and the number of saved scans.
+    """
+
+    def __init__(
+            self,
+            prepare: Callable[[list], dict[str, list[tuple]]] | None = None,
+            batch_size: int = 500,
+            flush_interval: float = 0.5,
+            max_queue: int = 10_000,
+            metrics: Metrics | None = None) -> None:
+        self.prepare = prepare
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.metrics = metrics
+        self.written: int = 0
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='database-writer')
+        self._con: sqlite3.Connection | None = None
+        self._task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        """
+        Opens the connection in the writer thread and starts draining the
+        queue.
+        """
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._connect)
+        self._task = asyncio.create_task(self._run())
+
+    @property
+    def task(self) -> asyncio.Task | None:
+        """The background task that drains the queue."""
+
+        return self._task
+
+    @property
+    def queued(self) -> int:
+        """The number of results waiting to be written."""
+
+        return self._queue.qsize()
+
+    async def put(self, result) -> None:
+        """
+        Queues one result, waits while the queue is full.
+
+        Args:
+            result: One result, it is converted to a row by prepare.
+
+        Raises:
+            RuntimeError: If the writer is not running anymore, also when it
+            fails while put() waits for room in the queue.
+        """
+
+        task = self._task
+        if task is None or task.done():
+            raise RuntimeError('database writer is not running')
+        if not self._queue.full():
+            self._queue.put_nowait(result)
+            return
+
+        '''A full queue only drains while the writer runs, so the wait ends
+        when the writer fails too'''
+        putter = asyncio.ensure_future(self._queue.put(result))
+        try:
+            await asyncio.wait(
+                {putter, task}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not putter.done():
+                putter.cancel()
+        if not putter.done() or putter.cancelled():
+            error = None if task.cancelled() else task.exception()
+            raise RuntimeError('database writer is not running') from error
+
+    async def close(self) -> None:
+        """
+        Writes all queued results and closes the connection.
+        """
+
+        loop = asyncio.get_running_loop()
+        try:
+            if self._task is not None and not self._task.done():
+                await self._queue.put(None)
+                await self._task
+        finally:
+            await loop.run_in_executor(self._executor, self._disconnect)
+            self._executor.shutdown(wait=True)
+
+    def _connect(self) -> None:
+        """Opens the long-lived connection, runs in the writer thread."""
+
+        self._con = sqlite3.connect(os.path.join(path, 'output.db'),
+                                    timeout=BUSY_TIMEOUT)
+        self._con.execute('PRAGMA journal_mode=WAL')
+        self._con.execute('PRAGMA synchronous=NORMAL')
+        create_table(self._con.cursor())
+        self._con.commit()
+
+    def _disconnect(self) -> None:
+        """Closes the connection, runs in the writer thread."""
+
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+
+    def _write(self, batch: list) -> None:
+        """Writes one batch in one transaction, runs in the writer thread."""
+
+        # The scan indexes of scan_addresses are local to their item
+        batches = [self.prepare(batch)] if self.prepare else batch
+        started = time.perf_counter()
+        with self._con:
+            for tables in batches:
+                write_rows(self._con, tables)
+        self.written += sum(len(tables.get('scans', [])) for tables in batches)
+        if self.metrics is not None:
+            self.metrics.observe(
+                'db_write', (time.perf_counter() - started) * 1000)
+            self.metrics.saved = self.written
+
+    async def _run(self) -> None:
+        """
+        Drains the queue in batches until the closing sentinel arrives.
+        """
+
+        loop = asyncio.get_running_loop()
+        closing = False
+        while not closing:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch: list = [item]
+            deadline = loop.time() + self.flush_interval
+
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(
+                            self._queue.get(), timeout=timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+
+            try:
+                await loop.run_in_executor(self._executor, self._write, batch)
+            except Exception as e:
+                print(f'\n| Database writer was failed: {e}')
+                raise
@@ -0,0 +1,129 @@
+import zlib
+import multiprocessing
+from sys import exit
+from typing import Callable, Iterable, Iterator
+
+
+"""
+Sharded scanning. The input is split by a stable hash of the domain name into
+N shards, so every process or machine scans a disjoint part of the list with
+its own event loop. Local shard processes write into the same 'output.db'
+(WAL mode), shards of other machines are merged with merge_databases().
+"""
+
+
+def shard_of(domain_name: str, shards: int) -> int:
+    """
+    Returns the shard of a domain. The hash doesn't depend on the process
+    (unlike hash()), so every process and machine agrees on it.
+
+    Args:
+        domain_name (str): The normalised domain name.
+        shards (int): The number of shards.
+
+    Returns:
+        int: The shard index in [0, shards).
+    """
+
+    return zlib.crc32(domain_name.encode()) % shards
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """
+    Parses a '--shard i/N' value, i counts from 1.
+
+    Args:
+        value (str): The value, e.g. '2/8'.
+
+    Returns:
+        tuple[int, int]: The zero-based shard index and the number of shards.
+
+    Raises:
+        SystemExit: If the value is not valid.
+    """
+
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        print(f'| Invalid shard "{value}", expected i/N e.g. 1/4')
+        exit(1)
+    if not 1 <= index <= count:
+        print(f'| Invalid shard "{value}", i must be between 1 and N')
+        exit(1)
+    return index - 1, count
+
+
+def filter_shard(
+        domains: Iterable[str],
+        shard: tuple[int, int]) -> Iterator[str]:
+    """
+    Streams the domains of one shard.
+
+    Args:
+        domains (Iterable[str]): All domains.
+        shard (tuple[int, int]): The shard index and the number of shards.
+
+    Yields:
+        str: The domains that belong to the shard.
+    """
+
+    index, count = shard
+    for domain_name in domains:
+        if shard_of(domain_name, count) == index:
+            yield domain_name
+
+
+def shard_share(total: int | None, shard: tuple[int, int]) -> int | None:
+    """
+    Splits a number of domains (the chunk length) between the shards.
+
+    Args:
+        total (int | None): The number of domains of all shards, None means
+            all of them.
+        shard (tuple[int, int]): The shard index and the number of shards.
+
+    Returns:
+        int | None: The number of domains of this shard.
+    """
+
+    if total is None:
+        return None
+    index, count = shard
+    return total // count + (1 if index < total % count else 0)
+
+
+def run_local_shards(target: Callable, count: int, *args) -> list[int]:
+    """
+    Runs target(*args, (index, count)) in one process per shard and waits for
+    all of them. The processes are spawned, so every shard starts a fresh
+    interpreter with its own event loop and GIL.
+
+    Args:
+        target (Callable): The function that scans one shard.
+        count (int): The number of shards (processes).
+        *args: The arguments passed to target before the shard.
+
+    Returns:
+        list[int]: The exit codes of the shard processes.
+    """
+
+    context = multiprocessing.get_context('spawn')
+    processes = [
+        context.Process(target=target, args=(*args, (index, count)),
+                        name=f'shard-{index + 1}-of-{count}')
+        for index in range(count)]
+    for process in processes:
+        process.start()
+
+    for process in processes:
+        # Every shard handles ctrl+c itself, the parent keeps waiting for
+        # them to save their data
+        while True:
+            try:
+                process.join()
+            except KeyboardInterrupt:
+                continue
+            break
+        if process.exitcode != 0:
+            print(f'| {process.name} exited with code {process.exitcode}')
+    return [process.exitcode for process in processes]
@@ -0,0 +1,11 @@
+import os
+import sys
+
+
+"""
+The modules of TLS-Checker are flat scripts, the tests import them from the
+parent directory like main.py does.
+"""
+
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,47 @@
+import time
+import asyncio
+
+import main
+from adaptive import AdaptiveLimiter
+from dns_cache import CachingResolver
+from aiodns.error import ARES_ENOTFOUND
+
+
+def feed_window(limiter: AdaptiveLimiter, latency_ms: float) -> None:
+    for _ in range(limiter.min_samples):
+        limiter.record(timed_out=False, latency_ms=latency_ms)
+
+
+def test_limit_recovers_after_a_window_of_cache_hits():
+    limiter = AdaptiveLimiter(100, maximum=1000, interval=0)
+    feed_window(limiter, 0.01)
+    for _ in range(15):
+        feed_window(limiter, 20)
+
+    assert limiter.limit > 100
+
+
+def test_lasting_congestion_still_shrinks_the_limit():
+    limiter = AdaptiveLimiter(100, maximum=1000, interval=0)
+    feed_window(limiter, 20)
+    healthy = limiter.limit
+    feed_window(limiter, 200)
+
+    assert limiter.limit < healthy
+
+
+def test_warm_cache_answers_are_not_recorded():
+    async def resolve_all() -> list:
+        resolver = CachingResolver(nameservers=['127.0.0.1:9'])
+        expires = time.time() + 600
+        resolver._store(('cached.example', 'A'), expires, ('192.0.2.1',))
+        resolver._store(('missing.example', 'A'), expires, ARES_ENOTFOUND)
+        return [
+            await main.resolve(resolver, name, 'A', 1, limiter)
+            for name in ('cached.example', 'missing.example')]
+
+    limiter = AdaptiveLimiter(100, interval=0, min_samples=1)
+
+    assert asyncio.run(resolve_all()) == [['192.0.2.1'], None]
+    assert limiter.limit == 100
+    assert limiter._outcomes == 0
@@ -0,0 +1,59 @@
+import sqlite3
+
+import pytest
+
+import main
+import csv_convertor
+from record import ScanResult
+from save_to_database import create_table, write_rows
+
+
+def add_scan(database_path: str, domain_name: str) -> None:
+    record = ScanResult(domain_name)
+    record.ipv4 = ['192.0.2.1']
+    record.geo = [[64496, 'Example', 'ZZ', 'Nowhere']]
+    record.tls_version = 'TLSv1.3'
+    record.scanned_at = 1
+
+    con = sqlite3.connect(database_path)
+    with con:
+        create_table(con.cursor())
+        write_rows(con, main.extract_results([record]))
+    con.close()
+
+
+def data_rows(csv_path) -> int:
+    return len(csv_path.read_text().splitlines()) - 1
+
+
+def test_failed_export_keeps_its_position(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    database_path = str(tmp_path / 'output.db')
+    scans_csv = tmp_path / 'csv' / 'scans.csv'
+    add_scan(database_path, 'one.example')
+    csv_convertor.convertor(database_path, ('csv',), True)
+    assert csv_convertor.load_state() == {'csv': 1}
+
+    add_scan(database_path, 'two.example')
+    before = scans_csv.read_bytes()
+    iter_batches = csv_convertor.iter_batches
+
+    def failing(cur):
+        yield from iter_batches(cur)
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(csv_convertor, 'iter_batches', failing)
+    with pytest.raises(SystemExit) as exit_info:
+        csv_convertor.convertor(database_path, ('csv',), True)
+
+    assert exit_info.value.code == 1
+    assert csv_convertor.load_state() == {'csv': 1}
+    # The partly appended rows are removed again
+    assert scans_csv.read_bytes() == before
+
+    monkeypatch.setattr(csv_convertor, 'iter_batches', iter_batches)
+    csv_convertor.convertor(database_path, ('csv',), True)
+
+    assert csv_convertor.load_state() == {'csv': 2}
+    assert data_rows(scans_csv) == 2
+    assert data_rows(tmp_path / 'csv' / 'results.csv') == 2
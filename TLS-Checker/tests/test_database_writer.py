@@ -0,0 +1,40 @@
+import sqlite3
+import asyncio
+import threading
+
+import pytest
+
+import save_to_database
+from save_to_database import DatabaseWriter
+
+
+def test_put_fails_when_the_writer_fails_on_a_full_queue(tmp_path,
+                                                         monkeypatch):
+    monkeypatch.setattr(save_to_database, 'path', str(tmp_path))
+    locked = threading.Event()
+
+    def write(batch: list) -> None:
+        # A busy timeout under lock contention
+        locked.wait(5)
+        raise sqlite3.OperationalError('database is locked')
+
+    async def scan() -> int:
+        writer = DatabaseWriter(batch_size=1, flush_interval=0, max_queue=2)
+        writer._write = write
+        await writer.start()
+        loop = asyncio.get_running_loop()
+        # Fails the write once the producer waits for room in the queue
+        loop.call_later(0.2, locked.set)
+        queued = 0
+        try:
+            with pytest.raises(RuntimeError) as error:
+                for item in range(10):
+                    await asyncio.wait_for(writer.put(item), 5)
+                    queued += 1
+            assert isinstance(error.value.__cause__, sqlite3.OperationalError)
+        finally:
+            await writer.close()
+        return queued
+
+    # The first item is taken by the writer, two wait in the queue
+    assert asyncio.run(scan()) == 3
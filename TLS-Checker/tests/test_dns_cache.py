@@ -0,0 +1,45 @@
+import time
+import asyncio
+
+from dns_cache import CachingResolver
+
+
+def create(cache_path: str | None = None, **kwargs) -> CachingResolver:
+    async def create_in_loop() -> CachingResolver:
+        return CachingResolver(
+            nameservers=['127.0.0.1:9'], cache_path=cache_path, **kwargs)
+
+    # The resolver channels are created in an event loop
+    return asyncio.run(create_in_loop())
+
+
+def test_memory_is_bounded():
+    resolver = create(max_entries=100)
+    expires = time.time() + 600
+    for index in range(1_000):
+        resolver._store((f'host{index}.example', 'A'), expires, ('192.0.2.1',))
+    resolver.cached('host900.example', 'A')
+    resolver._store(('new.example', 'A'), expires, ('192.0.2.2',))
+
+    assert len(resolver._cache) == 100
+    assert resolver.cached('host0.example', 'A') is None
+    # The recently used entry is kept
+    assert resolver.cached('host900.example', 'A') is not None
+
+
+def test_file_is_read_per_miss_and_written_in_batches(tmp_path):
+    cache_path = str(tmp_path / 'dns_cache.db')
+    writer = create(cache_path, flush_size=10)
+    expires = time.time() + 600
+    for index in range(25):
+        writer._store((f'host{index}.example', 'A'), expires, ('192.0.2.1',))
+
+    # Without save(), e.g. after a crash, the full batches are in the file
+    reader = create(cache_path, max_entries=5)
+    assert reader._cache == {}
+    assert reader.cached('host19.example', 'A')[0].host == '192.0.2.1'
+    assert reader.cached('host24.example', 'A') is None
+
+    writer.save()
+    assert reader.cached('host24.example', 'A')[0].host == '192.0.2.1'
+    assert len(reader._cache) == 2
@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+from filters import Filters, with_check
+from record import ScanResult
+
+
+def record_of(ipv6: bool = True, tls_version: str | None = 'TLSv1.3',
+              issuer: str | None = 'Example CA',
+              geo: list | None = None) -> ScanResult:
+    record = ScanResult('example.com')
+    record.ipv4 = ['192.0.2.1']
+    record.ipv6 = ['2001:db8::1'] if ipv6 else None
+    record.tls_version = tls_version
+    record.issuer_organ = issuer
+    record.geo = [geo or [64496, 'Example', 'ZZ', 'Nowhere']]
+    return record
+
+
+def test_empty_filters_keep_everything():
+    filters = Filters.from_options({})
+
+    assert not filters
+    assert filters.check_addresses(record_of(ipv6=False))
+    assert filters.check_tls(record_of(tls_version=None))
+    assert filters.check_geo(record_of())
+
+
+@pytest.mark.parametrize('record, kept', [
+    (record_of(), True),
+    (record_of(tls_version='TLSv1.2'), False),
+    (record_of(tls_version=None), False),
+    (record_of(issuer="let's encrypt"), False),
+    (record_of(issuer=None), True),
+])
+def test_tls_checks(record, kept):
+    filters = Filters(tls_versions=['TLSv1.3'],
+                      exclude_issuers=["Let's Encrypt"])
+
+    assert filters.check_tls(record) is kept
+
+
+@pytest.mark.parametrize('geo, kept', [
+    ([64496, 'Example', 'ZZ', 'Nowhere'], True),
+    ([13335, 'Cloudflare', 'US', 'United States'], False),
+    ([64496, 'Example', 'CN', 'China'], False),
+    ([64496, 'Example', 'XX', 'Russia'], False),
+    ([None, None, None, None], True),
+])
+def test_geo_checks(geo, kept):
+    filters = Filters(exclude_asns=['AS13335'],
+                      exclude_countries=['cn', 'Russia'])
+
+    assert filters.needs_geo
+    assert filters.check_geo(record_of(geo=geo)) is kept
+
+
+def test_dropped_records_are_counted_by_reason():
+    filters = Filters(require_ipv6=True, tls_versions=['TLSv1.3'])
+
+    async def probe(record: ScanResult, timeout: float | None) -> ScanResult:
+        return record
+
+    checked = with_check(probe, filters.check_tls)
+    records = [record_of(), record_of(tls_version='TLSv1.2')]
+    results = [asyncio.run(checked(record, None)) for record in records]
+
+    assert results == [records[0], None]
+    assert not filters.check_addresses(record_of(ipv6=False))
+    assert filters.dropped == {'tls_version': 1, 'ipv6': 1}
@@ -0,0 +1,90 @@
+import errno
+import socket
+import struct
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import main
+import icmp_ping
+from icmp_ping import IcmpPinger, checksum
+
+
+def ipv6_loopback() -> bool:
+    """Whether ::1 is configured on this host."""
+
+    if not socket.has_ipv6:
+        return False
+    try:
+        with socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) as sock:
+            sock.bind(('::1', 0))
+    except OSError:
+        return False
+    return True
+
+
+def test_checksum_of_a_packet_with_its_checksum_is_zero():
+    header = struct.pack('!BBHHH', icmp_ping.ICMP_ECHO_REQUEST, 0, 0, 1, 1)
+    value = checksum(header + icmp_ping.PAYLOAD)
+    header = struct.pack(
+        '!BBHHH', icmp_ping.ICMP_ECHO_REQUEST, 0, value, 1, 1)
+
+    assert checksum(header + icmp_ping.PAYLOAD) == 0
+
+
+def test_checksum_pads_odd_data():
+    assert checksum(b'\x01') == checksum(b'\x01\x00')
+
+
+@pytest.mark.parametrize('family, address', [
+    (socket.AF_INET, '127.0.0.1'),
+    pytest.param(socket.AF_INET6, '::1', marks=pytest.mark.skipif(
+        not ipv6_loopback(), reason='::1 is not available')),
+])
+def test_ping_loopback(family, address):
+    async def ping() -> list[float | None]:
+        pinger = IcmpPinger()
+        try:
+            if not pinger.available(family):
+                pytest.skip('ICMP sockets are not permitted')
+            # Concurrent pings share one socket and get their own replies
+            return await asyncio.gather(
+                *(pinger.ping(address, 2) for _ in range(5)))
+        finally:
+            pinger.close()
+
+    delays = asyncio.run(ping())
+
+    assert all(delay is not None and 0 <= delay < 2000 for delay in delays)
+
+
+def test_fallback_to_ping3_without_icmp_sockets(monkeypatch):
+    calls: list[tuple] = list()
+
+    def denied(*args, **kwargs):
+        raise PermissionError(errno.EPERM, 'Operation not permitted')
+
+    def ping3_ping(address, unit, timeout):
+        calls.append((address, unit, timeout))
+        return 1.6
+
+    monkeypatch.setattr('ping3.ping', ping3_ping)
+
+    async def ping() -> tuple[bool, float | None]:
+        pinger = IcmpPinger()
+        # Patched only while the loop runs, the loop has its sockets already
+        with monkeypatch.context() as patch:
+            patch.setattr(icmp_ping.socket, 'socket', denied)
+            available = pinger.available(socket.AF_INET)
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                delay = await main.get_ping(
+                    pinger, executor, '127.0.0.1', 3)
+        pinger.close()
+        return available, delay
+
+    available, delay = asyncio.run(ping())
+
+    assert not available
+    assert delay == 2.0
+    assert calls == [('127.0.0.1', 'ms', 3)]
@@ -0,0 +1,50 @@
+import gzip
+
+from metrics import Metrics
+from input_reader import (
+    BloomFilter, ScalableBloomFilter, normalize, read_domains)
+
+
+NAMES = [f'host{i}.example.com' for i in range(20_000)]
+
+
+def test_normalize():
+    assert normalize(' Example.COM. ') == 'example.com'
+    assert normalize('bücher.example') == 'xn--bcher-kva.example'
+    assert normalize('domain') is None
+    assert normalize('192.0.2.1') is None
+
+
+def test_bloom_filter_past_capacity_drops_new_names():
+    bloom = BloomFilter(1_000)
+    dropped = sum(not bloom.add(name) for name in NAMES)
+
+    # The reason for ScalableBloomFilter
+    assert dropped > len(NAMES) // 10
+
+
+def test_scalable_bloom_filter_past_capacity():
+    bloom = ScalableBloomFilter(1_000)
+    dropped = sum(not bloom.add(name) for name in NAMES)
+
+    assert len(bloom.slices) > 1
+    assert dropped <= 10
+    assert not any(bloom.add(name) for name in NAMES)
+
+
+def test_read_domains_past_capacity_drops_only_duplicates(tmp_path):
+    input_path = tmp_path / 'input.csv.gz'
+    with gzip.open(input_path, 'wt') as file:
+        file.write('domain\n')
+        file.writelines(f'{name}\n' for name in NAMES + NAMES[:500])
+    metrics = Metrics()
+
+    domains = list(read_domains(str(input_path), 1_000, metrics))
+
+    # A few false positives are counted as duplicates
+    kept = set(domains)
+    assert len(domains) >= len(NAMES) - 10
+    assert domains == [name for name in NAMES if name in kept]
+    assert metrics.outcomes[('input', 'duplicate')] == \
+        500 + len(NAMES) - len(domains)
+    assert metrics.outcomes[('input', 'invalid')] == 1
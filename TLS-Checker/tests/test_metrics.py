@@ -0,0 +1,20 @@
+import ssl
+import asyncio
+
+from aiodns.error import DNSError
+
+from metrics import error_class
+
+
+def test_error_class_of_tls_probe_failures():
+    assert error_class(asyncio.TimeoutError()) == 'timeout'
+    assert error_class(ConnectionRefusedError()) == 'refused'
+    assert error_class(ConnectionResetError()) == 'reset'
+    assert error_class(ssl.SSLCertVerificationError()) == 'cert_error'
+
+
+def test_dns_refusals_are_not_tcp_refusals():
+    assert error_class(DNSError(11, 'Could not contact DNS servers')) == \
+        'dns_conn_refused'
+    assert error_class(DNSError(6, 'Refused')) == 'dns_refused'
+    assert error_class(DNSError(4, 'Domain name not found')) == 'nxdomain'
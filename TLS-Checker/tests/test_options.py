@@ -0,0 +1,42 @@
+import json
+import argparse
+
+import pytest
+
+from options import add_option_arguments, headless_options
+
+
+def options_of(*flags: str) -> dict:
+    parser = argparse.ArgumentParser()
+    add_option_arguments(parser)
+    return headless_options(parser.parse_args(['--headless', *flags]), None)
+
+
+def test_stage_concurrency_defaults_to_active_tasks():
+    options = options_of('--active-tasks', '300')
+
+    assert options['dns_tasks'] == options['tls_tasks'] == 300
+    assert options['ping_tasks'] == 300
+    assert options['adaptive_max'] == 3000
+    assert options['dns_channels'] == 2
+
+
+def test_stage_concurrency_from_flags_and_config(tmp_path):
+    config_path = tmp_path / 'scan.json'
+    config_path.write_text(json.dumps({'tls_tasks': 50, 'dns_channels': 4}))
+
+    options = options_of('--config', str(config_path), '--dns-tasks', '800',
+                         '--adaptive-max', '1200')
+
+    assert options['dns_tasks'] == 800
+    assert options['tls_tasks'] == 50
+    assert options['ping_tasks'] == 100
+    assert options['adaptive_max'] == 1200
+    assert options['dns_channels'] == 4
+
+
+@pytest.mark.parametrize('flags', [
+    ('--tls-tasks', '0'), ('--dns-channels', '-1'), ('--adaptive-max', '0')])
+def test_stage_concurrency_below_one_is_rejected(flags):
+    with pytest.raises(SystemExit):
+        options_of(*flags)
@@ -0,0 +1,63 @@
+import asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import main
+from metrics import Metrics
+from pipeline import Pipeline, Stage
+from record import ScanResult
+
+
+def run_pipeline(stages: list[Stage], items: list,
+                 metrics: Metrics) -> list:
+    async def collect() -> list:
+        pipeline = Pipeline(stages, metrics=metrics)
+        return [item async for item in pipeline.run(iter(items))]
+
+    return asyncio.run(collect())
+
+
+def test_expected_failure_drops_the_item():
+    async def connect(item: int, timeout: float | None) -> int:
+        if item == 2:
+            raise ConnectionRefusedError()
+        return item
+
+    metrics = Metrics()
+    output = run_pipeline([Stage('tls', connect, 2)], [1, 2, 3], metrics)
+
+    assert sorted(output, key=str) == [1, 3, None]
+    assert metrics.outcomes[('tls', 'refused')] == 1
+    assert metrics.outcomes[('tls', 'passed')] == 2
+
+
+def test_unexpected_failure_fails_the_pipeline():
+    async def broken(item: int, timeout: float | None) -> int:
+        if item == 2:
+            raise KeyError('bug')
+        return item
+
+    with pytest.raises(KeyError):
+        run_pipeline([Stage('tls', broken, 2)], [1, 2, 3], Metrics())
+
+
+def test_failed_geo_lookup_keeps_the_record(monkeypatch):
+    def failed(addresses: list[str]) -> list[list]:
+        raise ValueError('corrupt database')
+
+    monkeypatch.setattr(main, 'geo_addresses', failed)
+    record = ScanResult('example.com')
+    record.ipv4, record.ipv6 = ['192.0.2.1'], ['2001:db8::1']
+
+    metrics = Metrics()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        enrich = partial(
+            main.enrich_stage, geo_executor=executor, metrics=metrics)
+        output = run_pipeline([Stage('enrich', enrich, 1)], [record], metrics)
+
+    assert output == [record]
+    assert record.geo == [[None] * 4, [None] * 4]
+    assert metrics.outcomes[('geo', 'error')] == 1
+    assert metrics.outcomes[('enrich', 'passed')] == 1
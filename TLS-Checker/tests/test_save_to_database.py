@@ -0,0 +1,139 @@
+import os
+import time
+import sqlite3
+
+import pytest
+
+import main
+import save_to_database
+from metrics import Metrics
+from record import ScanResult
+from save_to_database import create_table, skip_fresh, write_rows
+
+
+# The results table of version 1, before the columns of ADDED_COLUMNS
+V1_RESULTS = '''
+    CREATE TABLE results (
+    domain_name TEXT PRIMARY KEY,
+    ipv4 TEXT,
+    ipv6 TEXT,
+    asn INTEGER,
+    asn_organ TEXT,
+    iso_code INTEGER,
+    country TEXT,
+    cipher TEXT,
+    tls_version TEXT,
+    issuer_organ TEXT,
+    ping TEXT
+    )
+'''
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch) -> str:
+    monkeypatch.setattr(save_to_database, 'path', str(tmp_path))
+    return str(tmp_path / 'output.db')
+
+
+def add_scans(database_path: str, scans: dict[str, int]) -> None:
+    records = list()
+    for domain_name, scanned_at in scans.items():
+        record = ScanResult(domain_name)
+        record.ipv4 = ['192.0.2.1']
+        record.geo = [[None] * 4]
+        record.scanned_at = scanned_at
+        records.append(record)
+
+    con = sqlite3.connect(database_path)
+    with con:
+        create_table(con.cursor())
+        write_rows(con, main.extract_results(records))
+    con.close()
+
+
+def test_skip_fresh_looks_up_the_newest_scan(database):
+    now = int(time.time())
+    add_scans(database, {'fresh.example': now - 60,
+                         'old.example': now - 7200})
+    # A newer scan of old.example, also stale
+    add_scans(database, {'old.example': now - 3700})
+    metrics = Metrics()
+
+    domains = list(skip_fresh(
+        ['new.example', 'fresh.example', 'old.example', 'other.example'],
+        1, metrics, batch_size=3))
+
+    assert domains == ['new.example', 'old.example', 'other.example']
+    assert metrics.outcomes[('input', 'fresh')] == 1
+
+
+def test_migrated_scans_get_the_time_of_the_database_file(database):
+    con = sqlite3.connect(database)
+    con.execute(V1_RESULTS)
+    con.execute('''
+        INSERT INTO results VALUES ('v1.example', '192.0.2.1', NULL, 64496,
+            'Example', 'ZZ', 'Nowhere', 'TLS_AES_128_GCM_SHA256', 'TLSv1.3',
+            'Example CA', '12')
+    ''')
+    con.commit()
+    con.close()
+    os.utime(database, (time.time() - 600, time.time() - 600))
+    modified = int(os.path.getmtime(database))
+
+    add_scans(database, {})
+
+    con = sqlite3.connect(database)
+    assert con.execute('SELECT scanned_at FROM scans').fetchall() == [
+        (modified,)]
+    con.close()
+    # A resumed run skips the migrated domain while it is fresh
+    assert list(skip_fresh(['v1.example'], 1)) == []
+
+
+def test_migration_moves_every_v1_row(database):
+    con = sqlite3.connect(database)
+    con.execute(V1_RESULTS)
+    con.execute('''
+        CREATE TABLE address_geo (
+        domain_name TEXT, ip TEXT, asn INTEGER, asn_organ TEXT,
+        iso_code TEXT, country TEXT, PRIMARY KEY (domain_name, ip))
+    ''')
+    con.executemany(
+        'INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [
+            ('a.example', '192.0.2.1,192.0.2.2', '2001:db8::1', 64496,
+             'Example', 'ZZ', 'Nowhere', 'TLS_AES_128_GCM_SHA256',
+             'TLSv1.3', 'Example CA', '12'),
+            ('b.example', '192.0.2.1', None, 64496, 'Example', 'ZZ',
+             'Nowhere', 'TLS_AES_128_GCM_SHA256', 'TLSv1.2', 'Example CA',
+             'timeout'),
+            ('c.example', None, None, None, None, None, None, None, None,
+             None, None)])
+    con.executemany('INSERT INTO address_geo VALUES (?, ?, ?, ?, ?, ?)', [
+        ('a.example', '192.0.2.1', 64496, 'Example', 'ZZ', 'Nowhere'),
+        ('a.example', '192.0.2.2', 64497, 'Other', 'YY', 'Somewhere'),
+        ('b.example', '192.0.2.1', 64496, 'Example', 'ZZ', 'Nowhere')])
+    con.commit()
+    con.close()
+
+    add_scans(database, {})
+
+    con = sqlite3.connect(database)
+
+    def count(table: str) -> int:
+        return con.execute(f'SELECT count(*) FROM {table}').fetchone()[0]
+
+    assert count('domains') == 3
+    assert count('scans') == 3
+    assert count('addresses') == 3
+    assert count('scan_addresses') == 4
+    assert count('certificates') == 1
+    assert count('results') == 3
+    assert con.execute(
+        'SELECT asn FROM addresses WHERE ip = ?', ('192.0.2.2',)
+    ).fetchone() == (64497,)
+    assert con.execute('PRAGMA user_version').fetchone() == (
+        save_to_database.SCHEMA_VERSION,)
+    assert con.execute(
+        "SELECT name FROM sqlite_master WHERE name LIKE '%_v1'"
+    ).fetchall() == []
+    con.close()
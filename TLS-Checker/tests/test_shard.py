@@ -0,0 +1,42 @@
+import pytest
+
+from shard import filter_shard, parse_shard, shard_of, shard_share
+
+
+NAMES = [f'host{i}.example.com' for i in range(10_000)]
+POSITION = {name: position for position, name in enumerate(NAMES)}
+
+
+@pytest.mark.parametrize('count', [1, 3, 8])
+def test_shards_cover_every_name_exactly_once(count):
+    shards = [list(filter_shard(NAMES, (index, count)))
+              for index in range(count)]
+
+    assert sorted(name for shard in shards for name in shard) == \
+        sorted(NAMES)
+    assert sum(len(shard) for shard in shards) == len(NAMES)
+    # The shards keep the input order and are roughly balanced
+    for shard in shards:
+        assert shard == sorted(shard, key=POSITION.get)
+        assert len(shard) > len(NAMES) / count * 0.9
+
+
+def test_shard_of_is_stable():
+    # The same on every process, machine and version (CRC-32), unlike hash()
+    assert shard_of('example.com', 8) == 1
+    assert shard_of('example.com', 3) == 3069857465 % 3
+
+
+@pytest.mark.parametrize('total, count', [(10, 3), (2, 4), (0, 2)])
+def test_shard_shares_add_up(total, count):
+    shares = [shard_share(total, (index, count)) for index in range(count)]
+
+    assert sum(shares) == total
+    assert max(shares) - min(shares) <= 1
+
+
+def test_parse_shard():
+    assert parse_shard('2/8') == (1, 8)
+    for value in ('0/4', '5/4', 'one/4', '1'):
+        with pytest.raises(SystemExit):
+            parse_shard(value)
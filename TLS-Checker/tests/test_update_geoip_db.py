@@ -0,0 +1,179 @@
+import os
+import sys
+import json
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import update_geoip_db
+
+
+"""
+The updater runs against a local stand-in of the GitHub release API. The
+stand-in serves the release JSON with an ETag and the files with ETag, Range
+and If-Range support, and records every request.
+"""
+
+
+class StandIn(ThreadingHTTPServer):
+    """
+    Local release server.
+
+    Attributes:
+        files (dict[str, bytes]): The assets of the release.
+        served (dict[str, bytes]): Bytes served instead of an asset, e.g. a
+            corrupt download.
+        cut (set[str]): Assets whose next response is cut off halfway.
+        requests (list[tuple[str, dict]]): Path and headers of every
+            request.
+    """
+
+    def __init__(self, files: dict[str, bytes]) -> None:
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.files = files
+        self.served: dict[str, bytes] = dict()
+        self.cut: set[str] = set()
+        self.requests: list[tuple[str, dict]] = list()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def release(self) -> bytes:
+        return json.dumps({'tag_name': 'v1', 'assets': [{
+            'name': name,
+            'browser_download_url': f'{self.url}/files/{name}',
+            'size': len(data),
+            'updated_at': hashlib.md5(data).hexdigest(),
+            'digest': 'sha256:' + hashlib.sha256(data).hexdigest(),
+        } for name, data in self.files.items()]}).encode()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    server: StandIn
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def send(self, status: int, body: bytes, etag: str,
+             headers: dict | None = None) -> None:
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.path == '/release':
+            body = self.server.release()
+            etag = '"' + hashlib.md5(body).hexdigest() + '"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send(200, body, etag)
+            return
+
+        name = self.path.rsplit('/', 1)[-1]
+        data = self.server.served.get(name, self.server.files[name])
+        etag = '"' + hashlib.md5(data).hexdigest() + '"'
+        start = 0
+        if self.headers.get('Range') and \
+                self.headers.get('If-Range', etag) == etag:
+            start = int(self.headers['Range'][6:].rstrip('-'))
+        body = data[start:]
+        status = 206 if start else 200
+        if name in self.server.cut:
+            self.server.cut.discard(name)
+            # Announces the whole body and closes the connection halfway
+            self.send_response(status)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.send(status, body, etag, {
+            'Content-Range': f'bytes {start}-{len(data) - 1}/{len(data)}'}
+            if start else None)
+
+
+@pytest.fixture
+def stand_in(tmp_path, monkeypatch):
+    files = {'GeoLite2-ASN.mmdb': os.urandom(300_000),
+             'GeoLite2-City.mmdb': os.urandom(200_000)}
+    server = StandIn(files)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    monkeypatch.setattr(update_geoip_db, 'this_path', str(tmp_path))
+    monkeypatch.setattr(update_geoip_db, 'backoff', lambda attempt: 0)
+    # The random test files are not MaxMind databases, the format check of
+    # verify() is skipped
+    monkeypatch.setitem(sys.modules, 'maxminddb', None)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def file_requests(server: StandIn, name: str) -> list[dict]:
+    return [headers for path, headers in server.requests
+            if path == f'/files/{name}']
+
+
+def test_unchanged_release_is_not_downloaded(stand_in, tmp_path):
+    update_geoip_db.update(stand_in.url + '/release')
+    for name, data in stand_in.files.items():
+        assert (tmp_path / name).read_bytes() == data
+
+    stand_in.requests.clear()
+    update_geoip_db.update(stand_in.url + '/release')
+
+    assert [path for path, _ in stand_in.requests] == ['/release']
+    assert stand_in.requests[0][1]['If-None-Match']
+
+
+def test_broken_download_is_resumed(stand_in, tmp_path):
+    name = 'GeoLite2-ASN.mmdb'
+    stand_in.cut.add(name)
+
+    update_geoip_db.update(stand_in.url + '/release')
+
+    first, second = file_requests(stand_in, name)
+    assert 'Range' not in first
+    assert second['Range'].startswith('bytes=')
+    assert second['Range'] != 'bytes=0-'
+    assert second['If-Range']
+    assert (tmp_path / name).read_bytes() == stand_in.files[name]
+    assert not (tmp_path / f'{name}.part').exists()
+
+
+def test_corrupt_download_keeps_the_old_file(stand_in, tmp_path):
+    update_geoip_db.update(stand_in.url + '/release')
+    name = 'GeoLite2-City.mmdb'
+    old = stand_in.files[name]
+
+    # A new release whose file arrives corrupted
+    stand_in.files[name] = os.urandom(len(old))
+    stand_in.served[name] = os.urandom(len(old))
+    stand_in.requests.clear()
+    update_geoip_db.update(stand_in.url + '/release')
+
+    # A verification failure is not downloaded again
+    assert len(file_requests(stand_in, name)) == 1
+    assert (tmp_path / name).read_bytes() == old
+    assert not (tmp_path / f'{name}.part').exists()
+
+    # The failed file is downloaded again by the next update
+    del stand_in.served[name]
+    stand_in.requests.clear()
+    update_geoip_db.update(stand_in.url + '/release')
+
+    assert len(file_requests(stand_in, name)) == 1
+    assert (tmp_path / name).read_bytes() == stand_in.files[name]
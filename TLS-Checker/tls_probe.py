@@ -0,0 +1,123 @@
+import ssl
+import time
+import asyncio
+
+from metrics import error_class
+
+
+"""
+Non-blocking TLS probe built on the asyncio event loop. Every handshake is
+driven by the loop itself, so the number of concurrent probes is bounded only
+by the semaphore of the caller and not by the size of a thread pool.
+"""
+
+
+def create_context() -> ssl.SSLContext:
+    """
+    Creates the SSLContext shared by all probes of a scan.
+
+    Building a default context loads the system CA bundle, so it is created
+    once and reused for every handshake instead of once per domain.
+
+    Returns:
+        ssl.SSLContext: A client context with the default settings.
+    """
+
+    return ssl.create_default_context()
+
+
+async def tls_info(
+        hostname: str,
+        timeout: int,
+        context: ssl.SSLContext | None = None,
+        address: str | None = None,
+        port: int = 443) -> dict:
+    """
+    Establishes a TLS connection to the specified hostname over port 443 with
+    the given timeout and retrieves the TLS version, cryptographic details,
+    and issuer of its certificate. The TCP connect and the TLS handshake are
+    timed separately on the same connection, so they can be used as a latency
+    metric when ICMP is filtered.
+
+    Args:
+        hostname (str): The domain name, it is sent as SNI and used to verify
+            the certificate.
+        timeout (int): The timeout duration for the whole probe.
+        context (ssl.SSLContext | None): The shared SSLContext, a default one
+            is created if it is not given.
+        address (str | None): An already resolved IP address of the hostname.
+            The connection goes to this address so the hostname is not
+            resolved again. Falls back to the hostname if it is not given.
+        port (int): The TCP port, local test servers use another one.
+
+    Returns:
+        dict: A dictionary containing the TLS version, cipher used, issuer
+              organization of the certificate, the TCP connect and TLS
+              handshake durations in milliseconds, and 'error' which is
+              the class of the failure (e.g. 'timeout', 'refused',
+              'cert_error', see metrics.error_class) or None. A failed
+              handshake keeps the TCP connect time if it was measured.
+    """
+
+    if context is None:
+        context = create_context()
+
+    info: dict[str, str | float | None] = {
+        'version': None,
+        'cipher': None,
+        'issuer': None,
+        'tcp_connect_ms': None,
+        'tls_handshake_ms': None,
+        'error': None,
+    }
+    transports: list[asyncio.BaseTransport] = list()
+    try:
+        await asyncio.wait_for(
+            _handshake(hostname, address or hostname, port, context, info,
+                       transports),
+            timeout=timeout)
+    except Exception as e:
+        info['error'] = error_class(e)
+        info['version'] = None
+        info['cipher'] = None
+        info['issuer'] = None
+    finally:
+        # abort() drops the connection without waiting for close_notify,
+        # nothing is sent after the handshake so there is nothing to flush
+        for transport in transports:
+            transport.abort()
+
+    return info
+
+
+async def _handshake(
+        hostname: str,
+        host: str,
+        port: int,
+        context: ssl.SSLContext,
+        info: dict,
+        transports: list) -> None:
+    """
+    Connects to host, upgrades the connection to TLS and fills info in place,
+    so a timeout of the caller still leaves the measured values in info.
+    """
+
+    loop = asyncio.get_running_loop()
+
+    started = time.perf_counter()
+    transport, protocol = await loop.create_connection(
+        asyncio.Protocol, host, port)
+    connected = time.perf_counter()
+    transports.append(transport)
+    info['tcp_connect_ms'] = round((connected - started) * 1000, 2)
+
+    ssl_transport = await loop.start_tls(
+        transport, protocol, context, server_hostname=hostname)
+    transports.append(ssl_transport)
+    info['tls_handshake_ms'] = round(
+        (time.perf_counter() - connected) * 1000, 2)
+
+    ssock = ssl_transport.get_extra_info('ssl_object')
+    info['version'] = ssock.version()
+    info['cipher'] = ssock.cipher()[0]
+    info['issuer'] = ssock.getpeercert()['issuer'][1][0][1]
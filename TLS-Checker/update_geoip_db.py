@@ -1,101 +1,349 @@
 import os
 import sys
+import json
 import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
 
+"""
+Updates the GeoLite databases from the latest release of
+https://github.com/P3TERX/GeoLite.mmdb. The release and every file are
+compared with the ones of the last update (geoip_state.json), so an
+unchanged release costs one conditional request and no download. Changed
+files are downloaded at the same time into '<name>.part' files, a broken
+download is resumed with an HTTP range request, and a file replaces the
+current database only after it was verified, so a failed download never
+leaves a truncated database behind.
+
+The release API can be changed (--geoip-api), e.g. to a local stand-in that
+serves the same JSON.
+"""
+
+
 this_path: str = os.getcwd()
 api: str = 'https://api.github.com/repos/P3TERX/GeoLite.mmdb/releases/latest'
 repo_url: str = 'https://github.com/P3TERX/GeoLite.mmdb'
 
+# Release assets that are not used by the scan
+SKIPPED_ASSETS: tuple[str, ...] = ('GeoLite2-Country.mmdb',)
+
+# Bytes hashed at once, and bytes read from a response at once (a broken
+# download keeps everything but the chunk being read)
+CHUNK_SIZE: int = 1 << 20
+DOWNLOAD_CHUNK_SIZE: int = 1 << 16
+
+# Attempts of every request, with an exponential backoff between them
+RETRIES: int = 5
+MAX_BACKOFF: float = 30.0
+
+
+def load_state() -> dict:
+    """
+    Reads the release and the files of the last update.
+
+    Returns:
+        dict: {'etag': ETag of the release response, 'tag': release tag,
+        'files': {name: {'size', 'updated_at', 'etag'}}}, empty if there
+        was no update yet.
+    """
+
+    try:
+        with open(os.path.join(this_path, 'geoip_state.json')) as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_state(state: dict) -> None:
+    """Writes the state of load_state() atomically."""
+
+    state_path = os.path.join(this_path, 'geoip_state.json')
+    with open(state_path + '.tmp', 'w') as state_file:
+        json.dump(state, state_file, indent=2)
+    os.replace(state_path + '.tmp', state_path)
+
+
+def backoff(attempt: int) -> float:
+    """Seconds to wait before the next attempt."""
+
+    return min(MAX_BACKOFF, 2.0 ** attempt)
+
 
-def get_info() -> dict:
+def get_info(api_url: str, etag: str | None = None) -> dict | None:
     """
     Retrieves information about the latest release of the GeoLite database from
     https://github.com/P3TERX/GeoLite.mmdb GitHub repository.
 
+    Args:
+        api_url (str): URL of the release API.
+        etag (str | None): ETag of the last release response, the release
+            is not downloaded again if it didn't change.
+
     Returns:
-        dict: A dictionary containing the database names and their respective
-        download URLs.
+        dict | None: {'etag', 'tag', 'assets': {name: {'url', 'size',
+        'updated_at', 'digest'}}}, or None if the release didn't change.
 
     Raises:
-        SystemExit: If there are no files in the repository's releases assets.
+        RuntimeError: If the release can't be fetched.
     """
-    db_info: dict[str, str] = dict()
-    while True:
+
+    headers = {'Accept': 'application/vnd.github+json'}
+    if etag:
+        headers['If-None-Match'] = etag
+
+    print(f'| Getting release info from {api_url}')
+    for attempt in range(1, RETRIES + 1):
         try:
-            print(f'\r| Getting info from github repository: {repo_url}', end='')
-            response = requests.get(api, timeout=30)
-            if response.status_code == 200:
-                assets: list = response.json().get('assets', [])
-                if None in assets:
-                    print(f'| There is no file in this repository'
-                          f' {repo_url} > release > assets')
-                    sys.exit(1)
-                else:
-                    for asset in assets:
-                        if asset['name'] != 'GeoLite2-Country.mmdb':
-                            db_info[asset['name']] = asset['browser_download_url']
-            else:
-                print(f'\n| Downloading files from this repository {repo_url}'
-                      f'was unsuccessful > status code: {response.status_code}')
-                sys.exit(1)
-        except Exception as e:
-            print(f'\r| An error occurred: {e}')
-            print('| Retry after 20 seconds ...', end='')
-            time.sleep(20)
+            response = requests.get(api_url, headers=headers, timeout=30)
+        except requests.RequestException as e:
+            error = f'an error occurred: {e}'
         else:
-            print(f'\n| Successfully extracted'
-                  f' data from {repo_url} repository ✓')
-            break
+            if response.status_code == 304:
+                return None
+            if response.status_code == 200:
+                break
+            error = f'status code: {response.status_code}'
+            # Only rate limits and server errors are worth another try
+            if response.status_code not in (403, 429) and \
+                    response.status_code < 500:
+                raise RuntimeError(error)
+        if attempt == RETRIES:
+            raise RuntimeError(error)
+        print(f'| Getting release info failed, {error}, '
+              f'retry after {backoff(attempt):g} seconds ...')
+        time.sleep(backoff(attempt))
+
+    release: dict = response.json()
+    assets: dict[str, dict] = dict()
+    for asset in release.get('assets') or []:
+        if not asset or asset.get('name') in SKIPPED_ASSETS:
+            continue
+        assets[asset['name']] = {
+            'url': asset['browser_download_url'],
+            'size': asset.get('size'),
+            'updated_at': asset.get('updated_at'),
+            # 'sha256:<hex>' on GitHub
+            'digest': asset.get('digest'),
+        }
+    if not assets:
+        raise RuntimeError(f'the release of {api_url} has no assets')
+
+    return {'etag': response.headers.get('ETag'),
+            'tag': release.get('tag_name'),
+            'assets': assets}
+
+
+def sha256_digest(file_path: str) -> str:
+    """Returns the digest of a file in the 'sha256:<hex>' form of GitHub."""
+
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        while chunk := file.read(CHUNK_SIZE):
+            sha256.update(chunk)
+    return 'sha256:' + sha256.hexdigest()
+
+
+def is_current(name: str, asset: dict, known: dict | None) -> bool:
+    """
+    Whether the local file is the same as the asset of the release: it
+    exists, has the size of the asset and was downloaded from the same
+    upload of it. A file without state (e.g. downloaded by hand) is current
+    if it has the digest of the asset.
+    """
+
+    db_path = os.path.join(this_path, name)
+    if not os.path.isfile(db_path):
+        return False
+    if asset['size'] is not None and os.path.getsize(db_path) != asset['size']:
+        return False
+    if known is None:
+        return bool(asset['digest']) and \
+            sha256_digest(db_path) == asset['digest']
+    return known.get('updated_at') == asset['updated_at']
 
-    return db_info
 
+def verify(file_path: str, asset: dict) -> None:
+    """
+    Checks a downloaded file against the size and digest of the asset and
+    opens it as a MaxMind database.
+
+    Raises:
+        ValueError: If the file is not the asset.
+    """
+
+    size = os.path.getsize(file_path)
+    if asset['size'] is not None and size != asset['size']:
+        raise ValueError(f'size is {size} bytes instead of {asset["size"]}')
 
-def download_db(db_info: dict) -> None:
+    digest: str | None = asset['digest']
+    if digest and digest.startswith('sha256:') and \
+            sha256_digest(file_path) != digest:
+        raise ValueError('sha256 digest does not match')
+
+    try:
+        import maxminddb
+    except ImportError:
+        return
+    try:
+        maxminddb.open_database(file_path).close()
+    except Exception as e:
+        raise ValueError(f'not a MaxMind database > {e}')
+
+
+def fetch(name: str, asset: dict, progress: dict) -> None:
     """
-    Downloads the GeoLite databases using the provided database information.
+    Downloads an asset into '<name>.part'. A partial file of an earlier
+    attempt is resumed with a range request (If-Range keeps it only if the
+    file didn't change in between), the verified file replaces the database.
 
     Args:
-        db_info (dict): A dictionary containing the database names as keys and
-        their corresponding download URLs as values.
+        name (str): The file name of the database.
+        asset (dict): The asset, see get_info().
+        progress (dict): Keeps the ETag of the response between attempts.
+    """
+
+    db_path = os.path.join(this_path, name)
+    part_path = db_path + '.part'
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    if asset['size'] is not None and offset >= asset['size']:
+        offset = 0
+
+    headers: dict[str, str] = dict()
+    if offset:
+        headers['Range'] = f'bytes={offset}-'
+        if progress.get('etag'):
+            headers['If-Range'] = progress['etag']
+
+    with requests.get(asset['url'], headers=headers, stream=True,
+                      timeout=30) as response:
+        if response.status_code == 416:
+            # The next attempt downloads the whole file
+            os.remove(part_path)
+            raise requests.HTTPError('the partial file can not be resumed',
+                                     response=response)
+        response.raise_for_status()
+        if response.status_code != 206:
+            # The server sent the whole file
+            offset = 0
+        progress['etag'] = response.headers.get('ETag')
+        with open(part_path, 'ab' if offset else 'wb') as file:
+            file.seek(offset)
+            file.truncate()
+            for chunk in response.iter_content(
+                    chunk_size=DOWNLOAD_CHUNK_SIZE):
+                file.write(chunk)
+
+    try:
+        verify(part_path, asset)
+    except ValueError:
+        os.remove(part_path)
+        raise
+    os.replace(part_path, db_path)
+
+
+def download_db(name: str, asset: dict) -> dict:
+    """
+    Downloads one GeoLite database. A transport error is retried RETRIES
+    times, the download is resumed then. A file that fails verify() is not
+    downloaded again, the same release would give the same file.
+
+    Args:
+        name (str): The file name of the database.
+        asset (dict): The asset, see get_info().
 
     Returns:
-        None
+        dict: The state of the downloaded file, see load_state().
 
-    Notes:
-        This function retries downloading if an error occurs during the process.
+    Raises:
+        requests.RequestException | OSError: The error of the last attempt.
+        ValueError: If the downloaded file is not the asset.
     """
-    for db_name_url in list(db_info.items()):
-        name: str = db_name_url[0]
-        url: str = db_name_url[1]
-        while True:
+
+    progress: dict = dict()
+    for attempt in range(1, RETRIES + 1):
+        try:
+            print(f'| Start downloading {name} ...')
+            fetch(name, asset, progress)
+        except (requests.RequestException, OSError) as e:
+            if attempt == RETRIES:
+                raise
+            print(f'| Downloading process of {name} encountered an error: '
+                  f'{e}\n| Retry after {backoff(attempt):g} seconds ...')
+            time.sleep(backoff(attempt))
+        else:
+            return {'size': asset['size'], 'updated_at': asset['updated_at'],
+                    'etag': progress.get('etag')}
+
+
+def update(api_url: str | None = None) -> None:
+    """
+    Orchestrates the update process by fetching database information and
+    downloading the changed GeoLite databases at the same time.
+
+    Args:
+        api_url (str | None): URL of the release API, the GitHub API of
+            repo_url by default.
+
+    Raises:
+        SystemExit: If a database is missing and it can't be downloaded.
+    """
+
+    api_url = api_url or api
+    state = load_state()
+    files: dict[str, dict] = state.setdefault('files', dict())
+    complete = bool(files) and all(
+        os.path.isfile(os.path.join(this_path, name)) for name in files)
+
+    try:
+        info = get_info(api_url, state.get('etag') if complete else None)
+    except RuntimeError as e:
+        print(f'| Getting the release from {api_url} was unsuccessful > {e}')
+        if complete:
+            print('| The current GeoLite databases are used')
+            return
+        sys.exit(1)
+    if info is None:
+        print('| The GeoLite databases are up to date ✓')
+        return
+
+    changed: dict[str, dict] = dict()
+    for name, asset in info['assets'].items():
+        if is_current(name, asset, files.get(name)):
+            files[name] = {'size': asset['size'],
+                           'updated_at': asset['updated_at'],
+                           'etag': files.get(name, {}).get('etag')}
+        else:
+            changed[name] = asset
+    if not changed:
+        print(f'| The GeoLite databases of {info["tag"]} are up to date ✓')
+
+    failed: list[str] = list()
+    with ThreadPoolExecutor(max_workers=max(1, len(changed))) as executor:
+        futures = {name: executor.submit(download_db, name, asset)
+                   for name, asset in changed.items()}
+        for name, future in futures.items():
             try:
-                print(f'\r| Start downloading {name} ...', end='')
-                with requests.get(url, stream=True) as response:
-                    db_path: str = os.path.join(this_path, name)
-                    with open(db_path, mode='wb') as file:
-                        for chunk in response.iter_content(chunk_size=10 * 1024):
-                            file.write(chunk)
+                files[name] = future.result()
             except Exception as e:
-                print(f'\r| Downloading process of {name} '
-                      f'encountered an error: {e}'
-                      f'\n| Retry after 20 seconds ...', end='')
-                time.sleep(20)
+                failed.append(name)
+                print(f'| Downloading {name} was unsuccessful > {e}')
             else:
-                print(f'\n| Downloading {name} from {repo_url} '
+                print(f'| Downloading {name} from {changed[name]["url"]} '
                       f'is completed ✓')
-                break
 
+    # A release with a failed file is checked again by the next update
+    if not failed:
+        state['etag'] = info['etag']
+        state['tag'] = info['tag']
+    save_state(state)
 
-def update():
-    """
-   Orchestrates the update process by fetching database information and
-   downloading the GeoLite databases.
-
-   Returns:
-       None
-   """
-    db_info: dict = get_info()
-    download_db(db_info)
+    missing = [name for name in failed
+               if not os.path.isfile(os.path.join(this_path, name))]
+    if missing:
+        print(f'| {", ".join(missing)} could not be downloaded')
+        sys.exit(1)
+    if failed:
+        print('| The current files are kept for the failed downloads')